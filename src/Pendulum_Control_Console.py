@@ -1,19 +1,15 @@
 import numpy as np
-import matplotlib as mpl, matplotlib.pyplot as plt
 import time, os, threading
 # import modules from other python files
 from data_process import data, live_data
 from arduino_manager import arduino
 from moment_data_process import data_frame
-plt.rcParams['axes.grid'] = True
-plt.rcParams["figure.autolayout"] = True
-prop_cycle = plt.rcParams['axes.prop_cycle']
-colors = prop_cycle.by_key()['color']
-mpl.use('TkAgg')
+# matplotlib is set up by data_process, not imported at all in headless mode
 # Initialisation of some constants and variables
 port = 'COM4' 
 baudrate = 230400 
 MAX_COUNT = 10 # Number of points waited to plot a frame 
+READER_TIMEOUT = 2 # Time (s) waited for the reader thread to stop at the end of a run
 ANGLE_ROTATION = 55 # Rotation of the y-label
 
 # This is simply a class to manage the cart pendulum system, nothing physically interesting
@@ -31,6 +27,7 @@ class cart_pendulum():
         self.data = data
         self.temp_datum = temp_data
         self.df = data_frame
+        self.reader = None # Thread reading the arduino during a run, see thread_reader
         self.module_name = r"\Defaut_Cart_Pendulum"
         self.center_count = 0
         self.distance = 0
@@ -98,6 +95,18 @@ class cart_pendulum():
         if(swing_request):
             self.flag_list["swing_request"] = False
             
+    def stop_reader(self):
+        '''Stops the reader thread and waits for it, so that the run is exported
+        (and its record closed) with all the samples it read'''
+        if(self.reader is None):
+            return
+        self.temp_datum.flag_close_event = True
+        self.reader.join(READER_TIMEOUT)
+        if(self.reader.is_alive()):
+            print("The reader thread did not stop, the last samples may be missing.")
+        self.reader = None
+        self.temp_datum.copy(self.data)
+
     def reconnect(self, 
                   exp = False, 
                   swing_request = False, 
@@ -107,11 +116,12 @@ class cart_pendulum():
                   input_spec_info = True,
                   ):
         '''This function stops the serial connection and waits for ENTER to reconnect'''
+        self.stop_reader()
         if(send_terminate):
             time.sleep(0.1)
             self.arduino.send_message("Terminate\n")
         try:
-            plt.close("all")
+            self.temp_datum.close_figure()
             self.arduino.read_single()
             self.arduino.clear()
             self.arduino.board.close()
@@ -119,7 +129,8 @@ class cart_pendulum():
             if(exp):
                 self.temp_datum.export_csv(self.module_name, 
                                       NR_phase_amp = NR_phase_amp,
-                                      input_spec_info = input_spec_info,)
+                                      input_spec_info = input_spec_info,
+                                      background = not input_spec_info,)
             if(manual_continue):
                 input("\nPress ENTER to reconnect.\n\nOr press CTRL+C then ENTER to exit the program.\n")
                 self.arduino.initiate()
@@ -223,9 +234,10 @@ class cart_pendulum():
         except OSError:
             pass
         if(self.flag_list["thread_init"]):
-            reader = threading.Thread(target = self.thread_reader, 
-                                      args = (False, False, False))
-            reader.start()
+            self.data.module_name = self.module_name # Names the record from its first sample
+            self.reader = threading.Thread(target = self.thread_reader, 
+                                           args = (False, False, False))
+            self.reader.start()
             self.flag_list["thread_init"] = False
         # plot the graph in the main thread
         if(not self.temp_datum.flag_close_event):
@@ -266,9 +278,10 @@ class cart_pendulum():
                     self.reconnect(exp = True)
                 else:
                     if(self.flag_list["thread_init"]):
-                        reader = threading.Thread(target = self.thread_reader, 
-                                                args = (True, True, False))
-                        reader.start()
+                        self.data.module_name = self.module_name # Names the record from its first sample
+                        self.reader = threading.Thread(target = self.thread_reader, 
+                                                     args = (True, True, False))
+                        self.reader.start()
                         self.flag_list["thread_init"] = False
                         
                     if(not self.temp_datum.flag_close_event):
@@ -337,11 +350,12 @@ class cart_pendulum():
                     self.reconnect(exp=True)
                 else:
                     if self.flag_list["thread_init"]:
-                        reader = threading.Thread(
+                        self.data.module_name = self.module_name # Names the record from its first sample
+                        self.reader = threading.Thread(
                             target=self.thread_reader,
                             args=(True, True, False)
                         )
-                        reader.start()
+                        self.reader.start()
                         self.flag_list["thread_init"] = False
 
                     if not self.temp_datum.flag_close_event:
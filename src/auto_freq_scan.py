@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib as mpl, matplotlib.pyplot as plt
 import time, os, threading, csv
 from datetime import datetime
 # import modules from other python files
@@ -7,11 +6,7 @@ from data_process import data, live_data
 from arduino_manager import arduino
 from moment_data_process import data_frame
 from Pendulum_Control_Console import cart_pendulum
-plt.rcParams['axes.grid'] = True
-plt.rcParams["figure.autolayout"] = True
-prop_cycle = plt.rcParams['axes.prop_cycle']
-colors = prop_cycle.by_key()['color']
-mpl.use('TkAgg')
+# matplotlib is set up by data_process, not imported at all in headless mode
 # Initialisation of some constants and variables
 port = 'COM6' 
 baudrate = 230400
@@ -1,21 +1,19 @@
 import numpy as np
-import matplotlib as mpl, matplotlib.pyplot as plt
 import time, os, threading
 # import modules from other python files
 from data_process import data, live_data
 from arduino_manager import arduino
 from moment_data_process import data_frame
+from fall_detector import fall_detector
 
-plt.rcParams['axes.grid'] = True
-plt.rcParams["figure.autolayout"] = True
-prop_cycle = plt.rcParams['axes.prop_cycle']
-colors = prop_cycle.by_key()['color']
-mpl.use('TkAgg')
+# matplotlib is set up by data_process, not imported at all in headless mode
 
 # Initialisation of some constants and variables
 port = 'COM4'
 baudrate = 230400
 TRIAL_DURATION_SECONDS = 45 # NEW: Set the maximum duration for a single PID trial
+READER_TIMEOUT = 2 # Time (s) waited for the reader thread to stop at the end of a trial
+EARLY_STOP = True # End a trial as soon as the pendulum cannot recover (see fall_detector.py)
 
 # Define a list of PID parameter sets for automated testing
 PID_PARAM_SETS = [
@@ -141,6 +139,8 @@ class cart_pendulum():
         self.data = data
         self.temp_datum = temp_data
         self.df = data_frame
+        self.detector = fall_detector()
+        self.reader = None # Thread reading the arduino during a trial, see thread_reader
         self.module_name = r"\Defaut_Cart_Pendulum"
         self.center_count = 0
         self.distance = 0
@@ -166,13 +166,26 @@ class cart_pendulum():
         for flag in self.init_false_flag_list: self.flag_list[flag] = False
         if swing_request: self.flag_list["swing_request"] = False
 
+    def stop_reader(self):
+        '''Stops the reader thread and waits for it, so that the run is exported
+        (and its record closed) with all the samples it read'''
+        if self.reader is None:
+            return
+        self.temp_datum.flag_close_event = True
+        self.reader.join(READER_TIMEOUT)
+        if self.reader.is_alive():
+            print("The reader thread did not stop, the last samples may be missing.")
+        self.reader = None
+        self.temp_datum.copy(self.data)
+
     def reconnect(self, exp=False, send_terminate=False):
         '''MODIFIED: This function now only handles closing the connection and saving data.'''
+        self.stop_reader()
         if send_terminate:
             time.sleep(0.1)
             self.arduino.send_message("Terminate\n")
         try:
-            plt.close("all")
+            self.temp_datum.close_figure()
             if self.arduino.board and self.arduino.board.is_open:
                 self.arduino.read_single()
                 self.arduino.clear()
@@ -180,7 +193,8 @@ class cart_pendulum():
                 print("Arduino connection closed.")
             
             if exp:
-                self.temp_datum.export_csv(self.module_name, input_spec_info=True)
+                # Exported in the background, the next trial does not wait for the disk
+                self.temp_datum.export_csv(self.module_name, input_spec_info=False, background=True)
         except KeyboardInterrupt:
             if self.arduino.board and self.arduino.board.is_open: self.arduino.board.close()
             print("KeyboardInterrupt during reconnect. Exiting.")
@@ -202,6 +216,7 @@ class cart_pendulum():
         self.NR_counter = 0
         self.thread_counter = 0
         self._pid_trial_start_time = 0 # NEW: Reset trial timer
+        self.detector.reset()
 
     def thread_reader(self, appendPos=False, appendVel=False):
         while not self.temp_datum.flag_close_event:
@@ -213,6 +228,13 @@ class cart_pendulum():
             try:
                 self.df.update_data(self.arduino.receive.rstrip().split(','), appendPos=appendPos, appendVel=appendVel)
                 self.data.append_data(self.df, appendPos=appendPos, appendVel=appendVel)
+                if EARLY_STOP and self.flag_list["pid"] and self.detector.update(
+                        self.df.time, self.df.angle, self.df.position, self.df.position_velocity):
+                    # Recorded with the run, the trial is exported up to this sample
+                    self.data.end_reason = self.temp_datum.end_reason = self.detector.reason
+                    self.temp_datum.flag_close_event = True
+                    print(f"EARLY STOP: Trial ended ({self.detector.reason}) at {self.df.time - self.data.start_time:.2f} s. Terminating.")
+                    break
             except (ValueError, IndexError):
                 self.arduino.board.reset_input_buffer()
                 pass
@@ -279,8 +301,9 @@ class cart_pendulum():
                 self.temp_datum.flag_close_event = True
 
             if self.flag_list["thread_init"]:
-                reader = threading.Thread(target=self.thread_reader, args=(True, True))
-                reader.start()
+                self.data.module_name = self.module_name # Names the record from its first sample
+                self.reader = threading.Thread(target=self.thread_reader, args=(True, True))
+                self.reader.start()
                 self.flag_list["thread_init"] = False
 
             if not self.temp_datum.flag_close_event:
@@ -0,0 +1,213 @@
+'''Local browser dashboard of the live data, an alternative to the TkAgg window
+for the remote monitoring of long runs (e.g. twoauto.py sweeps in headless
+mode). A small HTTP server in the acquisition process serves dashboard.html
+and streams the decimated telemetry, spectra, phase and amplitude series to
+the browsers through a WebSocket, as binary frames which are drawn client-side.
+Only the standard library is used and the page loads nothing from the internet.
+
+Enabled with the --dashboard argument or CARTER_DASHBOARD=1, the page is then at
+http://localhost:8050 (CARTER_DASHBOARD_PORT to change the port). Set
+CARTER_DASHBOARD_HOST=0.0.0.0 to let other computers of the lab network watch.
+
+Frame format (little endian): uint32 length of a json header, the json header
+(title, module name and the list of series with their panel and number of
+points), padding to a multiple of 4 bytes, then for each series its float32
+x values followed by its float32 y values.'''
+import numpy as np
+import base64, hashlib, json, os, socket, struct, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from decimate import minmax_decimate
+
+DASHBOARD_HOST = os.environ.get('CARTER_DASHBOARD_HOST', '127.0.0.1')
+DASHBOARD_PORT = int(os.environ.get('CARTER_DASHBOARD_PORT', '8050'))
+DASHBOARD_RATE = 10 # Frames sent to the browsers per second
+DASHBOARD_WINDOW = 1024 # Number of the last samples shown in the time series
+DASHBOARD_COLUMNS = 400 # Decimation of the time series, see decimate.py
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # From the WebSocket RFC 6455
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dashboard.html')
+
+_server = None
+
+def start_dashboard(host = DASHBOARD_HOST, port = DASHBOARD_PORT):
+    '''Starts the dashboard server once per process and returns it'''
+    global _server
+    if(_server is None):
+        _server = dashboard_server(host, port)
+        _server.start()
+    return _server
+
+def ws_frame(payload, opcode = 0x2):
+    '''Encodes an unmasked WebSocket frame, binary by default'''
+    length = len(payload)
+    if(length < 126):
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif(length < 1 << 16):
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+def encode_frame(title, module_name, series):
+    '''series is a list of (name, panel, x, y), returns the binary frame'''
+    header = {'title': title, 'module': module_name, 'time': time.time(), 'series': []}
+    blocks = []
+    for name, panel, x, y in series:
+        x = np.asarray(x, dtype = np.float32)
+        y = np.asarray(y, dtype = np.float32)
+        header['series'].append({'name': name, 'panel': panel, 'n': len(x)})
+        blocks.append(x.tobytes())
+        blocks.append(y.tobytes())
+    raw = json.dumps(header).encode()
+    raw += b' ' * (-(len(raw) + 4) % 4)
+    return struct.pack('<I', len(raw)) + raw + b''.join(blocks)
+
+class dashboard_handler(BaseHTTPRequestHandler):
+
+    '''Serves the page on / and the stream of frames on /ws'''
+
+    protocol_version = 'HTTP/1.1' # Required by the browsers for the WebSocket upgrade
+
+    def do_GET(self):
+        if(self.path == '/ws'):
+            self.stream()
+        elif(self.path in ('/', '/index.html')):
+            with open(PAGE, 'rb') as file:
+                page = file.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if(key is None or self.headers.get('Upgrade', '').lower() != 'websocket'):
+            self.send_error(400)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        server = self.server.dashboard
+        seq = 0
+        try:
+            while(server.running):
+                frame, seq = server.wait_frame(seq)
+                if(frame is None):
+                    continue
+                self.wfile.write(ws_frame(frame))
+                self.wfile.flush()
+        except (ConnectionError, socket.timeout, OSError):
+            # Browser tab closed
+            pass
+
+    def log_message(self, format, *args):
+        '''Keep the console of the acquisition clean'''
+        pass
+
+class dashboard_server():
+
+    '''Runs the HTTP server in a daemon thread. The acquisition only calls
+    publish(), which encodes a frame at most DASHBOARD_RATE times per second
+    and never waits for the browsers: each of them is served by its own
+    thread, which sends the latest frame and skips the ones it missed.'''
+
+    def __init__(self, host = DASHBOARD_HOST, port = DASHBOARD_PORT, rate = DASHBOARD_RATE):
+        self.host = host
+        self.port = port
+        self.period = 1. / rate
+        self.last_publish = 0.
+        self.frame = None
+        self.seq = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.httpd = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), dashboard_handler)
+        self.httpd.daemon_threads = True
+        self.httpd.dashboard = self
+        self.running = True
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+        print("Dashboard at http://" + ('localhost' if self.host in ('127.0.0.1', '0.0.0.0') else self.host) \
+            + ':' + str(self.port))
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if(self.httpd is not None):
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def wait_frame(self, seq, timeout = 1.):
+        '''Waits for a frame newer than seq, returns (frame, its seq)'''
+        with self.condition:
+            if(self.seq == seq):
+                self.condition.wait(timeout)
+            if(self.seq == seq):
+                return None, seq
+            return self.frame, self.seq
+
+    def publish(self, data, force = False):
+        '''Encodes the current state of a live_data object into a frame'''
+        now = time.perf_counter()
+        if(not force and now - self.last_publish < self.period):
+            return
+        self.last_publish = now
+        frame = encode_frame(self.title(data), data.module_name, self.series(data))
+        with self.condition:
+            self.frame = frame
+            self.seq += 1
+            self.condition.notify_all()
+
+    def title(self, data):
+        if(data.module_name == 'pid'):
+            return 'PID parameters(' + str(getattr(data, 'pid_param', '')) + ')'
+        if(data.module_name == 'setSpeed' and data.setSpeed_param is not None):
+            return data.setSpeed_param
+        if(data.module_name in ('freq_scan', 'auto_freq_scan', 'NR')):
+            if(data.omega_list is None):
+                return data.module_name + ' Driven Freq: ' + str(data.omega) + 'Hz'
+            return data.module_name + ' Driven Freq: ' + ', '.join("%.3f" % i for i in data.omega_list) + 'Hz'
+        return data.module_name
+
+    def series(self, data):
+        '''The series shown by the dashboard for the module of data'''
+        module_name = data.module_name
+        series = []
+        if(data.index == 0):
+            return series
+        high_ind = data.temp_index + data.buffer_length + 1
+        low_ind = high_ind - min(data.index, DASHBOARD_WINDOW, data.buffer_length)
+        window = slice(low_ind, high_ind)
+        time_window = data.time[window]
+        def trace(name, panel, values):
+            series.append((name, panel, *minmax_decimate(time_window, values[window], DASHBOARD_COLUMNS)))
+        trace('angle', 'Angle/rad', data.angle)
+        if(module_name != 'measure'):
+            trace('position', 'Position/steps', data.position)
+        if(module_name in ('pid', 'setSpeed')):
+            if(module_name == 'pid'):
+                trace('angular velocity', 'Velocity', data.angular_velocity)
+            trace('cart velocity', 'Velocity', data.position_velocity)
+        else:
+            series.append(('fft angle', 'Spectrum', data.fft_freq, np.abs(data.fft_angle)))
+            if(module_name != 'measure'):
+                series.append(('fft position', 'Spectrum', data.fft_freq, np.abs(data.fft_pos)))
+        if(module_name in ('freq_scan', 'auto_freq_scan', 'NR')):
+            if(data.phase_list is not None):
+                series.append(('phase/pi', 'Phase', *zip(*data.phase_list)))
+            else:
+                for omega, phase_list in zip(data.omega_list, data.multi_phase_list):
+                    series.append(('%.3f Hz' % omega, 'Phase', *zip(*phase_list)))
+            if(data.phase_list_active is not None):
+                series.append(('phase_active/pi', 'Phase', *zip(*data.phase_list_active)))
+            series.append(('amplitude', 'Amplitude', *zip(*data.amp_list)))
+        return series
@@ -1,79 +1,270 @@
 import pandas as pd
 import numpy as np
 import os
-import glob
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from run_format import is_run, load_run
+from run_archive import read_csv_table, parse_metadata, unroll
+from run_catalog import CATALOG_PATH, build_catalog, top_runs
+from fall_detector import FALL_ANGLE, POSITION_LIMIT, END_REASONS, detect
+
+PROGRESS_STEP = 20 # Files between two progress reports of score_files
+BATCH_RUNS = 32 # Maximum number of runs scored together by batch_kpis in score_files
+KPI_VERSION = 5 # Version of the KPIs, increase it when they change so that the cached KPIs are computed again
+KPI_NAMES = ('iae_angle', 'iae_position', 'max_angle_deviation', 'max_position_overshoot', 'control_effort_proxy',
+             'ise_angle', 'itae_angle', 'settling_time', 'time_to_fall', 'rms_control_velocity')
+KPI_SIGNALS = ('time', 'angle', 'position', 'angular_velocity', 'cart_velocity') # Columns read by batch_kpis
+SETTLING_BAND = 0.05 # Angle (rad) within which the pendulum is settled
+FAILURE_PENALTY = 1e6 # Score added to the runs which ended early in an unrecoverable state, the completed runs score well below it
+TRIAL_DURATION = 45 # Duration (s) of the PID trials (TRIAL_DURATION_SECONDS of auto_pid.py), over which the failed runs are scored
+END_TOLERANCE = 1.0 # Time (s) before the end of the trial from which an unrecoverable state no longer counts as ending it early
+# Weights of the KPIs in the fitness score, by scoring profile. The runs can be
+# ranked again with any profile without being parsed (see fitness_scores).
+SCORING_PROFILES = {
+    'default': {'iae_angle': 2.0, 'iae_position': 0.5, 'max_angle_deviation': 3.0,
+                'max_position_overshoot': 0.2, 'control_effort_proxy': 0.1},
+    'angle': {'iae_angle': 5.0, 'iae_position': 0.1, 'max_angle_deviation': 10.0,
+              'max_position_overshoot': 0.05, 'control_effort_proxy': 0.1},
+    'position': {'iae_angle': 0.5, 'iae_position': 2.0, 'max_angle_deviation': 1.0,
+                 'max_position_overshoot': 1.0, 'control_effort_proxy': 0.1},
+    'smooth': {'iae_angle': 2.0, 'iae_position': 0.5, 'max_angle_deviation': 3.0,
+               'max_position_overshoot': 0.2, 'control_effort_proxy': 1.0},
+    # The longer the pendulum stays up the better, hence the negative weight
+    'settling': {'itae_angle': 1.0, 'settling_time': 10.0, 'time_to_fall': -10.0,
+                 'rms_control_velocity': 0.01},
+    }
 
 def parse_and_load_data(file_path):
     """
     Parses the unique CSV file structure to extract metadata (PID params)
-    and load the time-series data into a pandas DataFrame.
+    and load the time-series data into a pandas DataFrame. Binary run files
+    (see run_format.py) are read directly, with memory mapping. Only the
+    recorded samples are loaded, in chronological order.
 
     Args:
-        file_path (str): The path to the CSV file.
+        file_path (str): The path to the CSV or binary run file.
 
     Returns:
         tuple: A tuple containing:
             - dict: A dictionary of the extracted metadata (PID parameters, etc.).
             - pd.DataFrame: A DataFrame with the time-series data.
     """
-    metadata = {}
-    header_row_index = -1
-
+    if is_run(file_path):
+        try:
+            run = load_run(file_path)
+        except Exception as e:
+            print(f"Could not read file {file_path}: {e}")
+            return None, None
+        data = run.data()
+        if 'time' not in data:
+            return run.metadata, pd.DataFrame(data)
+        # The archives of older exports may still hold the raw circular buffer
+        columns = list(data)
+        return run.metadata, pd.DataFrame(unroll(np.column_stack([data[name] for name in columns])),
+                                          columns=columns)
+
+    # The file is read once: the metadata lines are parsed and the rows go
+    # to numpy's parser as float64, without the padding and the mirrored half
+    # of the circular buffer of the older exports
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except Exception as e:
+        lines, columns, data = read_csv_table(file_path)
+    except (OSError, UnicodeDecodeError) as e:
         print(f"Could not read file {file_path}: {e}")
         return None, None
-
-
-    # First pass: Extract metadata and find the data header
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
-
-        parts = line.split(',')
-
-        if parts[0] == 'Kp' and parts[1] == 'Ki':
-            # This is the PID parameter header line, the next line has the values
-            param_names = parts
-            # Handle cases where the next line might be out of bounds
-            if i + 1 < len(lines):
-                param_values = lines[i+1].strip().split(',')
-                if len(param_names) == len(param_values):
-                    for name, value in zip(param_names, param_values):
-                        try:
-                            metadata[name] = float(value)
-                        except ValueError:
-                            # Handle cases where a value might not be a float
-                            metadata[name] = value
-        elif parts[0] == 'time' and parts[1] == 'angle':
-            # This is the header for the main data
-            header_row_index = i
-            break # Stop after finding the data header
-        elif len(parts) == 2:
-            # For key-value pairs like 'start_time,889.405'
-            try:
-                metadata[parts[0]] = float(parts[1])
-            except ValueError:
-                metadata[parts[0]] = parts[1]
-
-    if header_row_index == -1:
+    except ValueError:
         # Silently skip files that don't match the expected format
         return None, None
 
-    # Second pass: Load the data using pandas, skipping the metadata rows
-    try:
-        df = pd.read_csv(file_path, skiprows=header_row_index)
-    except Exception as e:
-        print(f"Pandas could not parse {file_path} after header: {e}")
+    if columns[:2] != ['time', 'angle']:
         return None, None
 
+    metadata = parse_metadata(lines)
+    df = pd.DataFrame(unroll(data), columns=columns)
 
     return metadata, df
 
-def calculate_fitness_score(df, metadata):
+def profile_weights(profile='default'):
+    """
+    Returns the weight vector of a scoring profile, in the order of KPI_NAMES.
+
+    Args:
+        profile: The name of a profile of SCORING_PROFILES, a dictionary of
+            weights by KPI name (missing KPIs weigh 0) or a sequence of weights.
+
+    Returns:
+        np.ndarray: The weights.
+    """
+    if isinstance(profile, str):
+        if profile not in SCORING_PROFILES:
+            raise ValueError(f"Unknown scoring profile '{profile}', expected one of {list(SCORING_PROFILES)}")
+        profile = SCORING_PROFILES[profile]
+    if isinstance(profile, dict):
+        unknown = set(profile) - set(KPI_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown KPIs in the weights: {sorted(unknown)}")
+        return np.array([profile.get(name, 0.0) for name in KPI_NAMES], dtype=float)
+    weights = np.asarray(profile, dtype=float)
+    if weights.shape != (len(KPI_NAMES),):
+        raise ValueError(f"Expected {len(KPI_NAMES)} weights, one per KPI of {KPI_NAMES}")
+    return weights
+
+def fitness_scores(kpis, profile='default', failed=None):
+    """
+    Computes the fitness scores of many runs at once, as the weighted sum of
+    their KPIs. A lower score indicates better performance. The runs which
+    ended early in an unrecoverable state get FAILURE_PENALTY on top, so
+    that they rank after the completed runs whatever the profile.
+
+    Args:
+        kpis: A DataFrame with the KPI_NAMES columns (e.g. the rows of the run
+            catalog), or an array with one row of KPIs per run.
+        profile: The scoring profile or the weights, see profile_weights.
+        failed: Whether each run ended early in an unrecoverable state,
+            taken from the end_reason column of a DataFrame if None.
+
+    Returns:
+        np.ndarray: The fitness score of each run.
+    """
+    weights = profile_weights(profile)
+    if isinstance(kpis, pd.DataFrame):
+        if failed is None and 'end_reason' in kpis:
+            failed = kpis['end_reason'].notna().to_numpy()
+        # Only the weighted KPIs are read, older results may not have the others
+        used = weights != 0
+        scores = kpis[[name for name, use in zip(KPI_NAMES, used) if use]].to_numpy(dtype=float) @ weights[used]
+    else:
+        scores = np.asarray(kpis, dtype=float).reshape(-1, len(KPI_NAMES)) @ weights
+    if failed is not None:
+        scores = scores + FAILURE_PENALTY * np.asarray(failed, dtype=bool)
+    return scores
+
+def rank_runs(kpis, profiles=('default',)):
+    """
+    Scores the runs with several profiles side by side.
+
+    Args:
+        kpis (pd.DataFrame): The runs, with the KPI_NAMES columns.
+        profiles: The names of the profiles, or a dictionary of weights by
+            profile name.
+
+    Returns:
+        pd.DataFrame: A copy of kpis with a fitness_<profile> column per
+            profile, sorted by the first one.
+    """
+    if not isinstance(profiles, dict):
+        profiles = {name: name for name in profiles}
+    ranked = kpis.copy()
+    for name, profile in profiles.items():
+        ranked[f'fitness_{name}'] = fitness_scores(kpis, profile)
+    return ranked.sort_values(f'fitness_{next(iter(profiles))}')
+
+def pad_runs(runs, columns=KPI_SIGNALS):
+    """
+    Stacks runs of different lengths into padded 2D arrays, one row per run.
+
+    Args:
+        runs (list): The runs, DataFrames or dictionaries of columns.
+        columns (tuple): The columns to stack.
+
+    Returns:
+        tuple: A tuple containing:
+            - dict: A (runs, samples) array per column, padded with zeros.
+            - np.ndarray: The mask of the samples of each run.
+            - np.ndarray: The number of samples of each run.
+    """
+    lengths = np.array([len(run[columns[0]]) for run in runs], dtype=int)
+    mask = np.arange(lengths.max(initial=0)) < lengths[:, None]
+    arrays = {}
+    for name in columns:
+        arrays[name] = np.zeros(mask.shape)
+        # The masked elements are in row order, i.e. the samples of each run in turn
+        arrays[name][mask] = np.concatenate([np.asarray(run[name], dtype=float) for run in runs]) if runs else []
+    return arrays, mask, lengths
+
+def batch_kpis(runs):
+    """
+    Computes the KPIs of many runs at once on their padded arrays. The
+    integrals are weighted by the time steps (trapezoidal rule), so that the
+    runs recorded at different sample rates can be compared. A run which
+    reached an unrecoverable state (see fall_detector.py) is scored up to it,
+    and the rest of the trial, until TRIAL_DURATION, is charged as if the
+    angle and the position stayed at FALL_ANGLE and POSITION_LIMIT, so that
+    a trial does not score better by failing early. A run reaching it within
+    END_TOLERANCE of the end of the trial is charged the same way for the
+    time left, but it completed the trial: it has no end_reason, and so no
+    FAILURE_PENALTY in fitness_scores.
+
+    Args:
+        runs (list): The runs with at least 2 samples each, DataFrames or
+            dictionaries of the KPI_SIGNALS columns.
+
+    Returns:
+        dict: An array of the values of each run per KPI of KPI_NAMES, and
+            the reason why each run ended early (None if it completed the
+            trial) as 'end_reason'.
+    """
+    arrays, mask, lengths = pad_runs(runs)
+    rows = np.arange(len(runs))
+    end, reason = detect(arrays['time'], arrays['angle'], arrays['position'], arrays['cart_velocity'], mask)
+    lengths = np.where(end >= 0, np.minimum(np.maximum(end + 1, 2), lengths), lengths)
+    mask = np.arange(mask.shape[1]) < lengths[:, None]
+    time = arrays['time'] - arrays['time'][:, :1]
+    # Steps between two samples of a run, 0 in the padding
+    dt = np.clip(np.diff(time, axis=1), 0, None) * mask[:, 1:]
+    duration = time[rows, lengths - 1]
+
+    def integral(values):
+        return np.sum(0.5 * (values[:, 1:] + values[:, :-1]) * dt, axis=1)
+
+    # --- Key Performance Indicators (KPIs) ---
+    target_angle = 0.0
+    target_position = 0.0
+    angle_error = np.abs(arrays['angle'] - target_angle) * mask
+    position_error = np.abs(arrays['position'] - target_position) * mask
+
+    kpis = {
+        # 1. Integral of Absolute Error for Angle
+        'iae_angle': integral(angle_error),
+        # 2. Integral of Absolute Error for Position
+        'iae_position': integral(position_error),
+        # 3. Maximum Absolute Angle
+        'max_angle_deviation': angle_error.max(axis=1),
+        # 4. Maximum Absolute Position (Overshoot)
+        'max_position_overshoot': position_error.max(axis=1),
+        # 5. Control Effort Proxy (Integral of Squared Angular Velocity)
+        'control_effort_proxy': integral(np.square(arrays['angular_velocity'])),
+        # 6. Integral of Squared Error for Angle
+        'ise_angle': integral(np.square(angle_error)),
+        # 7. Integral of Time-weighted Absolute Error for Angle
+        'itae_angle': integral(time * angle_error),
+        }
+
+    # 8. Settling Time, from which the angle stays within SETTLING_BAND (the duration if never)
+    outside = angle_error > SETTLING_BAND
+    last_outside = mask.shape[1] - 1 - np.argmax(outside[:, ::-1], axis=1)
+    settled = np.minimum(last_outside + 1, lengths - 1)
+    kpis['settling_time'] = np.where(outside.any(axis=1), time[rows, settled], 0.0)
+
+    # 9. Time to Fall, of the first angle beyond FALL_ANGLE (the duration if never)
+    fallen = angle_error > FALL_ANGLE
+    kpis['time_to_fall'] = np.where(fallen.any(axis=1), time[rows, np.argmax(fallen, axis=1)], duration)
+
+    # 10. RMS Control Velocity, of the cart
+    kpis['rms_control_velocity'] = np.sqrt(integral(np.square(arrays['cart_velocity']))
+                                           / np.where(duration > 0, duration, 1.0))
+
+    # Penalty of the failed runs, the time left in the trial at the limits of the recoverable states
+    remaining = np.where(reason > 0, np.clip(TRIAL_DURATION - duration, 0, None), 0.0)
+    kpis['iae_angle'] += FALL_ANGLE * remaining
+    kpis['iae_position'] += POSITION_LIMIT * remaining
+    kpis['ise_angle'] += FALL_ANGLE ** 2 * remaining
+    kpis['itae_angle'] += FALL_ANGLE * remaining * (duration + 0.5 * remaining)
+    kpis['settling_time'] = np.where(reason > 0, duration + remaining, kpis['settling_time'])
+    early = np.where(remaining > END_TOLERANCE, reason, 0)
+    kpis['end_reason'] = np.array([END_REASONS[code] for code in early], dtype=object)
+    return kpis
+
+def calculate_fitness_score(df, metadata, profile='default'):
     """
     Calculates a fitness score based on the performance of the system.
     A lower score indicates better performance.
@@ -81,6 +272,7 @@ def calculate_fitness_score(df, metadata):
     Args:
         df (pd.DataFrame): The time-series data.
         metadata (dict): The extracted metadata.
+        profile: The scoring profile or the weights, see profile_weights.
 
     Returns:
         dict: A dictionary containing the individual performance metrics
@@ -94,51 +286,98 @@ def calculate_fitness_score(df, metadata):
         }
 
     # --- Key Performance Indicators (KPIs) ---
-    target_angle = 0.0
-    target_position = 0.0
+    results = {name: values[0] for name, values in batch_kpis([df]).items()}
 
-    # 1. Integral of Absolute Error for Angle
-    iae_angle = np.sum(np.abs(df['angle'] - target_angle))
+    # --- Final Fitness Score Calculation ---
+    results['fitness_score'] = fitness_scores([results[name] for name in KPI_NAMES], profile,
+                                              [results['end_reason'] is not None])[0]
 
-    # 2. Integral of Absolute Error for Position
-    iae_position = np.sum(np.abs(df['position'] - target_position))
+    return results
 
-    # 3. Maximum Absolute Angle
-    max_angle = np.max(np.abs(df['angle']))
+def score_chunk(file_paths):
+    """
+    Loads a chunk of run files and scores their PID runs together (see
+    batch_kpis). This is the task of the worker processes of score_files, so
+    it never raises.
 
-    # 4. Maximum Absolute Position (Overshoot)
-    max_position = np.max(np.abs(df['position']))
+    Args:
+        file_paths (list): The paths to the CSV or binary run files.
 
-    # 5. Control Effort Proxy (Integral of Squared Angular Velocity)
-    control_effort = np.sum(np.square(df['angular_velocity']))
+    Returns:
+        list: A tuple per file with the file path, the metadata (None if the
+            file could not be parsed), the results of calculate_fitness_score
+            (None if the run is not scored) and the error message (None if
+            there was none).
+    """
+    from run_catalog import path_parts
+    results, runs = [], []
+    for file_path in file_paths:
+        try:
+            metadata, df = parse_and_load_data(file_path)
+            if metadata is None or df is None:
+                results.append((file_path, None, None, 'Could not be parsed'))
+                continue
+            metadata.setdefault('sample_count', len(df))
+            metadata.setdefault('module', path_parts(file_path)[2])
+            results.append((file_path, metadata, None, None))
+            if metadata['module'] == 'pid' and len(df) >= 2:
+                runs.append((len(results) - 1, df))
+        except Exception as e:
+            results.append((file_path, None, None, f"{type(e).__name__}: {e}"))
+    if runs:
+        try:
+            kpis = batch_kpis([df for _, df in runs])
+            kpis['fitness_score'] = fitness_scores(np.column_stack([kpis[name] for name in KPI_NAMES]),
+                                                   failed=kpis['end_reason'] != None)
+            for j, (i, _) in enumerate(runs):
+                results[i] = results[i][:2] + ({name: values[j] for name, values in kpis.items()}, None)
+        except Exception as e:
+            for i, _ in runs:
+                results[i] = results[i][:2] + (None, f"{type(e).__name__}: {e}")
+    return results
 
-    # --- Final Fitness Score Calculation ---
-    weights = {
-        'w_iae_angle': 2.0,
-        'w_iae_position': 0.5,
-        'w_max_angle': 3.0,
-        'w_max_position': 0.2,
-        'w_control_effort': 0.1
-    }
+def score_file(file_path):
+    """Loads and scores a single run file, see score_chunk."""
+    return score_chunk([file_path])[0]
 
-    fitness_score = (
-        weights['w_iae_angle'] * iae_angle +
-        weights['w_iae_position'] * iae_position +
-        weights['w_max_angle'] * max_angle +
-        weights['w_max_position'] * max_position +
-        weights['w_control_effort'] * control_effort
-    )
-
-    results = {
-        'iae_angle': iae_angle,
-        'iae_position': iae_position,
-        'max_angle_deviation': max_angle,
-        'max_position_overshoot': max_position,
-        'control_effort_proxy': control_effort,
-        'fitness_score': fitness_score
-    }
+def score_files(file_paths, workers=None, chunksize=None):
+    """
+    Scores the files in a pool of processes, see score_chunk. The files are
+    submitted in chunks and the results come back in the order of file_paths,
+    with the progress and the errors printed along the way.
 
-    return results
+    Args:
+        file_paths (list): The paths of the files.
+        workers (int): The number of processes, one per CPU if None, and no
+            pool at all if 1.
+        chunksize (int): The number of files sent to a process at once, by
+            default the files are split into about 4 chunks per process, of
+            at most BATCH_RUNS files.
+
+    Yields:
+        tuple: The results of score_chunk for each file.
+    """
+    file_paths = list(file_paths)
+    total = len(file_paths)
+    workers = workers or os.cpu_count() or 1
+    chunksize = chunksize or min(BATCH_RUNS, max(1, total // (4 * workers)))
+    chunks = [file_paths[i:i + chunksize] for i in range(0, total, chunksize)]
+    if workers == 1 or len(chunks) < 2:
+        executor = None
+        results = chain.from_iterable(map(score_chunk, chunks))
+    else:
+        executor = ProcessPoolExecutor(workers)
+        results = chain.from_iterable(executor.map(score_chunk, chunks))
+    try:
+        for n, result in enumerate(results, 1):
+            if result[3] is not None:
+                print(f"Error in {result[0]}: {result[3]}")
+            if n % PROGRESS_STEP == 0 or n == total:
+                print(f"Scored {n}/{total} files")
+            yield result
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 def main():
     """
@@ -148,20 +387,20 @@ def main():
     # --- Configuration ---
     # IMPORTANT: Change this to the root directory containing your data folders.
     base_directory = '.' # Use '.' for current directory or provide a full path.
+    workers = None # Processes scoring the files, None for one per CPU.
+    rescore = False # Set to True to score all the files again, otherwise increase KPI_VERSION after a change of the KPIs.
+    profiles = list(SCORING_PROFILES) # Profiles of the fitness_<profile> columns of the results, the first one ranks them.
 
-    # This pattern will recursively find all .csv files inside folders matching the structure.
-    # It starts in base_directory, looks for cart_pendulum_data_*, then pid_set_*,
-    # and then searches all subdirectories (**) for any .csv file.
-    search_pattern = os.path.join(base_directory, 'cart_pendulum_data_*', 'pid_set_*', '**', '*.csv')
-
+    # The runs are found in the cart_pendulum_data_* folders and their parameters and KPIs
+    # are kept in the run catalog (see run_catalog.py), only new or modified files are parsed.
     print(f"Searching for files in: {os.path.abspath(base_directory)}")
-    print(f"Using search pattern: {search_pattern}\n")
+    print(f"Using the run catalog: {os.path.abspath(CATALOG_PATH)}\n")
 
-    # Find all files matching the pattern
-    csv_files = glob.glob(search_pattern, recursive=True)
+    added = build_catalog(base_directory, workers=workers, rescore=rescore)
+    results_df = top_runs()
 
-    if not csv_files:
-        print("No CSV files found matching the pattern. Please check your `base_directory` and folder structure.")
+    if results_df.empty:
+        print("No PID runs found. Please check your `base_directory` and folder structure.")
         # Create some dummy files and folders for demonstration if none are found.
         print("Creating a dummy directory structure for demonstration...")
         os.makedirs("cart_pendulum_data_9/pid_set_1/23-07-csv", exist_ok=True)
@@ -176,42 +415,20 @@ time,angle,position,angular_velocity,cart_velocity
 0.20,-0.0077,19.0,-0.5371,461.3785
 0.25,0.0092,-1.0,0.8142,-152.6042
 """)
-        csv_files = glob.glob(search_pattern, recursive=True)
-
-
-    all_results = []
-    print(f"Found {len(csv_files)} files to analyze. Processing...")
-
-    # --- Analysis Loop ---
-    for file_path in csv_files:
-        metadata, df = parse_and_load_data(file_path)
+        added += build_catalog(base_directory, workers=workers)
+        results_df = top_runs()
 
-        # Skip if the file couldn't be parsed correctly
-        if metadata is None or df is None:
-            continue
-
-        analysis_results = calculate_fitness_score(df, metadata)
-
-        # Combine metadata and analysis results into one record
-        record = {
-            'file_path': file_path,
-            **metadata,
-            **analysis_results
-        }
-        all_results.append(record)
+    print(f"{added} new or modified files analyzed, {len(results_df)} PID runs in the catalog.")
 
     print("\nAnalysis complete.")
 
     # --- Summarize and Save Results ---
-    if not all_results:
+    if results_df.empty:
         print("Could not process any files.")
         return
 
-    # Convert the list of dictionaries to a pandas DataFrame
-    results_df = pd.DataFrame(all_results)
-
-    # Sort the DataFrame by fitness score to find the best parameters
-    results_df = results_df.sort_values(by='fitness_score', ascending=True)
+    # The metadata column of the catalog is the raw json, the runs are ranked by the first profile
+    results_df = rank_runs(results_df.drop(columns=['metadata']), profiles)
 
     # Define the output file name
     output_csv_path = 'pid_analysis_results.csv'
@@ -1,21 +1,67 @@
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import time, os, csv
+import time, os, sys, csv, copy
 from datetime import datetime
-from scipy.fft import fft, fftfreq
-from scipy.optimize import curve_fit
-plt.rcParams['axes.grid'] = True
-plt.rcParams["figure.autolayout"] = True
-prop_cycle = plt.rcParams['axes.prop_cycle']
-colors = prop_cycle.by_key()['color']
-mpl.use('TkAgg')
+from live_plot import blit_renderer, render_scheduler
+from decimate import decimate, axes_columns
+# scipy, matplotlib and the optional live outputs are imported on first use,
+# which keeps the restart of the scripts fast (see startup_benchmark.py)
 
 # Initialisation of some constants and variables
 port = 'COM6' 
 baudrate = 230400 
-MAX_COUNT = 10 # Number of points waited to plot a frame
-ANGLE_ROTATION = 55 # Rotation of the y-label
+# Headless mode for unattended runs, e.g. on a lab server without display:
+# no GUI backend is imported and no live plot is drawn. Enabled with the
+# --headless argument or CARTER_HEADLESS=1, the PDF snapshot of each run is
+# then only rendered offline with --snapshot or CARTER_SNAPSHOT=1
+# Browser dashboard of dashboard.py, which replaces the live plot window,
+# enabled with the --dashboard argument or CARTER_DASHBOARD=1
+DASHBOARD = '--dashboard' in sys.argv or os.environ.get('CARTER_DASHBOARD', '0') == '1'
+# Publish the live data into shared memory for the viewers of live_viewer.py,
+# enabled with the --shm argument or CARTER_SHM=1. The viewers draw the live
+# plot, so the acquisition process is then headless as with the dashboard
+SHARED_MEMORY = '--shm' in sys.argv or os.environ.get('CARTER_SHM', '0') == '1'
+HEADLESS = '--headless' in sys.argv or os.environ.get('CARTER_HEADLESS', '0') == '1' or DASHBOARD or SHARED_MEMORY
+SNAPSHOT = '--snapshot' in sys.argv or os.environ.get('CARTER_SNAPSHOT', '0') == '1'
+HEADLESS_PERIOD = 0.05 # Period of the main loop in headless mode in seconds
+BACKEND = 'TkAgg' # Backend of the live plot window
+SAVE_DPI = 600 # Resolution of the saved figures, to which their traces are decimated
+# Format of the exported runs: 'csv', 'npz' (binary run file, see run_format.py),
+# 'both' or 'record' (written while the samples arrive, see run_recorder.py),
+# set with CARTER_EXPORT_FORMAT. CARTER_EXPORT_COMPRESS=1 compresses
+# the binary files, which then cannot be memory mapped by the readers
+EXPORT_FORMAT = os.environ.get('CARTER_EXPORT_FORMAT', 'csv')
+EXPORT_COMPRESS = os.environ.get('CARTER_EXPORT_COMPRESS', '0') == '1'
+mpl = plt = colors = None
+
+def import_matplotlib():
+    '''Imports matplotlib without pyplot, enough for the figures rendered
+    offline (see data.subplots)'''
+    global mpl, colors
+    if(mpl is not None):
+        return
+    import matplotlib
+    mpl = matplotlib
+    mpl.rcParams['axes.grid'] = True
+    mpl.rcParams["figure.autolayout"] = True
+    prop_cycle = mpl.rcParams['axes.prop_cycle']
+    colors = prop_cycle.by_key()['color']
+
+def import_pyplot(backend = BACKEND):
+    '''Imports matplotlib with the given backend, only done once when the
+    first figure is created'''
+    global plt
+    if(plt is not None):
+        return
+    import_matplotlib()
+    mpl.use(backend)
+    import matplotlib.pyplot
+    plt = matplotlib.pyplot
+
+def format_rows(block):
+    '''Formats a 2D array as csv rows in a single call, with the same float
+    representation as csv.writer'''
+    n_rows, n_cols = block.shape
+    return ((','.join(['%r'] * n_cols) + '\r\n') * n_rows) % tuple(block.ravel().tolist())
 
 class data_phy():
     '''Put all the physics in this class so that people can look at it'''
@@ -58,6 +104,13 @@ class data_phy():
         self.flag_fig_init = True
         self.flag_subplot_init = True
         self.flag_close_event = False
+        self.renderer = None
+        self.scheduler = render_scheduler()
+        self.offline = False # True while a snapshot is rendered in headless mode
+        self.publisher = None # shm_publisher of the live data, see live_data
+        self.dashboard = None # dashboard_server of the live data, see live_data
+        self.recorder = None # run_recorder of the current run, see append_data
+        self.end_reason = None # Why the run was ended early, see fall_detector.py
         self.module_name = ""
         self.path = ""
         self.omega_num = 0
@@ -104,6 +157,7 @@ class data_phy():
             index_list, avg_spacing = self.fft_index_list()
             self.avg_spacing = avg_spacing
             
+            from scipy.fft import fft, fftfreq
             fft_ang = fft(self.angle[index_list])
             fft_pos = fft(self.position[index_list])
             if(self.pos_const is not None):
@@ -274,6 +328,7 @@ class data_phy():
     
     def delay_fit(self, low, high):
         '''Find the delay time between the two waves in the freq_scan module'''
+        from scipy.optimize import curve_fit
         delay_time = 0.
         
         def delay_func(time, delay):
@@ -315,6 +370,11 @@ class data(data_phy):
         if(self.index == 0):
             self.start_time = data_frame.time
             self.sys_start_time = time.time()
+            if(EXPORT_FORMAT == 'record'):
+                from run_recorder import start_recorder
+                if(self.recorder is not None):
+                    self.recorder.close(self)
+                self.recorder = start_recorder(self)
         temp_index = self.index % self.buffer_length
         self.time[temp_index] = data_frame.time - self.start_time
         self.time[temp_index + self.buffer_length] = data_frame.time - self.start_time
@@ -330,9 +390,16 @@ class data(data_phy):
             self.position_velocity[temp_index + self.buffer_length] = data_frame.position_velocity
         self.index += 1
         self.temp_index = temp_index
+        if(self.recorder is not None):
+            self.recorder.update(self)
     
     def clear_data(self):
         '''Clears the data in the circular buffer, standard routine'''
+        if(self.recorder is not None):
+            # Run which was not exported
+            self.recorder.close(self)
+            self.recorder = None
+        self.end_reason = None
         self.time = np.zeros(2 * self.buffer_length)
         self.angle = np.zeros(2 * self.buffer_length)
         self.angular_velocity = np.zeros(2 * self.buffer_length)
@@ -359,9 +426,24 @@ class data(data_phy):
         self.setSpeed_param = None
         self.phase_list_active = None
         
+    def close_figure(self):
+        '''Closes the live figure, which saves it. In headless mode the snapshot
+        is rendered offline instead, if requested'''
+        if(self.publisher is not None):
+            # Ends the run for the viewers
+            self.publisher.close()
+        if(not HEADLESS):
+            if(plt is not None):
+                plt.close("all")
+        elif(SNAPSHOT and not self.flag_fig_init and self.index > 0):
+            from export_writer import get_writer
+            get_writer().submit(self.snapshot().save_snapshot)
+            self.flag_fig_init = True
+    
     def clear_figure(self):
         '''Clears the figure, standard routine'''
-        plt.close("all")
+        self.close_figure()
+        self.renderer = None
         self.flag_fig_init = True
         self.flag_subplot_init = True
         self.flag_close_event = False
@@ -370,10 +452,16 @@ class data(data_phy):
         '''Initialises the plot in terms of different stages'''
         if(self.flag_fig_init):
             self.flag_fig_init = False
-            plt.ion() # Turn on interactive mode, important for the non-blocking plot
+            if(HEADLESS and not self.offline):
+                return
+            if(self.offline):
+                import_matplotlib()
+            else:
+                import_pyplot()
+                plt.ion() # Turn on interactive mode, important for the non-blocking plot
             if(module_name == "measure"):
                 if(self.flag_subplot_init):
-                    self.figure, self.ax_list = plt.subplots(1, 2, figsize = (8, 5))
+                    self.figure, self.ax_list = self.subplots(1, 2, figsize = (8, 5))
                     self.figure.suptitle('Measure')
                     self.flag_subplot_init = False
                 self.line_angle, = self.ax_list[0].plot([], [], 'b-')
@@ -391,7 +479,7 @@ class data(data_phy):
                 
             elif(module_name == "NR"):
                 if(self.flag_subplot_init):
-                    self.figure, self.ax_list = plt.subplots(2, 2, figsize=(8, 5))
+                    self.figure, self.ax_list = self.subplots(2, 2, figsize=(8, 5))
                     self.flag_subplot_init = False
                     self.figure.suptitle('NR')
                     if(self.omega_list is None):
@@ -466,7 +554,7 @@ class data(data_phy):
             
             elif(module_name == "freq_scan" or module_name == "auto_freq_scan"):
                 if(self.flag_subplot_init):
-                    self.figure, self.ax_list = plt.subplots(2, 2, figsize=(8, 5))
+                    self.figure, self.ax_list = self.subplots(2, 2, figsize=(8, 5))
                     self.flag_subplot_init = False
                     self.figure.suptitle('NR')
                     if(self.omega_list is None):
@@ -541,7 +629,7 @@ class data(data_phy):
             
             elif(module_name == "pid"):
                 if(self.flag_subplot_init):
-                    self.figure, self.ax_list = plt.subplots(2, 2, figsize=(8, 5))
+                    self.figure, self.ax_list = self.subplots(2, 2, figsize=(8, 5))
                     self.figure.suptitle('PID')
                     self.flag_subplot_init = False
                 self.line_angle, = self.ax_list[0, 0].plot([], [], 'b-')
@@ -566,7 +654,7 @@ class data(data_phy):
                 
             elif(module_name == "setSpeed"):
                 if(self.flag_subplot_init):
-                    self.figure, self.ax_list = plt.subplots(1, 2, figsize=(8, 5))
+                    self.figure, self.ax_list = self.subplots(1, 2, figsize=(8, 5))
                     self.figure.suptitle('setSpeed')
                     self.flag_subplot_init = False
                 self.line_pos, = self.ax_list[0].plot([], [], 'r-')
@@ -581,6 +669,25 @@ class data(data_phy):
                 self.ax_list[1].set_xlabel('Time/s')
                 self.ax_list[1].set_ylabel('Cart Velocity/(steps/s)')
                 
+            # Texts updated every frame together with the lines
+            self.txt_rate = None
+            self.txt_res = None
+            if(module_name == "measure"):
+                txt_ax = self.ax_list[1]
+            elif(module_name in ("NR", "freq_scan", "auto_freq_scan", "pid")):
+                txt_ax = self.ax_list[0, 1]
+            if(module_name == "pid"):
+                self.txt_rate = txt_ax.text(0.5, 1.05, '', transform = txt_ax.transAxes)
+            elif(module_name != "setSpeed"):
+                self.txt_rate = txt_ax.text(0.5, 1.03, '', transform = txt_ax.transAxes)
+                self.txt_res = txt_ax.text(0.5, 1.12, '', transform = txt_ax.transAxes)
+            self.txt_fps = self.figure.text(0.01, 0.01, '', fontsize = 'small')
+            self.renderer = blit_renderer(self.figure, self.ax_new_list, 
+                                          [txt for txt in (self.txt_rate, self.txt_res, self.txt_fps) if txt is not None])
+            self.scheduler.reset()
+                
+            if(self.offline):
+                return
             # Configure the events
             self.figure.canvas.mpl_connect('close_event', self.handle_close)
             self.figure.canvas.manager.set_window_title(module_name)
@@ -588,476 +695,188 @@ class data(data_phy):
             plt.tight_layout()
             plt.show(block = False)
 
+    def subplots(self, nrows, ncols, **kwargs):
+        '''pyplot.subplots for the live plot. A figure rendered offline is not
+        managed by pyplot, it has an Agg canvas of its own, so that the export
+        writer thread can draw it while the main thread plots the next run'''
+        if(not self.offline):
+            return plt.subplots(nrows, ncols, **kwargs)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(**kwargs)
+        FigureCanvasAgg(figure)
+        return figure, figure.subplots(nrows, ncols)
+
+    def ring_window(self):
+        '''Returns the low and high indices of all the recorded points in the
+        circular buffer, in chronological order'''
+        high_ind = self.temp_index + self.buffer_length + 1
+        return high_ind - min(self.index, self.buffer_length), high_ind
+
+    def plot_window(self, window):
+        '''Returns the low and high indices of the last window points in the
+        circular buffer, or of all the points if there are not enough yet'''
+        high_ind = self.temp_index + self.buffer_length + 1
+        if(self.index < window):
+            return self.buffer_length + 1, high_ind
+        return high_ind - window, high_ind
+
+    def update_texts(self):
+        '''Updates the sampling rate and resolution texts of the live plot'''
+        try:
+            if(self.txt_rate is not None):
+                self.txt_rate.set_text('sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz')
+            if(self.txt_res is not None):
+                self.txt_res.set_text('resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz')
+        except ZeroDivisionError:
+            pass
+
+    def frame_due(self):
+        '''Returns True if a frame of the live plot should be drawn now. In
+        headless mode there is no figure and the main loop is only paced'''
+        if(HEADLESS and not self.offline):
+            time.sleep(HEADLESS_PERIOD)
+            return False
+        return self.scheduler.due()
+
+    def set_trace(self, line, x, y):
+        '''Sets the data of a line, decimated to the pixel width of its axes,
+        on the screen or in the saved figure when rendered offline'''
+        line.set_data(*decimate(x, y, axes_columns(line.axes, SAVE_DPI if self.offline else None)))
+
     def real_time_plot(self, module_name, scan = False):
-        '''Plots the data in real time, non-blocking. Can be improved by combining the 
-        similar parts in the if and else statements.'''
+        '''Plots the data in real time, non-blocking. Only the lines and the texts
+        are redrawn, the rest of the figure is blitted by self.renderer'''
         self.module_name = module_name
+        if(self.publisher is not None):
+            self.publisher.publish(self)
+        if(self.dashboard is not None):
+            self.dashboard.publish(self)
         if(module_name == "measure"):
             self.fft()
-            if(self.index < self.plot_length * 8):
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.buffer_length + 1
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind], 
-                                        self.angle[low_ind:high_ind])
-                    self.line_fft.set_data(self.fft_freq, 
-                                         abs(self.fft_angle))
-                    try:
-                        txt1 = self.ax_list[1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                            transform = self.ax_list[1].transAxes)
-                        txt2 = self.ax_list[1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                            transform = self.ax_list[1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                            
-                    self.ax_list[1].set_xlim(0, 2 * self.omega)
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                    except UnboundLocalError:
-                        pass
-                        
-                self.counter += 1
-                
-            else:
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.temp_index + 1 + self.buffer_length - self.plot_length * 8
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind], 
-                                        self.angle[low_ind:high_ind])
-                    self.line_fft.set_data(self.fft_freq, 
-                                         abs(self.fft_angle))
-                    try: 
-                        txt1 = self.ax_list[1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                            transform = self.ax_list[1].transAxes)
-                        txt2 = self.ax_list[1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                            transform = self.ax_list[1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                            
-                    self.ax_list[1].set_xlim(0, 2 * self.omega)
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
+            if(self.frame_due()):
+                self.scheduler.begin()
+                low_ind, high_ind = self.plot_window(self.plot_length * 8)
+                self.set_trace(self.line_angle, self.time[low_ind:high_ind], 
+                                    self.angle[low_ind:high_ind])
+                self.line_fft.set_data(self.fft_freq, 
+                                     abs(self.fft_angle))
+                self.update_texts()
+                self.renderer.set_xlim(self.ax_list[1], 0, 2 * self.omega)
+                self.txt_fps.set_text(self.scheduler.report())
+                self.renderer.update()
+                self.scheduler.end()
         
-        elif(module_name == "freq_scan" or module_name == "auto_freq_scan"):
+        elif(module_name == "freq_scan" or module_name == "auto_freq_scan" or module_name == "NR"):
             self.fft()
             self.pos_const = self.amp_0 * np.sin(2 * np.pi * \
                 self.omega * (self.time + self.start_time))
+            if(module_name == "NR"):
+                self.pos_active = self.position - self.pos_const
             delay_time, delay_error = 0., 0.
-            if(self.index < self.plot_length):
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.buffer_length + 1
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_fft_ang.set_data(self.fft_freq, 
-                                                abs(self.fft_angle))
-                    self.line_fft_pos.set_data(self.fft_freq,
-                                               abs(self.fft_pos))
-                    
-                    if(self.omega_list is None):
-                        if(self.index > 20 and scan):
-                            delay_time, delay_error = self.delay_fit(low_ind, high_ind)
-                        self.line_pos_const.set_data(self.time[low_ind:high_ind], 
-                                                     self.pos_const[low_ind:high_ind])
-                        self.line_phase.set_data(*zip(*self.phase_list))
-                    else:
-                        for index, line in enumerate(self.line_phase_list):
-                            line.set_data(*zip(*self.multi_phase_list[index]))
-                    self.line_amp.set_data(*zip(*self.amp_list))
-                    
-                    if(not scan):
-                        self.line_phase_active.set_data(*zip(*self.phase_list_active))
-                    
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        txt2 = self.ax_list[0, 1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        # if(self.index > 20 and scan):
-                        #     txt3 = self.ax_list[1, 0].text(0.1, 0.1, 'delay time: ' + str(1000*delay_time)[:6] + 'ms' \
-                                # + u"\u00B1" + str(1000*delay_error)[:5] + 'ms', transform = self.ax_list[1, 0].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    if(self.omega_list is None):
-                        self.figure.suptitle(module_name + ' Driving Freq: ' + str(self.omega) + 'Hz')
-                    else:
-                        self.figure.suptitle(module_name + ' Driving Freq: ' + ', '.join("%.3f" % i for i in self.omega_list) + 'Hz')
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                        
-                    if(self.omega_list is None):
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega)
-                    else:
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega_list[-1])
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                        # txt3.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
-                
-            else:
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.temp_index + 1 + self.buffer_length - self.plot_length
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_fft_ang.set_data(self.fft_freq, 
-                                                abs(self.fft_angle))
-                    self.line_fft_pos.set_data(self.fft_freq,
-                                               abs(self.fft_pos))
-                    
-                    if(self.omega_list is None):
-                        if(scan):
-                            delay_time, delay_error = self.delay_fit(low_ind, high_ind)
-                        self.line_phase.set_data(*zip(*self.phase_list))
-                        self.line_pos_const.set_data(self.time[low_ind:high_ind], 
-                                                     self.pos_const[low_ind:high_ind])
-                    else:
-                        for index, line in enumerate(self.line_phase_list):
-                            line.set_data(*zip(*self.multi_phase_list[index]))
-                    self.line_amp.set_data(*zip(*self.amp_list))
-                    
-                    if(not scan):
-                        self.line_phase_active.set_data(*zip(*self.phase_list_active))
-                    
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        txt2 = self.ax_list[0, 1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        # if(scan):
-                        #     txt3 = self.ax_list[1, 0].text(0.1, 0.1, 'delay time: ' + str(1000*delay_time)[:6] + 'ms' \
-                                # + u"\u00B1" + str(1000*delay_error)[:5] + 'ms', transform = self.ax_list[1, 0].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    if(self.omega_list is None):
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + str(self.omega) + 'Hz')
-                    else:
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + ', '.join("%.3f" % i for i in self.omega_list) + 'Hz')
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                
-                    if(self.omega_list is None):
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega)
-                    else:
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega_list[-1])
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                        # txt3.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
+            if(self.frame_due()):
+                self.scheduler.begin()
+                low_ind, high_ind = self.plot_window(self.plot_length)
+                self.set_trace(self.line_angle, self.time[low_ind:high_ind],
+                                    self.angle[low_ind:high_ind])
+                self.set_trace(self.line_pos, self.time[low_ind:high_ind],
+                                       self.position[low_ind:high_ind])
+                self.line_fft_ang.set_data(self.fft_freq, 
+                                            abs(self.fft_angle))
+                self.line_fft_pos.set_data(self.fft_freq,
+                                           abs(self.fft_pos))
                 
-        elif(module_name == "NR"):
-            self.fft()
-            self.pos_const = self.amp_0 * np.sin(2 * np.pi * \
-                self.omega * (self.time + self.start_time))
-            self.pos_active = self.position - self.pos_const
-            delay_time, delay_error = 0., 0.
-            if(self.index < self.plot_length):
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.buffer_length + 1
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_fft_ang.set_data(self.fft_freq, 
-                                                abs(self.fft_angle))
-                    self.line_fft_pos.set_data(self.fft_freq,
-                                               abs(self.fft_pos))
-                    
-                    if(self.omega_list is None):
-                        if(self.index > 20 and scan):
-                            delay_time, delay_error = self.delay_fit(low_ind, high_ind)
-                        self.line_pos_const.set_data(self.time[low_ind:high_ind], 
-                                                     self.pos_const[low_ind:high_ind])
-                        self.line_phase.set_data(*zip(*self.phase_list))
-                    else:
-                        for index, line in enumerate(self.line_phase_list):
-                            line.set_data(*zip(*self.multi_phase_list[index]))
-                    self.line_amp.set_data(*zip(*self.amp_list))
-                    
-                    if(not scan):
-                        self.line_phase_active.set_data(*zip(*self.phase_list_active))
-                    
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        txt2 = self.ax_list[0, 1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    if(self.omega_list is None):
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + str(self.omega) + 'Hz')
-                    else:
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + ', '.join("%.3f" % i for i in self.omega_list) + 'Hz')
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                        
-                    if(self.omega_list is None):
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega)
-                    else:
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega_list[-1])
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
+                if(self.omega_list is None):
+                    if(self.index > 20 and scan):
+                        # The delay time is not shown at the moment
+                        delay_time, delay_error = self.delay_fit(low_ind, high_ind)
+                    self.set_trace(self.line_pos_const, self.time[low_ind:high_ind], 
+                                                 self.pos_const[low_ind:high_ind])
+                    self.set_trace(self.line_phase, *zip(*self.phase_list))
+                else:
+                    for index, line in enumerate(self.line_phase_list):
+                        self.set_trace(line, *zip(*self.multi_phase_list[index]))
+                self.set_trace(self.line_amp, *zip(*self.amp_list))
                 
-            else:
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.temp_index + 1 + self.buffer_length - self.plot_length
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_fft_ang.set_data(self.fft_freq, 
-                                                abs(self.fft_angle))
-                    self.line_fft_pos.set_data(self.fft_freq,
-                                               abs(self.fft_pos))
-                    
-                    if(self.omega_list is None):
-                        if(scan):
-                            delay_time, delay_error = self.delay_fit(low_ind, high_ind)
-                        self.line_phase.set_data(*zip(*self.phase_list))
-                        self.line_pos_const.set_data(self.time[low_ind:high_ind], 
-                                                     self.pos_const[low_ind:high_ind])
-                    else:
-                        for index, line in enumerate(self.line_phase_list):
-                            line.set_data(*zip(*self.multi_phase_list[index]))
-                    self.line_amp.set_data(*zip(*self.amp_list))
-                    
-                    if(not scan):
-                        self.line_phase_active.set_data(*zip(*self.phase_list_active))
-                    
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.03, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                        txt2 = self.ax_list[0, 1].text(0.5, 1.12, 'resolution: ' + str(round(1 / len(self.index_list) / self.avg_spacing,3)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    if(self.omega_list is None):
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + str(self.omega) + 'Hz')
-                    else:
-                        self.figure.suptitle(module_name + ' Driven Freq: ' + ', '.join("%.3f" % i for i in self.omega_list) + 'Hz')
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
+                if(not scan):
+                    self.set_trace(self.line_phase_active, *zip(*self.phase_list_active))
                 
-                    if(self.omega_list is None):
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega)
-                    else:
-                        self.ax_list[0, 1].set_xlim(0, 2 * self.omega_list[-1])
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                        txt2.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
+                self.update_texts()
+                if(self.omega_list is None):
+                    self.renderer.set_title(module_name + ' Driven Freq: ' + str(self.omega) + 'Hz')
+                    self.renderer.set_xlim(self.ax_list[0, 1], 0, 2 * self.omega)
+                else:
+                    self.renderer.set_title(module_name + ' Driven Freq: ' + ', '.join("%.3f" % i for i in self.omega_list) + 'Hz')
+                    self.renderer.set_xlim(self.ax_list[0, 1], 0, 2 * self.omega_list[-1])
+                self.txt_fps.set_text(self.scheduler.report())
+                self.renderer.update()
+                self.scheduler.end()
                 
         elif(module_name == "pid"):
-            if(self.index < self.plot_length and self.index > 1):
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.buffer_length + 1
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_angle_vel.set_data(self.time[low_ind:high_ind],
-                                            self.angular_velocity[low_ind:high_ind])
-                    self.line_pos_vel.set_data(self.time[low_ind:high_ind],
-                                            self.position_velocity[low_ind:high_ind])
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.05, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    if(self.pid_param == 'r'):
-                        self.figure.suptitle('PID parameters (reusing previous values)')
-                    else:
-                        self.figure.suptitle('PID parameters(' + self.pid_param + ')')
-                    
-                    for axes in self.ax_list:
-                        for ax in axes:
-                            ax.relim()
-                            ax.autoscale_view()
-                            for label in ax.get_yticklabels():
-                                label.set_rotation(ANGLE_ROTATION)
-                        
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1
-                
-            else:
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.temp_index + 1 + self.buffer_length - self.plot_length
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_angle.set_data(self.time[low_ind:high_ind],
-                                        self.angle[low_ind:high_ind])
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                           self.position[low_ind:high_ind])
-                    self.line_angle_vel.set_data(self.time[low_ind:high_ind],
-                                            self.angular_velocity[low_ind:high_ind])
-                    self.line_pos_vel.set_data(self.time[low_ind:high_ind],
-                                            self.position_velocity[low_ind:high_ind])
-                    try:
-                        txt1 = self.ax_list[0, 1].text(0.5, 1.05, 'sampling rate: ' + str(round(0.5 / self.avg_spacing,1)) + 'Hz',
-                                                transform = self.ax_list[0, 1].transAxes)
-                    except ZeroDivisionError:
-                        pass
-                    
-                    if(self.pid_param == 'r'):
-                        self.figure.suptitle('PID parameters (reusing previous values)')
-                    else:
-                        self.figure.suptitle('PID parameters(' + self.pid_param + ')')
-                    
-                    for axes in self.ax_list:
-                        for ax in axes:
-                            ax.relim()
-                            ax.autoscale_view()
-                            for label in ax.get_yticklabels():
-                                label.set_rotation(ANGLE_ROTATION)
-                        
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    try:
-                        txt1.remove()
-                    except UnboundLocalError:
-                        pass
-                    
-                self.counter += 1            
+            if(self.frame_due()):
+                self.scheduler.begin()
+                low_ind, high_ind = self.plot_window(self.plot_length)
+                self.set_trace(self.line_angle, self.time[low_ind:high_ind],
+                                    self.angle[low_ind:high_ind])
+                self.set_trace(self.line_pos, self.time[low_ind:high_ind],
+                                       self.position[low_ind:high_ind])
+                self.set_trace(self.line_angle_vel, self.time[low_ind:high_ind],
+                                        self.angular_velocity[low_ind:high_ind])
+                self.set_trace(self.line_pos_vel, self.time[low_ind:high_ind],
+                                        self.position_velocity[low_ind:high_ind])
+                self.update_texts()
+                if(self.pid_param == 'r'):
+                    self.renderer.set_title('PID parameters (reusing previous values)')
+                else:
+                    self.renderer.set_title('PID parameters(' + self.pid_param + ')')
+                self.txt_fps.set_text(self.scheduler.report())
+                self.renderer.update()
+                self.scheduler.end()
         
         elif(module_name == "setSpeed"):
-            if(self.index < self.plot_length):
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.buffer_length + 1
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                             self.position[low_ind:high_ind])
-                    self.line_pos_vel.set_data(self.time[low_ind:high_ind],
-                                               self.position_velocity[low_ind:high_ind])
-                    
-                    if(self.setSpeed_param is not None):
-                        self.figure.suptitle(self.setSpeed_param)
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                            
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    
-                self.counter += 1
-            else:
-                if(self.counter % MAX_COUNT == 0):
-                    low_ind = self.temp_index + self.buffer_length + 1 - self.plot_length
-                    high_ind = self.temp_index + self.buffer_length + 1
-                    
-                    self.line_pos.set_data(self.time[low_ind:high_ind],
-                                             self.position[low_ind:high_ind])
-                    self.line_pos_vel.set_data(self.time[low_ind:high_ind],
-                                               self.position_velocity[low_ind:high_ind])
-                    
-                    if(self.setSpeed_param is not None):
-                        self.figure.suptitle(self.setSpeed_param)
-                    
-                    for ax in self.ax_new_list:
-                        ax.relim()
-                        ax.autoscale_view()
-                        for label in ax.get_yticklabels():
-                            label.set_rotation(ANGLE_ROTATION)
-                            
-                    self.figure.canvas.draw()
-                    self.figure.canvas.flush_events()
-                    
-                self.counter += 1
+            if(self.frame_due()):
+                self.scheduler.begin()
+                low_ind, high_ind = self.plot_window(self.plot_length)
+                self.set_trace(self.line_pos, self.time[low_ind:high_ind],
+                                         self.position[low_ind:high_ind])
+                self.set_trace(self.line_pos_vel, self.time[low_ind:high_ind],
+                                           self.position_velocity[low_ind:high_ind])
+                if(self.setSpeed_param is not None):
+                    self.renderer.set_title(self.setSpeed_param)
+                self.txt_fps.set_text(self.scheduler.report())
+                self.renderer.update()
+                self.scheduler.end()
         
     def handle_close(self, _):
         '''Turns the original close event to save the figure as well'''
         self.flag_close_event = True
         self.flag_subplot_init = True
-            
+        print("\nLive plot: " + self.scheduler.summary() + "\n")
+        # Drawn again from a snapshot by the export writer, on a figure of its
+        # own, pyplot and the live figure are only used by this thread
+        from export_writer import get_writer
+        get_writer().submit(self.snapshot().save_snapshot)
+        self.figure.canvas.flush_events()
+        plt.close("all")
+
+    def save_snapshot(self):
+        '''Renders the last frame of the live plot offline, on an Agg figure
+        which is not managed by pyplot, and saves it. Run by the export writer
+        on a snapshot of the run, for the live plot and in headless mode'''
+        self.offline = True
+        self.flag_fig_init = True
+        self.flag_subplot_init = True
+        try:
+            self.init_plot(self.module_name)
+            self.real_time_plot(self.module_name)
+            self.save_figure()
+        finally:
+            self.offline = False
+            self.flag_fig_init = True
+            self.figure = None
+
+    def save_figure(self):
+        '''Saves the figure as a pdf in the data folder'''
         try:
             dirc = self.path + '\\' + datetime.now().strftime("%d-%m-pdf")
             os.makedirs(dirc)
@@ -1065,12 +884,158 @@ class data(data_phy):
             pass
         filename = dirc + '\\' + self.module_name + \
             datetime.now().strftime("-%H-%M-%S") + ".pdf"
-        self.figure.savefig(filename, dpi = 600)
-        self.figure.clf()
-        self.figure.canvas.flush_events()
-        plt.close("all")
+        if(self.renderer is not None):
+            # The blitted artists are not part of a normal draw otherwise
+            self.renderer.release()
+        self.figure.savefig(filename, dpi = SAVE_DPI)
+
+    def snapshot(self):
+        '''Returns a copy of the data of the finished run, which the export
+        writer can save while this object is cleared for the next run'''
+        snap = copy.copy(self)
+        for key, value in vars(self).items():
+            if(isinstance(value, np.ndarray)):
+                setattr(snap, key, value.copy())
+            elif(isinstance(value, list) and not key.startswith('line_')):
+                setattr(snap, key, copy.deepcopy(value))
+        # The live outputs and the artists of the live figure stay with this
+        # object, save_snapshot draws a figure of its own
+        snap.figure = None
+        snap.publisher = None
+        snap.dashboard = None
+        snap.renderer = None
+        snap.scheduler = render_scheduler()
+        return snap
 
     def export_csv(
+        self, 
+        module_name,
+        NR_phase_amp = False,
+        input_spec_info = True,
+        export_format = EXPORT_FORMAT,
+        background = False,
+        ):
+        '''Exports the data to csv files, to a binary run file (see run_format.py)
+        or to both, depending on export_format. With background, a snapshot of
+        the run is exported by the export writer and nothing is asked'''
+        from export_writer import get_writer
+        if(self.recorder is not None):
+            # The samples are on disk already, only the footer is left
+            self.recorder.close(self, self.run_metadata(module_name, NR_phase_amp = NR_phase_amp))
+            if(export_format == 'record'):
+                get_writer().submit(self.snapshot().catalog_run, self.recorder.filename, module_name, NR_phase_amp)
+                return
+        if(background):
+            get_writer().submit(self.snapshot().export_csv, module_name, NR_phase_amp, 
+                                input_spec_info = False, export_format = export_format)
+            return
+        filename = None
+        if(export_format in ('csv', 'both')):
+            filename = self.write_csv(module_name, NR_phase_amp, input_spec_info)
+        if(export_format in ('npz', 'both')):
+            filename = self.write_run(module_name, NR_phase_amp)
+        if(filename is not None):
+            # A run exported in both formats is catalogued by its binary file
+            self.catalog_run(filename, module_name, NR_phase_amp)
+
+    def catalog_run(self, filename, module_name, NR_phase_amp = False):
+        '''Adds an exported run to the run catalog (see run_catalog.py)'''
+        from run_catalog import register_run, CATALOG_PATH
+        if(not CATALOG_PATH):
+            return
+        low_ind, high_ind = self.ring_window()
+        columns = {
+            'time': self.time[low_ind:high_ind],
+            'angle': self.angle[low_ind:high_ind],
+            'position': self.position[low_ind:high_ind],
+            'angular_velocity': self.angular_velocity[low_ind:high_ind],
+            'cart_velocity': self.position_velocity[low_ind:high_ind],
+            }
+        register_run(filename, self.run_metadata(module_name, NR_phase_amp = NR_phase_amp), columns)
+
+    def phase_amp_rows(self):
+        '''Aligns the amplitudes with the phases, since they have different
+        lengths in the buffer. Returns the rows of time, phase, amplitude and,
+        if any, the active phase'''
+        rows = []
+        temp_i = 0
+        temp_amp = self.amp_list[0][1]
+        for i in range(len(self.amp_list) - 1):
+            if(self.amp_list[i + 1][0]):
+                temp_i = i
+                temp_amp = self.amp_list[i][1]
+                break
+        for i in range(len(self.phase_list)):
+            if(i != len(self.phase_list) - 1 and self.phase_list[i + 1][0] == 0):
+                continue
+            if(temp_i != len(self.amp_list) - 1 and self.phase_list[i][0] >= self.amp_list[temp_i + 1][0]):
+                temp_i += 1
+                temp_amp = self.amp_list[temp_i][1]
+            row = [self.phase_list[i][0], self.phase_list[i][1], temp_amp]
+            if(self.phase_list_active is not None):
+                row.append(self.phase_list_active[i][1])
+            rows.append(row)
+        return rows
+
+    def run_metadata(self, module_name, special_info = "", NR_phase_amp = False):
+        '''The header of the csv files as a dictionary, for the binary run file'''
+        def value(text):
+            try:
+                return float(text)
+            except (TypeError, ValueError):
+                return text
+        metadata = {'special_info': special_info, 'module': module_name}
+        if(module_name == "pid"):
+            try:
+                params = self.pid_param.split(',')
+                for i, key in enumerate(["Kp", "Ki", "Kd", "Kp_pos", "Ki_pos", "Kd_pos"]):
+                    metadata[key] = value(params[i])
+            except (AttributeError, IndexError):
+                pass
+        metadata['start_time'] = float(self.start_time)
+        if(self.omega_list is None):
+            metadata['omega'] = float(self.omega)
+        else:
+            metadata['multiple_omega'] = [float(i) for i in self.omega_list]
+        try:
+            metadata['amplitude'] = float(self.amp_list[-1][1])
+            metadata['amp_0'] = float(self.amp_0)
+            if(self.omega_list is None):
+                metadata['phase/pi'] = float(self.phase_list[-1][1])
+            else:
+                metadata['multiple_phase/pi'] = [float(i[-1][1]) for i in self.multi_phase_list]
+        except (AttributeError, IndexError, TypeError):
+            pass
+        if(NR_phase_amp):
+            metadata.update({'NR_Kp': self.NR_Kp, 'NR_Ki': self.NR_Ki, 'NR_Kd': self.NR_Kd})
+        if(self.end_reason is not None):
+            metadata['end_reason'] = self.end_reason
+        metadata['sample_count'] = int(min(self.index, self.buffer_length))
+        return metadata
+
+    def write_run(self, module_name, NR_phase_amp = False):
+        '''Writes the data, the fft and the phase/amplitude tables and the
+        metadata into a single binary run file'''
+        from run_format import save_run, DATA_COLUMNS, RUN_EXTENSION
+        dirc = self.path + '\\' + datetime.now().strftime("%d-%m-run")
+        os.makedirs(dirc, exist_ok = True)
+        filename = dirc + '\\' + module_name + datetime.now().strftime("-%H-%M-%S") + RUN_EXTENSION
+        low_ind, high_ind = self.ring_window()
+        columns = (self.time, self.angle, self.position, self.angular_velocity, self.position_velocity)
+        data = {name: values[low_ind:high_ind] for name, values in zip(DATA_COLUMNS, columns)}
+        fft = None
+        if(module_name != "pid" and module_name != "setSpeed"):
+            fft = {'freq': self.fft_freq, 'angle': self.fft_angle, 'position': self.fft_pos}
+        phase_amp = None
+        if(NR_phase_amp):
+            rows = np.array(self.phase_amp_rows(), dtype = float).reshape(-1, 4 if self.phase_list_active is not None else 3)
+            phase_amp = dict(zip(('time', 'phase', 'amplitude', 'phase_active'), rows.T))
+        save_run(filename, self.run_metadata(module_name, NR_phase_amp = NR_phase_amp), 
+                 data, fft, phase_amp, compress = EXPORT_COMPRESS)
+        print("\nExported to " + filename + "\n")
+        return filename
+
+    def write_csv(
         self, 
         module_name,
         NR_phase_amp = False,
@@ -1121,10 +1086,16 @@ class data(data_phy):
                     writer.writerow(["multiple_phase/pi", *(str(i[-1][1]) for i in self.multi_phase_list)])
             except (AttributeError, IndexError):
                 pass
+            if(self.end_reason is not None):
+                writer.writerow(["end_reason", self.end_reason])
             writer.writerow(["time", "angle", "position", "angular_velocity", "cart_velocity"])
-            for i in range(len(self.time)):
-                writer.writerow([self.time[i], self.angle[i], self.position[i],\
-                    self.angular_velocity[i], self.position_velocity[i]])
+            # Only the recorded points, unrolled from the circular buffer
+            low_ind, high_ind = self.ring_window()
+            csvfile.write(format_rows(np.column_stack((self.time[low_ind:high_ind], 
+                                                        self.angle[low_ind:high_ind], 
+                                                        self.position[low_ind:high_ind], 
+                                                        self.angular_velocity[low_ind:high_ind], 
+                                                        self.position_velocity[low_ind:high_ind]))))
             csvfile.close()
         if(module_name != "pid" and module_name != "setSpeed"):
             with open(filename_fft + '.csv', 'w', newline = '') as csvfile:
@@ -1146,8 +1117,7 @@ class data(data_phy):
                 except (AttributeError, IndexError):
                     pass
                 writer.writerow(['freq', 'fft_angle', 'fft_position'])
-                for i in range(len(self.fft_freq)):
-                    writer.writerow([self.fft_freq[i], self.fft_angle[i], self.fft_pos[i]])
+                writer.writerows(zip(self.fft_freq, self.fft_angle, self.fft_pos))
                 csvfile.close()
                 
         if(NR_phase_amp):
@@ -1165,49 +1135,18 @@ class data(data_phy):
                     writer.writerow(['time/s', 'phase/pi', 'amplitude/steps', 'phase_active/pi'])
                 else:
                     writer.writerow(['time/s', 'phase/pi'])
-                # Following code tries to align the amplitude data with the phase data
-                # since they have different lengths in the buffer
-                temp_i = 0
-                temp_amp = self.amp_list[0][1]
-                for i in range(len(self.amp_list) - 1):
-                    if(self.amp_list[i + 1][0]):
-                        temp_i = i
-                        temp_amp = self.amp_list[i][1]
-                        break
-                for i in range(len(self.phase_list)):
-                    if(i == len(self.phase_list) - 1):
-                        pass
-                    else:
-                        if(self.phase_list[i + 1][0] == 0):
-                            continue
-                    if(self.phase_list_active is not None):
-                        if(temp_i == len(self.amp_list) - 1):
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1],\
-                                temp_amp, self.phase_list_active[i][1]])
-                        elif(self.phase_list[i][0] < self.amp_list[temp_i + 1][0]):
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1],\
-                                temp_amp, self.phase_list_active[i][1]])
-                        else:
-                            temp_i += 1
-                            temp_amp = self.amp_list[temp_i][1]
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1],\
-                                temp_amp, self.phase_list_active[i][1]])
-                    else:
-                        if(temp_i == len(self.amp_list) - 1):
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1]])
-                        elif(self.phase_list[i][0] < self.amp_list[temp_i + 1][0]):
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1]])
-                        else:
-                            temp_i += 1
-                            temp_amp = self.amp_list[temp_i][1]
-                            writer.writerow([self.phase_list[i][0], self.phase_list[i][1]])
+                if(self.phase_list_active is not None):
+                    writer.writerows(self.phase_amp_rows())
+                else:
+                    writer.writerows(row[:2] for row in self.phase_amp_rows())
                 csvfile.close()
 
         print("\nExported to " + filename + "\n")
         if(module_name != 'pid' and module_name != 'setSpeed'):
             print("\nExported to " + filename_fft + "\n")
         if(NR_phase_amp):
-            print("\nExported to " + filename_phase_amp + "\n")       
+            print("\nExported to " + filename_phase_amp + "\n")
+        return filename + '.csv'       
     
 class live_data(data):
     
@@ -1220,6 +1159,12 @@ class live_data(data):
         wait_to_stable,
         ):
         super().__init__(fft_length, sampling_div, wait_to_stable)
+        if(SHARED_MEMORY):
+            from shared_buffer import shm_publisher
+            self.publisher = shm_publisher()
+        if(DASHBOARD):
+            from dashboard import start_dashboard
+            self.dashboard = start_dashboard()
         
     def copy(self, data, NR = False):
         '''Copy the data from the data class to the live_data class.
@@ -1244,6 +1189,8 @@ class live_data(data):
         self.avg_spacing = data.avg_spacing
         self.index_list = data.index_list
         self.start_time = data.start_time
+        self.recorder = data.recorder
+        self.end_reason = data.end_reason
         try:
             self.pid_param = data.pid_param
         except AttributeError:
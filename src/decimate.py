@@ -0,0 +1,77 @@
+'''Visual decimation of long traces before plotting. A line plotted on an
+axes of a few hundred pixels cannot show more than a couple of points per
+pixel column, so the traces are reduced to about twice the pixel width of
+the axes, keeping the extremes (min/max) or the shape (LTTB) of the trace.'''
+import numpy as np
+
+def minmax_decimate(x, y, n_columns):
+    '''Keeps the minimum and the maximum of y in each of n_columns buckets of
+    consecutive points, in their original order. Returns at most
+    2 * n_columns points, the input itself if it is already short enough.'''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    n_columns = int(n_columns)
+    if(n_columns < 1 or n <= 2 * n_columns):
+        return x, y
+    bucket = int(np.ceil(n / n_columns))
+    n_columns = int(np.ceil(n / bucket))
+    # Pad with the last value so that the buckets can be reshaped into a 2D array
+    padded = np.concatenate((y, np.full(n_columns * bucket - n, y[-1])))
+    padded = padded.reshape(n_columns, bucket)
+    offsets = np.arange(n_columns) * bucket
+    index_min = np.argmin(padded, axis = 1) + offsets
+    index_max = np.argmax(padded, axis = 1) + offsets
+    index = np.sort(np.stack((index_min, index_max), axis = 1), axis = 1).ravel()
+    index = np.minimum(index, n - 1)
+    # A bucket whose min and max are the same point only needs it once
+    keep = np.ones(len(index), dtype = bool)
+    keep[1:] = index[1:] != index[:-1]
+    index = index[keep]
+    return x[index], y[index]
+
+def lttb(x, y, n_out):
+    '''Largest-Triangle-Three-Buckets downsampling to n_out points, which
+    keeps the visual shape of the trace better than min/max for smooth data'''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    n_out = int(n_out)
+    if(n_out < 3 or n <= n_out):
+        return x, y
+    xf = x.astype(float)
+    yf = y.astype(float)
+    # Bucket edges of the n - 2 inner points, the first and last points are always kept
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    index = np.zeros(n_out, dtype = int)
+    index[-1] = n - 1
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point) is the third vertex
+        if(i + 2 < len(edges)):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            x_avg = xf[next_start:next_end].mean()
+            y_avg = yf[next_start:next_end].mean()
+        else:
+            x_avg, y_avg = xf[-1], yf[-1]
+        area = np.abs((xf[selected] - x_avg) * (yf[start:end] - yf[selected]) \
+            - (xf[selected] - xf[start:end]) * (y_avg - yf[selected]))
+        selected = start + int(np.argmax(area))
+        index[i + 1] = selected
+    return x[index], y[index]
+
+def decimate(x, y, n_columns, method = 'minmax'):
+    '''Reduces a trace to about 2 * n_columns points with the chosen method,
+    'minmax' or 'lttb'. n_columns is usually the pixel width of the axes.'''
+    if(method == 'lttb'):
+        return lttb(x, y, 2 * n_columns)
+    return minmax_decimate(x, y, n_columns)
+
+def axes_columns(ax, dpi = None):
+    '''Number of pixel columns of an axes on the screen, or in its figure
+    saved at dpi'''
+    width = ax.bbox.width
+    if(dpi is not None):
+        width *= dpi / ax.figure.dpi
+    return max(int(width), 1)
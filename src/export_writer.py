@@ -0,0 +1,71 @@
+'''Background writer of the finished runs, so that the export of the data and
+the rendering of the figures never hold up the control loop. The jobs are run
+in order by a single thread, e.g. the export of a snapshot of a run (see
+data.snapshot()) while the next trial of auto_pid.py is already running.
+
+The queue is bounded: if the disk cannot keep up, submit() waits for a free
+slot instead of piling up snapshots in memory. The pending jobs are finished
+before the interpreter exits.'''
+import atexit, importlib, queue, threading, traceback
+# Imported for its side effect only: pandas imports it, and a job importing
+# pandas first while the interpreter exits could no longer register its exit
+# handler
+importlib.import_module('concurrent.futures.thread')
+
+WRITER_QUEUE = 4 # Maximum number of jobs waiting to be written
+
+_writer = None
+
+def get_writer():
+    '''Returns the writer of the process, started on first use'''
+    global _writer
+    if(_writer is None):
+        _writer = export_writer()
+        _writer.start()
+        atexit.register(_writer.close)
+    return _writer
+
+class export_writer():
+
+    '''A thread running the submitted jobs one after the other'''
+
+    def __init__(self, size = WRITER_QUEUE):
+        self.queue = queue.Queue(size)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = 'export_writer', daemon = True)
+        self.thread.start()
+
+    def submit(self, job, *args, **kwargs):
+        '''Queues job(*args, **kwargs), waits if the queue is full'''
+        if(self.queue.full()):
+            print("\nExport writer busy, waiting for a free slot...\n")
+        self.queue.put((job, args, kwargs))
+
+    def run(self):
+        while(True):
+            item = self.queue.get()
+            try:
+                if(item is None):
+                    return
+                job, args, kwargs = item
+                job(*args, **kwargs)
+            except Exception:
+                # A failed export must not stop the following ones
+                print("\nExport failed:\n" + traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''Waits until all the submitted jobs are done'''
+        self.queue.join()
+
+    def close(self):
+        '''Finishes the pending jobs and stops the thread'''
+        if(self.thread is None or not self.thread.is_alive()):
+            return
+        if(self.queue.unfinished_tasks):
+            print("\nFinishing the pending exports...\n")
+        self.queue.put(None)
+        self.thread.join()
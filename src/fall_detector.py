@@ -0,0 +1,85 @@
+'''Detection of the unrecoverable states of the pendulum during a PID trial, so
+that the automated sweeps (auto_pid.py, twoauto.py) end a failed trial at once
+instead of running it for the whole TRIAL_DURATION_SECONDS.
+
+A trial cannot recover once
+    - the angle stays beyond FALL_ANGLE for FALL_DURATION ('fallen')
+    - the cart runs beyond POSITION_LIMIT from the centre ('runaway')
+    - the cart velocity stays beyond VELOCITY_LIMIT for SATURATION_DURATION,
+      the motor cannot do more ('saturated')
+
+fall_detector is fed the samples one by one by the reader thread, detect()
+finds the same states in recorded runs, for many runs at once, and is used to
+trim them before they are scored (see data_analysis.batch_kpis).'''
+import numpy as np
+
+FALL_ANGLE = 0.3 # Angle (rad) beyond which the pendulum has fallen
+FALL_DURATION = 0.25 # Time (s) the angle must stay beyond FALL_ANGLE
+POSITION_LIMIT = 2000 # Distance (steps) from the centre beyond which the cart runs away
+VELOCITY_LIMIT = 3000 # Cart velocity (steps/s) of a saturated motor
+SATURATION_DURATION = 0.5 # Time (s) the cart velocity must stay beyond VELOCITY_LIMIT
+END_REASONS = (None, 'fallen', 'runaway', 'saturated') # By the codes returned by detect()
+
+class fall_detector():
+
+    '''Online evaluator of a trial, update() is called with each new sample'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''Starts a new trial'''
+        self.reason = None
+        self.end_time = None
+        self.angle_since = None # Time since which the angle is beyond FALL_ANGLE
+        self.velocity_since = None # Time since which the velocity is beyond VELOCITY_LIMIT
+
+    def update(self, time, angle, position, velocity):
+        '''Returns the reason why the trial cannot recover, None while it can'''
+        if(self.reason is not None):
+            return self.reason
+        self.angle_since = since(abs(angle) > FALL_ANGLE, self.angle_since, time)
+        self.velocity_since = since(abs(velocity) > VELOCITY_LIMIT, self.velocity_since, time)
+        if(self.angle_since is not None and time - self.angle_since >= FALL_DURATION):
+            self.reason = 'fallen'
+        elif(abs(position) > POSITION_LIMIT):
+            self.reason = 'runaway'
+        elif(self.velocity_since is not None and time - self.velocity_since >= SATURATION_DURATION):
+            self.reason = 'saturated'
+        if(self.reason is not None):
+            self.end_time = time
+        return self.reason
+
+def since(condition, start, time):
+    '''Start time of the current stretch of samples meeting condition'''
+    if(not condition):
+        return None
+    return time if start is None else start
+
+def sustained(condition, time, duration):
+    '''Whether each sample ends a stretch of samples meeting condition which
+    lasted at least duration, along the last axis'''
+    index = np.arange(condition.shape[-1])
+    last_unmet = np.maximum.accumulate(np.where(condition, -1, index), axis = -1)
+    first_met = np.minimum(last_unmet + 1, condition.shape[-1] - 1)
+    return condition & (time - np.take_along_axis(time, first_met, axis = -1) >= duration)
+
+def detect(time, angle, position, velocity, mask = None):
+    '''Finds the first unrecoverable sample of recorded runs. The arguments are
+    (runs, samples) arrays, or the arrays of a single run, mask the samples of
+    each run if they are padded. Returns the index of the sample (-1 if none)
+    and the code of the reason in END_REASONS (0 if none), by run.'''
+    time, angle, position, velocity = np.atleast_2d(time, angle, position, velocity)
+    if(mask is None):
+        mask = np.ones(time.shape, dtype = bool)
+    states = (sustained(np.abs(angle) > FALL_ANGLE, time, FALL_DURATION),
+              np.abs(position) > POSITION_LIMIT,
+              sustained(np.abs(velocity) > VELOCITY_LIMIT, time, SATURATION_DURATION))
+    codes = np.zeros(time.shape, dtype = int)
+    # The first reason wins when several are met at the same sample, as in fall_detector
+    for code, state in reversed(list(enumerate(states, 1))):
+        codes[state & mask] = code
+    detected = codes > 0
+    index = np.where(detected.any(axis = -1), np.argmax(detected, axis = -1), -1)
+    reason = np.where(index >= 0, codes[np.arange(len(codes)), index], 0)
+    return index, reason
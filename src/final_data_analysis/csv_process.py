@@ -4,14 +4,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import pandas as pd
-import os, csv, tkinter
+import os, csv, tkinter, sys
 from statistics import mean, stdev
 from scipy.fft import fft, fftfreq
 from scipy.signal import find_peaks
 from scipy.optimize import curve_fit
+# Shared helpers live in the parent src directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from decimate import decimate, axes_columns
+from run_format import is_run, load_run, DATA_COLUMNS
+from run_archive import unroll
 plt.rcParams['axes.grid'] = True
 plt.rcParams["figure.autolayout"] = True
 mpl.use('TkAgg')
+SAVE_DPI = 600 # Resolution of the saved figures, to which their traces are decimated
 
 def damp_sin(time, gamma, omega, phi, amp, offset):
     '''Fit to the natural frequency measurement plot'''
@@ -49,35 +55,30 @@ class data_analysis():
     4. read_csv(file_name, flag_pid = False):
         Args: 
             file_name: the name of the csv file
-            flag_pid: whether the csv file is a pid type file, if True,
-            read_csv will read the values starting from a different row
+            flag_pid: whether the csv file is a pid type file, kept for
+            the callers, the table of any type starts after its time header
         Yields: 
             read the csv file and store the data in the data array
             update the properties dictionary
         Returns: 
             True if the csv file is read successfully, False otherwise
             (including negative time stamp, and sometimes empty file)
+        Binary run files (.npz, .rec and .carz, see run_format.py) are read
+        by read_run(path)
     5. check_csv_type():
         check whether all the csv files are of the same type, returns
         True if all the csv files are of the same type, False otherwise
-    6. load_data(row, file):
-        Args:
-            row: a row of data from the csv file
-            file: the csv file name
-        Yields:
-            load the data into the data array, delete the files if negative
-            time stamp is detected
-    7. clean_data(file):
+    6. clean_data(file):
         Yields:
             rotate the circular buffer to the correct starting time stamp
-            and return the data array
-    8. restore_figure(start_index = 0, end_index = -1):
+            (see run_archive.unroll) and return the data array
+    7. restore_figure(start_index = 0, end_index = -1):
         Args:
             start_index: the starting index of the data to be plotted
             end_index: the ending index of the data to be plotted
         Yields:
             restore the figure for the scan type data
-    9. fft_index_list(time, fft_length, sampling_div):
+    8. fft_index_list(time, fft_length, sampling_div):
         Args:
             time: the time array
             fft_length: the length of the fft
@@ -86,7 +87,7 @@ class data_analysis():
             index_list: the list of indices for the fft
             avg_spacing: the average time spacing, which determines
             the maximum frequency (refer to the Nyquist-Shannon sampling)
-    10. general_fft(time, angle, position, fft_length, sampling_div):
+    9. general_fft(time, angle, position, fft_length, sampling_div):
         Args:
             time: the time array
             angle: the angle array
@@ -98,12 +99,12 @@ class data_analysis():
             fft_position: the fourier transform of the position array
             fft_freq: the frequency array
             avg: the average time spacing
-    11. phase_rectify(phase):
+    10. phase_rectify(phase):
         Args:
             phase: the phase to be rectified
         Returns:
             a phase in the range of -0.5 * pi to 1.5 * pi
-    12. phase_calc(fft_freq, omega, fft_angle, fft_pos, interpolation = True):
+    11. phase_calc(fft_freq, omega, fft_angle, fft_pos, interpolation = True):
         Args:
             fft_freq: the frequency array
             omega: the driving frequency in Hz
@@ -112,7 +113,7 @@ class data_analysis():
             interpolation: whether to use interpolation to calculate the phase
         Returns:
             phase: the phase in the range of -0.5 * pi to 1.5 * pi
-    13. scan_fit(time, angle, amp_range):
+    12. scan_fit(time, angle, amp_range):
         Args:
             time: the time array
             angle: the angle array
@@ -120,25 +121,37 @@ class data_analysis():
         Returns:
             popt: the optimized parameters to fit the sinusoidal function
             pcov: the covariance matrix
-    14. scan_fft_plot(axs, start_index = 0, end_index = -1):
+    13. window_dft(signals, bins, ends, lengths):
+        Args:
+            signals: the arrays of uniformly sampled data
+            bins: the frequency bin of each window
+            ends: the index of the last point of each window
+            lengths: the number of points of each window
+        Returns:
+            the fourier coefficient of each signal at the bin of each window
+    14. rolling_phase(start_index = 0, end_index = -1):
+        Returns:
+            the time stamps and the phases of the rolling fft, computed on
+            uniformly resampled data with a sliding DFT in linear time
+    15. scan_fft_plot(axs, start_index = 0, end_index = -1):
         plot the phase curve and fft on the axes objects
-    15. scan_process(axes, start_time, end_time, rolling_time):
+    16. scan_process(axes, start_time, end_time, rolling_time):
         calculate the phase and amplitude of the scan data
         based on the input time range and rolling time
-    16. scan_plot(file, block = True):
+    17. scan_plot(file, block = True):
         plot two graphs:
         1. The angle-time graph with best fit line and parameters
         2. The phase curve and cumulated error
         And save the timestamp, the amplitude of the best-fit, and the
         phase with errors to a csv file
-    17. save_scan_data(exp_data, file):
+    18. save_scan_data(exp_data, file):
         save the scan data to a csv file
-    18. measure_plot(file, block = True):
+    19. measure_plot(file, block = True):
         plot the angle-time graph with best fit line and parameters
         And save the timestamp, the optimized parameters to a csv file
-    19. save_measure_data(exp_data, file):
+    20. save_measure_data(exp_data, file):
         save the measure data to a csv file
-    20. main():
+    21. main():
         the main function of the data analysis class
         '''
     
@@ -199,7 +212,7 @@ class data_analysis():
         self.dirc = input('Please input the directory of the csv file: ')
         self.parent_name_list = os.path.basename(self.dirc).split('-')
         for file in os.listdir(self.dirc):
-            if file.endswith('.csv'):
+            if file.endswith('.csv') or is_run(file):
                 self.csv_list.append(file)
             if file.startswith('measure'):
                 self.data_flag_dict['measure'] = True
@@ -214,48 +227,71 @@ class data_analysis():
             return True
     
     def read_csv(self, file_name, flag_pid = False):
-        '''Read a single csv file and return the properties and data'''
+        '''Read a single csv file, the metadata lines into the properties and
+        the table after the time header into the data array, in one parse'''
         path = self.dirc + '\\' + file_name
         self.path = path
+        if(is_run(file_name)):
+            return self.read_run(path)
         with open(path, 'r') as file:
-            reader = csv.reader(file)
-            try: 
-                for index, row in enumerate(reader):
-                    if(flag_pid):
-                        if(index == 2):
-                            # Read the pid parameters
-                            pid_headers = ['Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos']
-                            for index, param in row:
-                                self.properties.update({pid_headers[index]:param})
-                            continue
-                        if(row[0].startswith('Kp')):
-                            continue
-                        for header in self.header:
-                            if(row[0].startswith(header)):
-                                self.properties.update({header:row[1]})
-                                break
-                        if(row[0].startswith('time')):
-                            continue
-                        if(index >= 8):
-                            self.load_data(row, file)
-                    else:
-                        for header in self.header:
-                            if(row[0] == 'multiple_omega' or row[0] == 'multiple_phase'):
-                                self.properties.update({header:(row[i] for i in range(1, len(row)))})
-                                print(self.properties[header])
-                                # TODO: multiple frequency assessment
-                                return False
-                            if(row[0].startswith(header)):
-                                self.properties.update({header:row[1]})
-                                if(len(row)>3 and row[2] in self.header):
-                                    self.properties.update({row[2]:row[3]})
-                                break
-                        if(row[0].startswith('time')):
-                            continue
-                        if(index >= 6):
-                            self.load_data(row, file)
-            except ValueError:
+            text = file.read()
+        lines = text.split('\n')
+        header = next((i for i, line in enumerate(lines) if line.startswith('time')), len(lines))
+        for index, line in enumerate(lines[:header]):
+            row = line.split(',')
+            if(row[0] == 'multiple_omega' or row[0] == 'multiple_phase'):
+                self.properties.update({row[0]:row[1:]})
+                print(self.properties[row[0]])
+                # TODO: multiple frequency assessment
                 return False
+            if(row[0] == 'Kp'):
+                # The pid parameters are on the next line
+                if(index + 1 < header):
+                    self.properties.update(zip(row, lines[index + 1].split(',')))
+                continue
+            for key in self.header:
+                if(row[0].startswith(key)):
+                    self.properties.update({key:row[1] if len(row) > 1 else ''})
+                    if(len(row) > 3 and row[2] in self.header):
+                        self.properties.update({row[2]:row[3]})
+                    break
+        if(header == len(lines)):
+            return False
+        n_columns = lines[header].count(',') + 1
+        body = '\n'.join(lines[header + 1:]).strip()
+        try:
+            table = np.fromstring(body.replace('\n', ','), sep = ',') if body else np.zeros(0)
+        except ValueError:
+            # NumPy 2 raises on a malformed field instead of stopping the parse
+            return False
+        if(table.size % n_columns):
+            return False
+        table = table.reshape(-1, n_columns)[:, :5]
+        if(np.any(table[:, 0] < 0)):
+            print("Detected negative time stamp at " + self.path + " Deleting file...")
+            input("Press ENTER to continue")
+            os.remove(self.path)
+            return False
+        # The zero time stamps are the padding of the circular buffer
+        table = table[table[:, 0] != 0.]
+        self.count = len(table)
+        self.data[:, :self.count] = table.T
+        return True
+    
+    def read_run(self, path):
+        '''Read a binary run file (see run_format.py), memory mapped'''
+        run = load_run(path)
+        for header in self.header:
+            if(header in run.metadata):
+                if(isinstance(run.metadata[header], list)):
+                    # TODO: multiple frequency assessment
+                    return False
+                self.properties.update({header:str(run.metadata[header])})
+        columns = np.array([run[name] for name in DATA_COLUMNS])
+        # Same as the csv rows, the zero time stamps are not loaded
+        columns = columns[:, columns[0] != 0.]
+        self.count = columns.shape[1]
+        self.data[:, :self.count] = columns
         return True
     
     def check_csv_type(self):
@@ -271,42 +307,17 @@ class data_analysis():
             print('Multiple data type detected!')
             return False
     
-    def load_data(self, row, file):
-        '''Load a single row of data'''
-        if(float(row[0]) < 0):
-            print("Detected negative time stamp at " + self.path + " Deleting file...")
-            input("Press ENTER to continue")
-            file.close()
-            os.remove(self.path)
-            return
-        if(row[0] != '0.0'):
-            for i in range(5):
-                self.data[i][self.count] = float(row[i])
-            self.count += 1
-                
     def clean_data(self, file):
-        '''Returns an array with correct starting time stamp'''
-        temp_index = 0
-        time_stamp = self.data[0][0]
-        flag = True
-        for i in range(len(self.data[0])):
-            if(flag):
-                if(self.data[0][i] >= time_stamp):
-                    time_stamp = self.data[0][i]
-                else:
-                    flag = False
-                    temp_index = i
-                    time_stamp = self.data[0][i]
-                    for j in range(len(self.data[0])):
-                        self.data[0][j] -= time_stamp
-                    break
-                    
-        if(temp_index == 0 and time_stamp == 0):
+        '''Returns an array with correct starting time stamp. The older files
+        hold the whole circular buffer twice, rotated at the first decrease of
+        the time stamps, the newer ones only the recorded points in order.'''
+        if(self.count == 0):
             print('Empty file found at ' + self.dirc + '\\' + file + " Deleting file...")
             input("Press ENTER to continue")
             os.remove(self.path)
             raise FileNotFoundError
-        return self.data[:, temp_index : temp_index + int(self.count / 2)]
+        data = unroll(self.data[:, :self.count].T).T
+        return np.vstack((data[0] - data[0][0], data[1:]))
     
     def restore_figure(self, start_index = 0, end_index = -1):
         '''Restore the figure for the scan type data'''
@@ -318,13 +329,11 @@ class data_analysis():
         except KeyError:
             self.figure.suptitle('No special info'+self.extratitle)
         self.figure.canvas.manager.set_window_title(self.properties['file_name'])
-        axes[0, 0].plot(self.temp_data[0][0:len(self.temp_data[0]):5], 
-                        self.temp_data[1][0:len(self.temp_data[0]):5], 
+        axes[0, 0].plot(*decimate(self.temp_data[0], self.temp_data[1], axes_columns(axes[0, 0])), 
                         'b-', 
                         label = 'angle_time')
         axes[0, 0].legend(loc = 'upper left')
-        axes[1, 0].plot(self.temp_data[0][0:len(self.temp_data[0]):5], 
-                        self.temp_data[2][0:len(self.temp_data[0]):5], 
+        axes[1, 0].plot(*decimate(self.temp_data[0], self.temp_data[2], axes_columns(axes[1, 0])), 
                         'b-', 
                         label = 'position_time')
         axes[1, 0].legend(loc = 'upper left')
@@ -373,14 +382,10 @@ class data_analysis():
         return fft_angle, fft_position, fft_freq, avg
 
     def phase_rectify(self, phase):
-        '''Shifts the phase to be between 0.5 * pi and -1.5 * pi, which is symmetric abour -0.5*pi'''
-        phase = phase - 2 * np.pi * int(phase / (2 * np.pi))
-        if phase > 0.5 * np.pi:
-            return phase - 2 * np.pi
-        elif phase <= -1.5 * np.pi:
-            return phase + 2 * np.pi
-        else:
-            return phase
+        '''Shifts the phase to be between 0.5 * pi and -1.5 * pi, which is symmetric abour -0.5*pi,
+        phase is a number or an array'''
+        phase = phase - 2 * np.pi * np.trunc(phase / (2 * np.pi))
+        return phase - 2 * np.pi * (phase > 0.5 * np.pi) + 2 * np.pi * (phase <= -1.5 * np.pi)
     
     def phase_calc(self, fft_freq, omega, fft_angle, fft_pos, interpolation = True):
         '''Function borrowed from data_process.py, calculate the phase'''
@@ -429,27 +434,58 @@ class data_analysis():
                                maxfev = 2000000000)
         return popt, pcov
 
+    def window_dft(self, signals, bins, ends, lengths):
+        '''Return the fourier coefficient at the given bin of each row of signals,
+        over the window of the given length ending at each of ends. The full
+        windows are slid along the data with cumulative sums, the shorter ones
+        at the start of the data all begin at its first sample'''
+        spectrum = np.zeros((len(signals), len(ends)), dtype = complex)
+        full = lengths == self.fft_length
+        if(np.any(full)):
+            k, length, last = bins[full][0], self.fft_length, ends[full]
+            twiddle = np.exp(-2j * np.pi * k * np.arange(signals.shape[1]) / length)
+            sums = np.concatenate((np.zeros((len(signals), 1)), np.cumsum(signals * twiddle, axis = 1)), axis = 1)
+            spectrum[:, full] = (sums[:, last + 1] - sums[:, last + 1 - length]) \
+                * np.exp(2j * np.pi * k * (last + 1 - length) / length)
+        if(np.any(~full)):
+            k, length, last = bins[~full], lengths[~full], ends[~full]
+            j = np.arange(last.max() + 1)
+            kernel = np.exp(-2j * np.pi * np.outer(k / length, j)) * (j <= last[:, None])
+            spectrum[:, ~full] = signals[:, :len(j)] @ kernel.T
+        return spectrum
+
+    def rolling_phase(self, start_index = 0, end_index = -1):
+        '''Return the time stamps and the phases of the rolling fft of the data,
+        at each point of a uniform resampling between the two indices after the
+        first 5 s. The window ends at that point and holds the fft_length
+        previous points (all of them at the start). Only the bins around the
+        driving frequency are computed, as used by phase_calc, so that the cost
+        is linear in the length of the data'''
+        time = self.temp_data[0]
+        omega = float(self.properties['omega'])
+        step = max(self.sampling_div, np.median(np.diff(time))) if len(time) > 1 else self.sampling_div
+        end_time = time[:end_index][-1] if len(time[:end_index]) else time[0]
+        grid = time[0] + step * np.arange(int((end_time - time[0]) / step) + 1)
+        signals = np.array([np.interp(grid, time, self.temp_data[1]),
+                            np.interp(grid, time, self.temp_data[2])])
+        ends = np.flatnonzero((grid >= time[start_index]) & (grid - time[0] > 5))
+        lengths = np.minimum(ends + 1, self.fft_length)
+        # Bin of the driving frequency in each window, and its neighbour on the side of omega
+        position = omega * lengths * step
+        close = np.rint(position)
+        neighbour = close + np.sign(position - close)
+        delta_phase = [self.phase_rectify(np.angle(spectrum[0]) - np.angle(spectrum[1]) + np.pi)
+                       for spectrum in (self.window_dft(signals, bins, ends, lengths) for bins in (close, neighbour))]
+        phase = delta_phase[0] + np.abs(position - close) * (delta_phase[1] - delta_phase[0])
+        return grid[ends], phase / np.pi
+
     def scan_fft_plot(self, axs, start_index = 0, end_index = -1):
         '''Plot phase curve and fft on the axes objects'''
-        for i in range(len(self.temp_data[0][start_index:end_index])):
-            if(self.temp_data[0][i + start_index] - self.temp_data[0][0] > 5):
-                fft_angle, fft_position, fft_freq, avg = self.general_fft(
-                    self.temp_data[0][:i + start_index],
-                    self.temp_data[1][:i + start_index],
-                    self.temp_data[2][:i + start_index],
-                    self.fft_length,
-                    self.sampling_div
-                )
-                phase = self.phase_calc(
-                    fft_freq,
-                    float(self.properties['omega']),
-                    fft_angle,
-                    fft_position
-                )
-                self.phase_list.append(phase)
-                axs[1].plot(self.temp_data[0][i + start_index], phase, 'bo', markersize = 2)
         if(len(self.temp_data[0]) == 0):
             return
+        times, phases = self.rolling_phase(start_index, end_index)
+        self.phase_list += list(phases)
+        axs[1].plot(times, phases, 'bo', markersize = 2)
         fft_angle, fft_position, fft_freq, avg = self.general_fft(
             self.temp_data[0][start_index:end_index],
             self.temp_data[1][start_index:end_index],
@@ -530,7 +566,7 @@ class data_analysis():
                 pass
             plt.pause(2)
             plt.savefig(self.parent_path + '\\auto_scan_fit_pdf-%s-%s\\'%(self.parent_name_list[0], \
-                self.parent_name_list[1]) + self.properties['file_name'][:-4] + '.pdf', dpi = 600)
+                self.parent_name_list[1]) + self.properties['file_name'][:-4] + '.pdf', dpi = SAVE_DPI)
             plt.close('all')
             self.ax0.clear()
         else:
@@ -559,13 +595,13 @@ class data_analysis():
         except KeyError:
             self.figure.suptitle('No special info'+self.extratitle)
         self.figure.canvas.manager.set_window_title(self.properties['file_name'])
-        axes[0, 0].plot(self.temp_data[0][0:len(self.temp_data[0]):5], 
-                        self.temp_data[1][0:len(self.temp_data[0]):5], 
+        # The auto scan saves the figure, decimated to its resolution then
+        dpi = SAVE_DPI if auto_scan else None
+        axes[0, 0].plot(*decimate(self.temp_data[0], self.temp_data[1], axes_columns(axes[0, 0], dpi)), 
                         'b-', 
                         label = 'angle_time')
         axes[0, 0].legend(loc = 'upper left')
-        axes[1, 0].plot(self.temp_data[0][0:len(self.temp_data[0]):5], 
-                        self.temp_data[2][0:len(self.temp_data[0]):5], 
+        axes[1, 0].plot(*decimate(self.temp_data[0], self.temp_data[2], axes_columns(axes[1, 0], dpi)), 
                         'b-', 
                         label = 'position_time')
         axes[1, 0].legend(loc = 'upper left')
@@ -578,7 +614,7 @@ class data_analysis():
                 pass
             plt.pause(2)
             plt.savefig(self.parent_path + '\\auto_scan_pdf-%s-%s\\'%(self.parent_name_list[0], \
-                self.parent_name_list[1]) + file[:-4] + '.pdf', dpi = 600)
+                self.parent_name_list[1]) + file[:-4] + '.pdf', dpi = SAVE_DPI)
             plt.close('all')
             self.ax0.clear()
             exp_data = self.scan_process(axes, 30, self.temp_data[0][-1], 40, auto_scan = True)
@@ -691,8 +727,7 @@ class data_analysis():
             self.temp_data[2][start_index:end_index],
             self.fft_length,
             self.sampling_div)
-        axes[0].plot(self.temp_data[0],
-                     self.temp_data[1],
+        axes[0].plot(*decimate(self.temp_data[0], self.temp_data[1], axes_columns(axes[0])),
                      'b-', label = 'angle')
         axes[1].plot(fft_freq[0:int((len(fft_freq)+1)/2)],
                      abs(fft_angle[0:int((len(fft_freq)+1)/2)]),
@@ -1,15 +1,189 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from run_catalog import CATALOG_PATH, load_results
+
+REPORT_VERSION = 1 # Version of the plots, increase it when they change so that the reports are rendered again
+MANIFEST = 'report_manifest.json' # Hashes of the inputs of the rendered files, in the output directory
+PARAMETERS = ['Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos']
+KPIS = ['iae_angle', 'iae_position', 'max_angle_deviation', 'max_position_overshoot', 'control_effort_proxy']
+PLOTS = ('fitness_score_barplot', 'correlation_heatmap', 'pair_plot', 'parallel_coordinates_plot')
+
+_figures = {} # Figures reused by the renders of a process, by plot
+
+def figure(plot, figsize):
+    """Returns the cleared figure of a plot, created on first use in the process."""
+    import matplotlib.pyplot as plt
+    if plot not in _figures:
+        _figures[plot] = plt.figure(figsize=figsize)
+    fig = _figures[plot]
+    fig.clf()
+    return fig
+
+def render_plot(job):
+    """
+    Renders one plot of a report to a file. This is the task of the worker
+    processes of build_report.
+
+    Args:
+        job (tuple): The name of the plot (one of PLOTS), the runs, the
+            description of the runs for the titles and the output path.
+
+    Returns:
+        str: The output path.
+    """
+    plot, df, label, save_path = job
+    # Plotting libraries are imported here, they dominate the start-up time.
+    # The plots are only saved, Agg renders them without a display.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if plot == 'fitness_score_barplot':
+        fig = figure(plot, (10, 6))
+        ax = fig.add_subplot()
+        sns.barplot(x=df.index, y='fitness_score', data=df, palette='viridis', order=df.index, ax=ax)
+        ax.set_title(f'{label} by Fitness Score')
+        ax.set_xlabel('Rank')
+        ax.set_ylabel('Fitness Score')
+    elif plot == 'correlation_heatmap':
+        fig = figure(plot, (12, 10))
+        ax = fig.add_subplot()
+        cols_for_corr = [col for col in PARAMETERS + KPIS + ['fitness_score'] if col in df.columns]
+        sns.heatmap(df[cols_for_corr].corr(), annot=True, cmap='coolwarm', fmt=".2f", ax=ax)
+        ax.set_title(f'Correlation Heatmap of {label}')
+    elif plot == 'pair_plot':
+        # The pair plot makes its own figure
+        pairplot_cols = [col for col in PARAMETERS + ['fitness_score'] if col in df.columns]
+        grid = sns.pairplot(df[pairplot_cols], diag_kind='kde')
+        grid.figure.suptitle(f'Pair Plot of PID Parameters and Fitness Score ({label})', y=1.02)
+        grid.figure.savefig(save_path)
+        plt.close(grid.figure)
+        return save_path
+    elif plot == 'parallel_coordinates_plot':
+        fig = figure(plot, (12, 7))
+        ax = fig.add_subplot()
+        parallel_coords_cols = [col for col in PARAMETERS + ['fitness_score'] if col in df.columns]
+        pd.plotting.parallel_coordinates(df[parallel_coords_cols], 'fitness_score', colormap='viridis', ax=ax)
+        ax.set_title(f'Parallel Coordinates Plot of {label}')
+        ax.set_xlabel('Parameters')
+        ax.set_ylabel('Value')
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.grid(True)
+    else:
+        raise ValueError(f"Unknown plot '{plot}', expected one of {PLOTS}")
+    fig.tight_layout()
+    fig.savefig(save_path)
+    return save_path
+
+def select_runs(file_path, limit=5, where=None, group_by=None, profile=None):
+    """
+    Selects the runs of the reports from the run catalog or a results CSV file.
 
-def analyze_pid_data(file_path):
+    Args:
+        file_path (str): The path to the run catalog or the CSV file.
+        limit (int): The number of best runs, per group if group_by is set,
+            all if None.
+        where (str): A filter of the runs, as a pandas query on their
+            columns, e.g. "pid_set == 'pid_set_3' and Kd > 3".
+        group_by (str): A column whose values each get their report, e.g.
+            'data_set' or the 'cluster' column of pca.perform_pca_and_clustering.
+        profile (str): The scoring profile ranking the runs (see
+            data_analysis.SCORING_PROFILES), the stored fitness scores if None.
+
+    Returns:
+        dict: The runs ranked by fitness score, by subset name ('top' or
+            '<group_by>_<value>').
+    """
+    # The catalog only returns the best runs when they are not filtered first
+    df = load_results(file_path, limit=limit if where is None and group_by is None else None, profile=profile)
+    if where is not None:
+        df = df.query(where)
+    df = df.sort_values(by='fitness_score')
+    if group_by is None:
+        return {'top': df if limit is None else df.head(limit)}
+    return {f'{group_by}_{value}': group if limit is None else group.head(limit)
+            for value, group in df.groupby(group_by, sort=True, dropna=False)}
+
+def input_hash(plot, df, label):
+    """Hash of what a rendered file depends on, to skip it when unchanged."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{REPORT_VERSION}\n{plot}\n{label}\n'.encode())
+    digest.update(df.to_csv().encode())
+    return digest.hexdigest()
+
+def build_report(file_path, limit=5, where=None, group_by=None, profile=None,
+                 output_dir='analysis_results', workers=None, force=False):
     """
-    Analyzes PID controller data from a CSV file to find the top 5 parameter sets
-    and generates several visualizations.
+    Generates the reports of the best parameter sets without a display: the
+    bar plot of the fitness scores, the correlation heatmap, the pair plot,
+    the parallel coordinates and the CSV table of the runs. The plots are
+    rendered in parallel, and only those whose runs changed since the last
+    report in output_dir.
 
     Args:
-        file_path (str): The path to the CSV file.
+        file_path (str): The path to the run catalog or the CSV file.
+        limit, where, group_by, profile: The selection of the runs, see
+            select_runs. Each group is reported in its own subdirectory.
+        output_dir (str): The directory of the reports.
+        workers (int): The number of processes, one per CPU if None, and no
+            pool at all if 1.
+        force (bool): Whether to render the unchanged plots again.
+
+    Returns:
+        dict: The runs of each report, see select_runs.
+    """
+    subsets = select_runs(file_path, limit, where, group_by, profile)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    jobs, hashes = [], {}
+    for name, df in subsets.items():
+        subset_dir = output_dir if name == 'top' else os.path.join(output_dir, name)
+        os.makedirs(subset_dir, exist_ok=True)
+        df = df.reset_index(drop=True)
+        label = f'Top {len(df)} Parameter Sets' + ('' if name == 'top' else f' of {name}')
+        df.to_csv(os.path.join(subset_dir, f'top_{len(df)}_parameter_sets.csv'), index=False)
+        if len(df) < 2:
+            print(f"Skipping the plots of {name}, it has fewer than 2 runs.")
+            continue
+        for plot in PLOTS:
+            save_path = os.path.join(subset_dir, plot + '.png')
+            hashes[save_path] = input_hash(plot, df, label)
+            if manifest.get(save_path) != hashes[save_path] or not os.path.exists(save_path):
+                jobs.append((plot, df, label, save_path))
+
+    print(f"Rendering {len(jobs)} plots, {len(hashes) - len(jobs)} unchanged...")
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        rendered = list(map(render_plot, jobs))
+    else:
+        with ProcessPoolExecutor(min(workers, len(jobs))) as executor:
+            rendered = list(executor.map(render_plot, jobs))
+    manifest.update((save_path, hashes[save_path]) for save_path in rendered)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return subsets
+
+def analyze_pid_data(file_path, profile=None, limit=5, where=None, group_by=None, workers=None):
+    """
+    Analyzes PID controller data from the run catalog or a CSV file to find
+    the top parameter sets and generates several visualizations, see
+    build_report.
+
+    Args:
+        file_path (str): The path to the run catalog or the CSV file.
+        profile (str): The scoring profile ranking the runs (see
+            data_analysis.SCORING_PROFILES), the stored fitness scores if None.
+        limit, where, group_by: The selection of the runs, see select_runs.
+        workers (int): The number of processes rendering the plots.
     """
     # --- Data Loading and Processing ---
     # Check if the file exists
@@ -17,77 +191,18 @@ def analyze_pid_data(file_path):
         print(f"Error: The file '{file_path}' was not found.")
         return
 
-    # Read the CSV data from the file into a pandas DataFrame
+    output_dir = "analysis_results"
     try:
-        df = pd.read_csv(file_path)
+        subsets = build_report(file_path, limit, where, group_by, profile, output_dir, workers)
     except Exception as e:
-        print(f"Error reading the CSV file: {e}")
+        print(f"Error generating the report: {e}")
         return
 
-    # Sort the DataFrame by 'fitness_score' in ascending order to find the best-performing sets
-    # and select the top 5.
-    df_sorted = df.sort_values(by='fitness_score').head(5)
-
-    print("--- Top 5 Parameter Sets ---")
-    print(df_sorted)
-    print("\nGenerating visualizations...")
+    for name, df in subsets.items():
+        print(f"--- Top {len(df)} Parameter Sets{'' if name == 'top' else ' of ' + name} ---")
+        print(df)
 
-    # Create a directory for the output plots if it doesn't exist
-    output_dir = "analysis_results"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    # --- Visualizations ---
-
-    # 1. Bar chart of Fitness Score
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x=df_sorted.index, y='fitness_score', data=df_sorted, palette='viridis', order=df_sorted.index)
-    plt.title('Top 5 Parameter Sets by Fitness Score')
-    plt.xlabel('Original Index from CSV')
-    plt.ylabel('Fitness Score')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'fitness_score_barplot.png'))
-
-    # 2. Correlation Heatmap
-    plt.figure(figsize=(12, 10))
-    cols_for_corr = [
-        'Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos',
-        'iae_angle', 'iae_position', 'max_angle_deviation',
-        'max_position_overshoot', 'control_effort_proxy', 'fitness_score'
-    ]
-    # Filter out columns that are not in the dataframe to prevent errors
-    cols_for_corr = [col for col in cols_for_corr if col in df_sorted.columns]
-    correlation_matrix = df_sorted[cols_for_corr].corr()
-    sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', fmt=".2f")
-    plt.title('Correlation Heatmap of Top 5 Parameter Sets')
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'correlation_heatmap.png'))
-
-
-    # 3. Pair Plot
-    pairplot_cols = ['Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos', 'fitness_score']
-    pairplot_cols = [col for col in pairplot_cols if col in df_sorted.columns]
-    sns.pairplot(df_sorted[pairplot_cols], diag_kind='kde')
-    plt.suptitle('Pair Plot of PID Parameters and Fitness Score (Top 5 Sets)', y=1.02)
-    plt.savefig(os.path.join(output_dir, 'pair_plot.png'))
-
-    # 4. Parallel Coordinates Plot
-    plt.figure(figsize=(12, 7))
-    parallel_coords_cols = ['Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos', 'fitness_score']
-    parallel_coords_cols = [col for col in parallel_coords_cols if col in df_sorted.columns]
-    pd.plotting.parallel_coordinates(df_sorted[parallel_coords_cols], 'fitness_score', colormap='viridis')
-    plt.title('Parallel Coordinates Plot of Top 5 Parameter Sets')
-    plt.xlabel('Parameters')
-    plt.ylabel('Value')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'parallel_coordinates_plot.png'))
-
-    # --- Save Top 5 Data ---
-    df_sorted.to_csv(os.path.join(output_dir, 'top_5_parameter_sets.csv'), index=False)
-
-    print(f"\nAnalysis complete. All plots and the top 5 data CSV have been saved in the '{output_dir}' directory.")
+    print(f"\nAnalysis complete. All plots and the top data CSV have been saved in the '{output_dir}' directory.")
 
 
 if __name__ == '__main__':
@@ -97,6 +212,13 @@ if __name__ == '__main__':
     # Or on Linux/Mac: '/home/youruser/data/pid_results.csv'
     # -------------------------------------------------------------------
     csv_file_location = 'pid_analysis_results.csv'
+    # The run catalog of data_analysis.py is queried directly when it exists
+    if os.path.exists(CATALOG_PATH):
+        csv_file_location = CATALOG_PATH
+    scoring_profile = None # e.g. 'angle' to rank the runs with another profile of data_analysis.SCORING_PROFILES
+    top_n = 5 # Number of best runs reported, per group if group_by is set
+    run_filter = None # e.g. "data_set == 'cart_pendulum_data_4'", a pandas query on the runs
+    group_by = None # e.g. 'pid_set' for a report per PID set
 
     # Create a dummy CSV for demonstration purposes if it doesn't exist
     if not os.path.exists(csv_file_location):
@@ -114,4 +236,4 @@ if __name__ == '__main__':
         with open(csv_file_location, 'w') as f:
             f.write(dummy_data)
 
-    analyze_pid_data(csv_file_location)
\ No newline at end of file
+    analyze_pid_data(csv_file_location, scoring_profile, top_n, run_filter, group_by)
\ No newline at end of file
@@ -0,0 +1,234 @@
+'''Converts and validates the legacy csv exports into binary run files (see
+run_format.py) and registers them in the run catalog (see run_catalog.py).
+
+The folders cart_pendulum_data*/<set>/DD-MM-csv are walked, and each run is
+converted by a pool of processes together with its DD-MM-fft-csv and
+DD-MM-phase_amp-csv tables, into DD-MM-run/<module>-H-M-S.npz which the
+analysis then reads instead of the csv file (see run_format.unique_runs).
+The reference_parameters-*.csv files of auto_freq_scan are converted too.
+
+Each csv file is parsed once. The zero padding and the mirrored half of the
+circular buffer of the older exports are dropped and a wrapped buffer is put
+back in chronological order. The time stamps must increase and the metadata of
+the module must be present, runs failing these checks are still converted but
+their issues are reported and kept in the catalog.
+
+The conversion is resumable and idempotent: the sources already converted,
+with the same size and modification time, are skipped, and each output file is
+written under a temporary name and renamed once complete.
+
+Usage: python legacy_converter.py [base_directory] [--workers N] [--compress] [--force]'''
+import numpy as np
+import csv, glob, json, os, re, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_format import save_run, binary_twin, DATA_COLUMNS, FFT_COLUMNS, PHASE_AMP_COLUMNS
+from run_archive import read_csv_table, parse_metadata, is_number, unroll
+
+DATA_FOLDERS = 'cart_pendulum_data*' # Pattern of the data folders in the base directory
+REFERENCE_PATTERN = os.path.join('auto_freq_scan', 'reference_parameters-*.csv')
+RUN_FOLDER = re.compile(r'^\d\d-\d\d-csv$') # DD-MM-csv, the folders of the runs
+PID_KEYS = ('Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos')
+WORKERS = None # Processes of the pool, one per CPU by default
+
+def table_twin(csv_path, kind):
+    '''Path of the fft or phase_amp table exported with a run, None if missing'''
+    dirc, file = os.path.split(csv_path)
+    path = os.path.join(dirc[:-len('-csv')] + '-' + kind + '-csv', kind + '-' + file)
+    return path if os.path.exists(path) else None
+
+def read_typed_table(path):
+    '''Reads a small csv table with a header line, after the metadata lines if
+    any. The columns are float, complex (the fft tables) or text.'''
+    with open(path, 'r', newline = '') as file:
+        lines = list(csv.reader(file))
+    lines = [line for line in lines if line]
+    header = max(i for i, line in enumerate(lines) if not is_number(line[0]))
+    columns = {}
+    rows = lines[header + 1:]
+    for j, name in enumerate(lines[header]):
+        values = [row[j] if j < len(row) else '' for row in rows]
+        for kind in (float, complex):
+            try:
+                columns[name] = np.array([kind(value) for value in values])
+                break
+            except ValueError:
+                continue
+        else:
+            columns[name] = np.array(values)
+    return [','.join(line) for line in lines[:header]], columns
+
+def validate(module, metadata, data):
+    '''Returns the list of the issues of a converted run'''
+    issues = []
+    if(len(data) == 0):
+        issues.append('no samples')
+        return issues
+    steps = np.diff(data[:, 0])
+    if(np.any(steps < 0)):
+        issues.append('time decreases at %d rows' % np.count_nonzero(steps < 0))
+    elif(np.any(steps == 0)):
+        issues.append('time repeats at %d rows' % np.count_nonzero(steps == 0))
+    required = ['start_time']
+    if(module == 'pid'):
+        required += PID_KEYS
+    elif(module not in ('measure', 'setSpeed', 'center')):
+        required.append('omega')
+    missing = [key for key in required if key not in metadata and 'multiple_' + key not in metadata]
+    if(missing):
+        issues.append('missing metadata: ' + ', '.join(missing))
+    return issues
+
+def convert_run(csv_path, compress = False):
+    '''Converts a run with its tables, returns a result dictionary with the
+    output path, the metadata, the issues and the KPIs'''
+    lines, columns, data = read_csv_table(csv_path)
+    if(tuple(columns) != DATA_COLUMNS):
+        raise ValueError('unexpected columns ' + ','.join(columns))
+    data = unroll(data)
+    metadata = parse_metadata(lines)
+    module = os.path.basename(csv_path).rsplit('-', 3)[0]
+    metadata.update(module = module, sample_count = len(data), source = csv_path)
+    sources = [csv_path]
+    fft = phase_amp = None
+    fft_path = table_twin(csv_path, 'fft')
+    if(fft_path is not None):
+        _, table = read_typed_table(fft_path)
+        fft = dict(zip(FFT_COLUMNS, table.values()))
+        sources.append(fft_path)
+    phase_amp_path = table_twin(csv_path, 'phase_amp')
+    if(phase_amp_path is not None):
+        _, table = read_typed_table(phase_amp_path)
+        phase_amp = dict(zip(PHASE_AMP_COLUMNS, table.values()))
+        sources.append(phase_amp_path)
+    issues = validate(module, metadata, data)
+    metadata['issues'] = issues
+    output = binary_twin(csv_path)
+    os.makedirs(os.path.dirname(output), exist_ok = True)
+    temp = output[:-len('.npz')] + '.tmp.npz'
+    save_run(temp, metadata, dict(zip(DATA_COLUMNS, data.T)), fft, phase_amp, compress = compress)
+    os.replace(temp, output)
+    kpis = None
+    if(module == 'pid' and len(data) >= 2):
+        import pandas as pd
+        from run_catalog import run_kpis
+        kpis = run_kpis(metadata, pd.DataFrame(dict(zip(DATA_COLUMNS, data.T))))
+    return {'sources': sources, 'output': output, 'metadata': metadata, 'issues': issues, 'kpis': kpis}
+
+def convert_reference(csv_path, compress = False):
+    '''Converts a reference_parameters file of auto_freq_scan'''
+    lines, table = read_typed_table(csv_path)
+    metadata = dict(parse_metadata(lines), module = 'reference_parameters', source = csv_path,
+                    sample_count = len(next(iter(table.values()), [])))
+    issues = [] if table else ['no table']
+    metadata['issues'] = issues
+    output = binary_twin(csv_path)
+    temp = output[:-len('.npz')] + '.tmp.npz'
+    save_run(temp, metadata, table, compress = compress)
+    os.replace(temp, output)
+    return {'sources': [csv_path], 'output': output, 'metadata': metadata, 'issues': issues, 'kpis': None}
+
+def convert(job):
+    '''Worker of the pool, job is (kind, csv path, compress). Errors are
+    returned rather than raised so that one bad file does not stop the pool.'''
+    kind, csv_path, compress = job
+    try:
+        if(kind == 'reference'):
+            return convert_reference(csv_path, compress)
+        return convert_run(csv_path, compress)
+    except Exception as error:
+        return {'sources': [csv_path], 'output': None, 'error': '%s: %s' % (type(error).__name__, error)}
+
+def find_sources(base_directory = '.'):
+    '''The (kind, csv path) of all the legacy files to convert'''
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(base_directory, DATA_FOLDERS, '**', '*.csv'), recursive = True)):
+        if(RUN_FOLDER.match(os.path.basename(os.path.dirname(path)))):
+            jobs.append(('run', path))
+    for path in sorted(glob.glob(os.path.join(base_directory, REFERENCE_PATTERN))):
+        jobs.append(('reference', path))
+    return jobs
+
+def source_state(path):
+    '''Size and modification time of a source, which identify its version'''
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+def connect_conversions(catalog_path):
+    '''The run catalog with the table of the converted sources'''
+    from run_catalog import connect
+    connection = connect(catalog_path)
+    connection.execute('''CREATE TABLE IF NOT EXISTS conversions (
+        source TEXT PRIMARY KEY, size INTEGER, mtime REAL, output TEXT, status TEXT, issues TEXT)''')
+    connection.commit()
+    return connection
+
+def pending(jobs, connection, force = False):
+    '''Drops the jobs whose sources were converted already and did not change'''
+    done = {row['source']: row for row in connection.execute('SELECT * FROM conversions')}
+    todo = []
+    for kind, path in jobs:
+        sources = [path] + [twin for twin in (table_twin(path, 'fft'), table_twin(path, 'phase_amp'))
+                            if kind == 'run' and twin is not None]
+        rows = [done.get(os.path.abspath(source)) for source in sources]
+        up_to_date = all(row is not None and row['status'] != 'failed'
+                         and (row['size'], row['mtime']) == source_state(source)
+                         and os.path.exists(row['output']) for source, row in zip(sources, rows))
+        if(force or not up_to_date):
+            todo.append((kind, path))
+    return todo
+
+def record(connection, result):
+    '''Registers the result of a conversion in the catalog'''
+    from run_catalog import catalog_row, upsert, file_hash
+    output = result['output']
+    if(output is None):
+        status, issues = 'failed', [result['error']]
+    else:
+        status, issues = 'issues' if result['issues'] else 'ok', result['issues']
+        # The binary twin replaces the sources in the catalog, see run_format.unique_runs
+        connection.executemany('DELETE FROM runs WHERE file_path = ?',
+                               [(os.path.abspath(source),) for source in result['sources']])
+        upsert(connection, [catalog_row(output, result['metadata'], result['kpis'], file_hash(output))])
+    connection.executemany('INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?)',
+        [(os.path.abspath(source), *source_state(source), output and os.path.abspath(output),
+          status, json.dumps(issues)) for source in result['sources']])
+    connection.commit()
+    return status
+
+def main(args):
+    from run_catalog import CATALOG_PATH
+    base_directory = '.'
+    workers, compress, force = WORKERS, False, False
+    i = 0
+    while(i < len(args)):
+        if(args[i] == '--workers'):
+            i += 1
+            workers = int(args[i])
+        elif(args[i] == '--compress'):
+            compress = True
+        elif(args[i] == '--force'):
+            force = True
+        else:
+            base_directory = args[i]
+        i += 1
+    connection = connect_conversions(CATALOG_PATH or 'run_catalog.sqlite')
+    jobs = find_sources(base_directory)
+    todo = pending(jobs, connection, force)
+    print("%d legacy files found, %d to convert" % (len(jobs), len(todo)))
+    counts = {'ok': 0, 'issues': 0, 'failed': 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(convert, (kind, path, compress)) for kind, path in todo]
+        for n, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            status = record(connection, result)
+            counts[status] += 1
+            if(status != 'ok'):
+                print("%s %s: %s" % (status, result['sources'][0], '; '.join(result.get('issues') or [result.get('error')])))
+            if(n % 20 == 0 or n == len(futures)):
+                print("%d/%d converted, %.1f s" % (n, len(futures), time.perf_counter() - start))
+    connection.close()
+    print("%(ok)d converted, %(issues)d converted with issues, %(failed)d failed" % counts)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
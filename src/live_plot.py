@@ -0,0 +1,224 @@
+'''Helpers for the non-blocking live plots drawn in data_process.py'''
+import numpy as np
+import time
+
+ANGLE_ROTATION = 55 # Rotation of the y-label
+PLOT_FPS = 15 # Target refresh rate of the live plots
+RENDER_BUDGET = 0.5 # Maximum fraction of the main thread time spent rendering
+HYSTERESIS = 0.25 # Fraction of the data span added around the data when an axis is rescaled
+SHRINK_RATIO = 0.4 # Rescale when the data fills less than this fraction of the view
+
+class blit_renderer():
+
+    '''Renders a live figure by blitting. The static part of the figure (axes,
+    ticks, labels, legends) is drawn once and cached as a background, every
+    frame only restores the background and redraws the lines and texts.
+
+    The axis limits are only changed when the data leaves the current view,
+    or fills too little of it, and a margin is added around the data when this
+    happens. Only then the whole figure is redrawn and the background cached again.'''
+
+    def __init__(self, figure, ax_dict, texts = ()):
+        '''ax_dict is the ax_new_list of the data class, i.e. a dictionary of
+        axes to a line or a list/tuple of lines drawn on that axes'''
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.background = None
+        self.flag_redraw = True
+        self.ax_lines = {}
+        for ax, lines in ax_dict.items():
+            if(not isinstance(lines, (list, tuple))):
+                lines = (lines,)
+            self.ax_lines[ax] = list(lines)
+        self.texts = list(texts)
+        self.title = None
+        self.fixed_xlim = set() # axes whose x limits are set by set_xlim() only
+        # Axes sharing the x axis (twinx) are rescaled together from all their lines
+        self.x_groups = []
+        grouped = set()
+        for ax in self.ax_lines:
+            if(ax in grouped):
+                continue
+            siblings = [sib for sib in ax.get_shared_x_axes().get_siblings(ax) \
+                if sib in self.ax_lines]
+            grouped.update(siblings)
+            self.x_groups.append(siblings)
+        for artist in self.artists():
+            artist.set_animated(True)
+        for ax in self.ax_lines:
+            ax.set_autoscale_on(False)
+            ax.tick_params(axis = 'y', labelrotation = ANGLE_ROTATION)
+        self.cid = self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def artists(self):
+        '''All the artists that are redrawn every frame'''
+        artists = []
+        for lines in self.ax_lines.values():
+            artists.extend(lines)
+        return artists + self.texts
+
+    def on_draw(self, event):
+        '''Cache the background after every full draw, e.g. resizing of the window'''
+        if(event is not None and event.canvas != self.canvas):
+            return
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists():
+            self.figure.draw_artist(artist)
+
+    def set_title(self, title):
+        '''Change the suptitle, which is part of the background'''
+        if(title != self.title):
+            self.title = title
+            self.figure.suptitle(title)
+            self.flag_redraw = True
+
+    def set_xlim(self, ax, low, high):
+        '''Fix the x limits of an axes (and its twins) instead of autoscaling'''
+        for sib in ax.get_shared_x_axes().get_siblings(ax):
+            self.fixed_xlim.add(sib)
+        if(tuple(ax.get_xlim()) != (low, high)):
+            ax.set_xlim(low, high)
+            self.flag_redraw = True
+
+    def data_range(self, lines, axis):
+        '''Returns the finite (min, max) of the lines data, None if no data'''
+        low, high = np.inf, -np.inf
+        for line in lines:
+            values = np.asarray(line.get_xdata() if axis == 'x' else line.get_ydata(), dtype = float)
+            if(values.size == 0):
+                continue
+            values = values[np.isfinite(values)]
+            if(values.size == 0):
+                continue
+            low = min(low, values.min())
+            high = max(high, values.max())
+        if(low > high):
+            return None
+        return low, high
+
+    def rescale(self, current, data_range, lead = False):
+        '''Returns the new limits if the data has left the current limits or
+        fills less than SHRINK_RATIO of it, None otherwise. With lead = True
+        the whole margin is put after the data, used for the time axes.'''
+        low, high = data_range
+        cur_low, cur_high = min(current), max(current)
+        span = high - low
+        if(span == 0):
+            # Constant data, e.g. a cart velocity of zero
+            span = abs(high) if high != 0 else 1.
+        if(low >= cur_low and high <= cur_high \
+            and span >= SHRINK_RATIO * (cur_high - cur_low)):
+            return None
+        if(lead):
+            return low, high + 2 * HYSTERESIS * span
+        return low - HYSTERESIS * span, high + HYSTERESIS * span
+
+    def autoscale(self):
+        '''Rescale the axes with hysteresis, returns True if any limit changed'''
+        changed = False
+        for group in self.x_groups:
+            if(group[0] in self.fixed_xlim):
+                continue
+            lines = [line for ax in group for line in self.ax_lines[ax]]
+            data_range = self.data_range(lines, 'x')
+            if(data_range is None):
+                continue
+            new_lim = self.rescale(group[0].get_xlim(), data_range, lead = True)
+            if(new_lim is not None):
+                group[0].set_xlim(*new_lim)
+                changed = True
+        for ax, lines in self.ax_lines.items():
+            data_range = self.data_range(lines, 'y')
+            if(data_range is None):
+                continue
+            new_lim = self.rescale(ax.get_ylim(), data_range)
+            if(new_lim is not None):
+                ax.set_ylim(*new_lim)
+                changed = True
+        return changed
+
+    def update(self):
+        '''Draws a frame, blitting unless the background has to be redrawn'''
+        if(self.autoscale()):
+            self.flag_redraw = True
+        if(self.flag_redraw or self.background is None or not self.canvas.supports_blit):
+            self.flag_redraw = False
+            # on_draw() caches the new background and draws the animated artists
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+        self.canvas.blit(self.figure.bbox)
+        self.canvas.flush_events()
+
+    def release(self):
+        '''Stop blitting and make the artists part of a normal draw again,
+        e.g. before saving the figure'''
+        self.canvas.mpl_disconnect(self.cid)
+        for artist in self.artists():
+            artist.set_animated(False)
+
+class render_scheduler():
+
+    '''Paces the frames of the live plot at a fixed rate, independent of how
+    fast the main loop spins or which module is running. Late frames are
+    dropped instead of being caught up, and the time spent rendering is kept
+    below RENDER_BUDGET so that the acquisition and the online estimation
+    in the main loop keep running at full rate.'''
+
+    def __init__(self, fps = PLOT_FPS, budget = RENDER_BUDGET):
+        self.period = 1. / fps
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.next_frame = 0.
+        self.frame_start = 0.
+        self.last_frame = None
+        self.frames = 0
+        self.dropped = 0
+        self.fps = 0. # Achieved frame rate, exponentially averaged
+        self.render_time = 0. # Render time of the last frame in seconds
+        self.total_render_time = 0.
+
+    def due(self):
+        '''Returns True if a frame should be drawn now'''
+        return time.perf_counter() >= self.next_frame
+
+    def begin(self):
+        self.frame_start = time.perf_counter()
+
+    def end(self):
+        '''Records the frame and schedules the next one'''
+        now = time.perf_counter()
+        self.render_time = now - self.frame_start
+        self.total_render_time += self.render_time
+        self.frames += 1
+        if(self.last_frame is None):
+            self.next_frame = self.frame_start + self.period
+        else:
+            interval = self.frame_start - self.last_frame
+            if(interval > 0):
+                self.fps = 1. / interval if self.fps == 0 else 0.9 * self.fps + 0.1 / interval
+            self.next_frame += self.period
+        self.last_frame = self.frame_start
+        if(self.next_frame < now):
+            # Under load, skip the frames that are already late
+            missed = int((now - self.next_frame) / self.period) + 1
+            self.dropped += missed
+            self.next_frame += missed * self.period
+        # Keep the rendering within its share of the main loop
+        self.next_frame = max(self.next_frame, now + self.render_time * (1. / self.budget - 1.))
+
+    def report(self):
+        '''Achieved frame rate and render time of the last frame'''
+        return 'fps: %.1f  render: %.1f ms  dropped: %d' % (self.fps, 1000 * self.render_time, self.dropped)
+
+    def summary(self):
+        if(self.frames == 0):
+            return 'No frame rendered'
+        return '%d frames, %.1f fps, %.1f ms per frame on average, %d dropped' % \
+            (self.frames, self.fps, 1000 * self.total_render_time / self.frames, self.dropped)
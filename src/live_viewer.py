@@ -0,0 +1,109 @@
+'''Live viewer running in its own process. It attaches to the shared memory
+published by the acquisition process (started with --shm or CARTER_SHM=1)
+and draws the usual live plot, so that the rendering never competes with
+thread_reader for the GIL. Several viewers can watch the same run, each of
+them detaches when its window is closed.
+
+Usage: python live_viewer.py [shared memory name]'''
+import numpy as np
+import sys, time
+import data_process
+from data_process import live_data
+from shared_buffer import shm_reader, SHM_NAME
+
+# The viewer draws the live plot, even if CARTER_SHM=1 makes the acquisition headless
+data_process.HEADLESS = False
+POLL_PERIOD = 0.01 # Waiting time of the viewer loop in seconds
+ATTACH_PERIOD = 0.5 # Waiting time between two attempts to attach to a run
+
+class viewer_data(live_data):
+
+    '''live_data filled from the shared memory snapshots instead of a data object'''
+
+    def __init__(self):
+        super().__init__(fft_length = 512, sampling_div = 0.04, wait_to_stable = 1)
+        self.publisher = None # Never publish back, even with CARTER_SHM=1
+        self.dashboard = None
+        self.flag_exit = False
+        self.flag_end_run = False
+
+    def load(self, snapshot):
+        '''Copies a snapshot of shared_buffer.shm_reader into the data arrays.
+        The ring is mirrored like the circular buffer of the data class.'''
+        ring = snapshot['ring']
+        buffer_length = ring.shape[1]
+        if(buffer_length != self.buffer_length or snapshot['fft_length'] != self.fft_length):
+            self.buffer_length = buffer_length
+            self.fft_length = snapshot['fft_length']
+            self.clear_data()
+        mirrored = np.concatenate((ring, ring), axis = 1)
+        self.time, self.angle, self.position, self.angular_velocity, self.position_velocity = mirrored
+        self.index = snapshot['index']
+        self.temp_index = snapshot['temp_index']
+        self.omega = float(snapshot['omega'])
+        self.amp = float(snapshot['amp'])
+        self.amp_0 = float(snapshot['amp_0'])
+        self.start_time = float(snapshot['start_time'])
+        self.avg_spacing = float(snapshot['avg_spacing'])
+        self.sampling_div = float(snapshot['sampling_div'])
+        if(len(snapshot['phase'])):
+            self.phase_list = [tuple(row) for row in snapshot['phase']]
+        if(len(snapshot['amp_list'])):
+            self.amp_list = [tuple(row) for row in snapshot['amp_list']]
+        if(snapshot['phase_active'] is not None):
+            self.phase_list_active = [tuple(row) for row in snapshot['phase_active']]
+        meta = snapshot['meta']
+        self.module_name = meta.get('module_name', '')
+        self.pid_param = meta.get('pid_param') or 'r'
+        self.setSpeed_param = meta.get('setSpeed_param')
+
+    def end_run(self):
+        '''Closes the figure of a run that is over, without ending the viewer'''
+        self.flag_end_run = True
+        self.clear_figure()
+        self.flag_end_run = False
+
+    def handle_close(self, event):
+        '''Closing the window by hand ends the viewer'''
+        if(not self.flag_end_run):
+            self.flag_exit = True
+        super().handle_close(event)
+
+    def save_snapshot(self):
+        '''The acquisition process saves the figure, not the viewers'''
+        pass
+
+def main(name = SHM_NAME):
+    reader = shm_reader(name)
+    datum = viewer_data()
+    print("Waiting for the run '" + name + "'... (Press Ctrl+C to exit)")
+    try:
+        while(not datum.flag_exit):
+            if(not reader.attach()):
+                time.sleep(ATTACH_PERIOD)
+                continue
+            snapshot = reader.snapshot() if datum.scheduler.due() else None
+            if(snapshot is None):
+                if(datum.renderer is not None):
+                    datum.figure.canvas.flush_events()
+                time.sleep(POLL_PERIOD)
+                continue
+            if(snapshot['closed']):
+                # The run is over, wait for the next one
+                reader.detach()
+                datum.end_run()
+                print("Run ended, waiting for the next one...")
+                continue
+            datum.load(snapshot)
+            if(datum.module_name == ""):
+                continue
+            scan = snapshot['phase_active'] is None
+            datum.init_plot(datum.module_name, scan = scan)
+            datum.real_time_plot(datum.module_name, scan = scan)
+    except KeyboardInterrupt:
+        pass
+    reader.detach()
+    datum.close_figure()
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else SHM_NAME)
@@ -1,35 +1,170 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 import os
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from run_catalog import CATALOG_PATH, load_results
 
-def perform_pca_and_clustering(file_path, n_clusters=4):
+K_RANGE = range(1, 11) # Cluster counts tried by select_k
+MINIBATCH_ROWS = 10000 # Runs from which MiniBatchKMeans replaces KMeans
+SILHOUETTE_SAMPLE = 5000 # Runs sampled to compute the silhouette score of large tables
+GAP_REFERENCES = 5 # Uniform reference data sets of the gap statistic
+RANDOM_STATE = 42
+
+def make_kmeans(k, n_rows):
+    """Returns a K-Means estimator, mini-batch for the large run tables."""
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    if n_rows >= MINIBATCH_ROWS:
+        return MiniBatchKMeans(n_clusters=k, random_state=RANDOM_STATE, n_init=3, batch_size=1024)
+    return KMeans(n_clusters=k, random_state=RANDOM_STATE, n_init=10)
+
+def fit_k(scaled_data, k, gap=False):
     """
-    Performs PCA and K-Means clustering on PID controller data from a CSV file.
+    Fits K-Means with k clusters and evaluates the clustering. This is the
+    task of the worker processes of select_k.
 
     Args:
-        file_path (str): The path to the CSV file.
-        n_clusters (int): The number of clusters to form.
+        scaled_data (np.ndarray): The standardized features, one row per run.
+        k (int): The number of clusters.
+        gap (bool): Whether to also cluster the reference data sets of the
+            gap statistic, GAP_REFERENCES more fits.
+
+    Returns:
+        dict: The fitted model, its inertia (SSE), its silhouette score (NaN
+            for a single cluster) and, with gap, the log inertias of the gap
+            statistic reference data sets.
+    """
+    from sklearn.metrics import silhouette_score
+    model = make_kmeans(k, len(scaled_data)).fit(scaled_data)
+    silhouette = np.nan
+    if 2 <= k < len(scaled_data):
+        silhouette = silhouette_score(scaled_data, model.labels_, random_state=RANDOM_STATE,
+                                      sample_size=min(len(scaled_data), SILHOUETTE_SAMPLE))
+    fit = {'k': k, 'model': model, 'sse': model.inertia_, 'silhouette': silhouette}
+    if not gap:
+        return fit
+    # Uniform data sets in the bounding box of the data, clustered alike
+    rng = np.random.default_rng(RANDOM_STATE + k)
+    low, high = scaled_data.min(axis=0), scaled_data.max(axis=0)
+    reference = [np.log(make_kmeans(k, len(scaled_data)).fit(rng.uniform(low, high, scaled_data.shape)).inertia_)
+                 for _ in range(GAP_REFERENCES)]
+    return dict(fit, reference=reference)
+
+def select_k(scaled_data, k_range=K_RANGE, method='silhouette', workers=None):
+    """
+    Fits K-Means for each cluster count in parallel and chooses the count.
+
+    Args:
+        scaled_data (np.ndarray): The standardized features, one row per run.
+        k_range (range): The cluster counts tried.
+        method (str): 'silhouette' for the count of the best silhouette score,
+            'gap' for the smallest count whose gap statistic is within one
+            standard error of the next one (Tibshirani et al.).
+        workers (int): The number of processes, one per CPU if None, and no
+            pool at all if 1.
+
+    Returns:
+        tuple: The chosen count and a DataFrame of the fits by count, with the
+            sse and silhouette columns, the gap and gap_error columns with the
+            'gap' method only, and the fitted models.
+    """
+    if method not in ('silhouette', 'gap'):
+        raise ValueError(f"Unknown method '{method}', expected 'silhouette' or 'gap'")
+    k_range = [k for k in k_range if k <= len(scaled_data)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(k_range) < 2:
+        fits = list(map(fit_k, repeat(scaled_data), k_range, repeat(method == 'gap')))
+    else:
+        with ProcessPoolExecutor(min(workers, len(k_range))) as executor:
+            fits = list(executor.map(fit_k, repeat(scaled_data), k_range, repeat(method == 'gap')))
+    fits = pd.DataFrame(fits).set_index('k')
+    if method == 'gap':
+        reference = np.array(fits.pop('reference').tolist())
+        fits['gap'] = reference.mean(axis=1) - np.log(fits['sse'].clip(lower=1e-12))
+        fits['gap_error'] = reference.std(axis=1) * np.sqrt(1 + 1 / GAP_REFERENCES)
+        gap, error = fits['gap'].to_numpy(), fits['gap_error'].to_numpy()
+        within = np.flatnonzero(gap[:-1] >= gap[1:] - error[1:])
+        best = fits.index[within[0]] if len(within) else fits['gap'].idxmax()
+    else:
+        best = fits['silhouette'].idxmax() if fits['silhouette'].notna().any() else fits.index[0]
+    return int(best), fits
+
+def save_k_selection(fits, best, method, save_path):
+    """Plots the SSE (elbow), the silhouette score and, if computed, the gap statistic by cluster count."""
+    import matplotlib.pyplot as plt
+    panels = 3 if 'gap' in fits else 2
+    fig, axes = plt.subplots(1, panels, figsize=(5 * panels, 4.5))
+    axes[0].plot(fits.index, fits['sse'], marker='o')
+    axes[0].set_title('Elbow Method')
+    axes[0].set_ylabel('Sum of Squared Errors (SSE)')
+    axes[1].plot(fits.index, fits['silhouette'], marker='o')
+    axes[1].set_title('Silhouette Score')
+    if 'gap' in fits:
+        axes[2].errorbar(fits.index, fits['gap'], yerr=fits['gap_error'], marker='o', capsize=3)
+        axes[2].set_title('Gap Statistic')
+    for ax in axes:
+        ax.axvline(best, color='red', linestyle='--', alpha=0.6)
+        ax.set_xlabel('Number of Clusters (k)')
+        ax.set_xticks(list(fits.index))
+        ax.grid(True)
+    fig.suptitle(f'Choice of k = {best} by {method}')
+    fig.tight_layout()
+    fig.savefig(save_path)
+    plt.close(fig)
+
+def perform_pca_and_clustering(file_path, n_clusters=None, profile=None, method='silhouette', workers=None,
+                               trajectory=False):
+    """
+    Performs PCA and K-Means clustering on PID controller data from the run
+    catalog or a CSV file. The diagnostic plots are saved in analysis_results,
+    so that it can run unattended after a sweep.
+
+    Args:
+        file_path (str): The path to the run catalog or the CSV file.
+        n_clusters (int): The number of clusters to form, chosen by select_k
+            if None.
+        profile (str): The scoring profile of the fitness scores (see
+            data_analysis.SCORING_PROFILES), the stored ones if None.
+        method (str): The method of select_k, 'silhouette' or 'gap'.
+        workers (int): The number of processes of select_k and of the
+            feature extraction.
+        trajectory (bool): Whether to cluster on the trajectory features of
+            the runs too (see trajectory_features.py), which reads their files.
+
+    Returns:
+        pd.DataFrame: The clustered runs, with their principal components and
+            cluster, None if they could not be loaded.
     """
     # --- 1. Data Loading and Preparation ---
     if not os.path.exists(file_path):
         print(f"Error: The file '{file_path}' was not found.")
         return
     try:
-        df = pd.read_csv(file_path)
+        df = load_results(file_path, profile=profile)
     except Exception as e:
-        print(f"Error reading the CSV file: {e}")
+        print(f"Error reading the results: {e}")
         return
 
+    # sklearn and the plotting libraries are imported here, they dominate the start-up time.
+    # The plots are only saved, Agg renders them without a display.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import PCA
+
     # Select numerical features for clustering
     features = [
         'Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos', 'iae_angle',
         'iae_position', 'max_angle_deviation', 'max_position_overshoot',
         'control_effort_proxy', 'fitness_score'
     ]
+    if trajectory:
+        from trajectory_features import FEATURE_NAMES, feature_table
+        print(f"Extracting the trajectory features of {len(df)} runs...")
+        df = df.merge(feature_table(df['file_path'], workers), on='file_path', how='left')
+        features += list(FEATURE_NAMES)
     # Filter out columns that are not in the dataframe
     features = [col for col in features if col in df.columns]
     data_for_clustering = df[features].dropna()
@@ -38,23 +173,17 @@ def perform_pca_and_clustering(file_path, n_clusters=4):
     scaler = StandardScaler()
     scaled_data = scaler.fit_transform(data_for_clustering)
 
-    # --- 2. Elbow Method to Find Optimal k ---
-    print("Generating Elbow Method plot to find optimal k...")
-    sse = []
-    k_range = range(1, 11)
-    for k in k_range:
-        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-        kmeans.fit(scaled_data)
-        sse.append(kmeans.inertia_) # Sum of squared distances to closest centroid
-
-    plt.figure(figsize=(8, 5))
-    plt.plot(k_range, sse, marker='o')
-    plt.title('Elbow Method for Optimal k')
-    plt.xlabel('Number of Clusters (k)')
-    plt.ylabel('Sum of Squared Errors (SSE)')
-    plt.xticks(k_range)
-    plt.grid(True)
-    plt.show() # Display the plot for the user to decide on k
+    # Create output directory for the plots
+    output_dir = "analysis_results"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # --- 2. Choice of k, the counts are fitted in parallel ---
+    print(f"Fitting K-Means for k in {K_RANGE.start}..{K_RANGE.stop - 1} to find optimal k...")
+    best_k, fits = select_k(scaled_data, method=method, workers=workers)
+    selection_path = os.path.join(output_dir, 'pca_k_selection.png')
+    save_k_selection(fits, best_k, method, selection_path)
+    print(f"Optimal k by {method}: {best_k}, plots saved to '{selection_path}'")
 
     # --- 3. PCA for Dimensionality Reduction ---
     print(f"Performing PCA to reduce to 2 components...")
@@ -63,14 +192,17 @@ def perform_pca_and_clustering(file_path, n_clusters=4):
     pca_df = pd.DataFrame(data=principal_components, columns=['PC1', 'PC2'])
 
     # --- 4. K-Means Clustering ---
-    print(f"Performing K-Means clustering with k={n_clusters}...")
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-    clusters = kmeans.fit_predict(scaled_data)
-    pca_df['cluster'] = clusters
+    n_clusters = n_clusters or best_k
+    print(f"K-Means clustering with k={n_clusters}...")
+    if n_clusters in fits.index:
+        kmeans = fits.loc[n_clusters, 'model']
+    else:
+        kmeans = make_kmeans(n_clusters, len(scaled_data)).fit(scaled_data)
+    pca_df['cluster'] = kmeans.labels_
 
     # --- 5. Visualization ---
     print("Generating final cluster visualization...")
-    plt.figure(figsize=(12, 8))
+    fig = plt.figure(figsize=(12, 8))
     sns.scatterplot(
         x='PC1', y='PC2', hue='cluster', data=pca_df,
         palette=sns.color_palette('viridis', n_colors=n_clusters),
@@ -89,23 +221,29 @@ def perform_pca_and_clustering(file_path, n_clusters=4):
     plt.legend()
     plt.grid(True)
 
-    # Create output directory and save the plot
-    output_dir = "analysis_results"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
     save_path = os.path.join(output_dir, 'pca_kmeans_clusters.png')
-    plt.savefig(save_path)
+    fig.savefig(save_path)
+    plt.close(fig)
 
     print(f"\nAnalysis complete. Cluster plot saved to '{save_path}'")
+    return df.loc[data_for_clustering.index].assign(**pca_df.set_index(data_for_clustering.index))
 
 
 if __name__ == '__main__':
     # --- Configuration ---
     # IMPORTANT: Change this path to the location of your CSV file.
     csv_file_location = 'pid_analysis_results.csv'
-    # Set the number of clusters based on the Elbow Method plot.
-    # The "elbow" in the plot suggests an optimal value. A value of 3 or 4 looks reasonable.
-    N_CLUSTERS = 4
+    # The run catalog of data_analysis.py is queried directly when it exists
+    if os.path.exists(CATALOG_PATH):
+        csv_file_location = CATALOG_PATH
+    # Set the number of clusters, or None to choose it automatically by K_SELECTION
+    # ('silhouette' or 'gap'), see the plots of analysis_results/pca_k_selection.png.
+    N_CLUSTERS = None
+    K_SELECTION = 'silhouette'
+    # Cluster on the behaviour of the runs too (spectra, limit cycles, phase space), see trajectory_features.py
+    TRAJECTORY_FEATURES = False
+    # Scoring profile of the fitness scores, e.g. 'angle' (see data_analysis.SCORING_PROFILES)
+    SCORING_PROFILE = None
 
     # --- Execution ---
     # Create a dummy CSV for demonstration if it doesn't exist
@@ -131,4 +269,5 @@ if __name__ == '__main__':
         with open(csv_file_location, 'w') as f:
             f.write(dummy_data)
 
-    perform_pca_and_clustering(csv_file_location, n_clusters=N_CLUSTERS)
\ No newline at end of file
+    perform_pca_and_clustering(csv_file_location, n_clusters=N_CLUSTERS, profile=SCORING_PROFILE, method=K_SELECTION,
+                               trajectory=TRAJECTORY_FEATURES)
\ No newline at end of file
@@ -16,6 +16,7 @@ mpl.use('TkAgg')
 port = 'COM4'
 baudrate = 230400
 TRIAL_DURATION_SECONDS = 45 #  maximum duration for a single PID trial
+READER_TIMEOUT = 2 # Time (s) waited for the reader thread to stop at the end of a trial
 
 # --- PID Parameter Sets for Automated Testing ---
 PID_PARAM_SETS = [700.0,490.0,2.75,-0.04,0.0,-0.008]
@@ -41,6 +42,7 @@ class cart_pendulum():
         self.data = data
         self.temp_datum = temp_data
         self.df = data_frame
+        self.reader = None # Thread reading the arduino during a trial, see thread_reader
         self.module_name = r"\Defaut_Cart_Pendulum"
         self.center_count = 0
         self.distance = 0
@@ -64,8 +66,21 @@ class cart_pendulum():
         for flag in self.init_false_flag_list: self.flag_list[flag] = False
         if swing_request: self.flag_list["swing_request"] = False
 
+    def stop_reader(self):
+        '''Stops the reader thread and waits for it, so that the run is exported
+        (and its record closed) with all the samples it read'''
+        if self.reader is None:
+            return
+        self.temp_datum.flag_close_event = True
+        self.reader.join(READER_TIMEOUT)
+        if self.reader.is_alive():
+            print("The reader thread did not stop, the last samples may be missing.")
+        self.reader = None
+        self.temp_datum.copy(self.data)
+
     def reconnect(self, exp=False, send_terminate=False):
         '''This function now only handles closing the connection and saving data.'''
+        self.stop_reader()
         if send_terminate:
             time.sleep(0.1)
             if hasattr(self.arduino, 'board') and self.arduino.board.is_open:
@@ -82,7 +97,8 @@ class cart_pendulum():
                 print("Arduino connection closed.")
             
             if exp:
-                self.temp_datum.export_csv(self.module_name, input_spec_info=True)
+                # Exported in the background, the next trial does not wait for the disk
+                self.temp_datum.export_csv(self.module_name, input_spec_info=False, background=True)
         except KeyboardInterrupt:
             if hasattr(self.arduino, 'board') and self.arduino.board.is_open: self.arduino.board.close()
             print("KeyboardInterrupt during reconnect. Exiting.")
@@ -180,8 +196,9 @@ class cart_pendulum():
                 self.temp_datum.flag_close_event = True
 
             if self.flag_list["thread_init"]:
-                reader = threading.Thread(target=self.thread_reader, args=(True, True))
-                reader.start()
+                self.data.module_name = self.module_name # Names the record from its first sample
+                self.reader = threading.Thread(target=self.thread_reader, args=(True, True))
+                self.reader.start()
                 self.flag_list["thread_init"] = False
 
             if not self.temp_datum.flag_close_event:
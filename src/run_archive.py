@@ -0,0 +1,274 @@
+'''Compressed archive of the runs, for the data folders which otherwise grow
+by a few MB of csv per trial. The samples are cut in chunks of CHUNK_ROWS
+rows which are compressed separately, and an index of the chunks with their
+time range is stored at the end of the file, so that any time range of a run
+is read without decompressing the rest (archive_file.read()).
+
+The chunks are compressed with zstd if the zstandard package is installed,
+with zlib otherwise. The bytes of the float64 columns are shuffled first (all
+the first bytes, then all the second bytes...), which compresses much better.
+
+File layout (little endian):
+    - MAGIC, uint32 length of a json header (columns, codec, metadata and the
+      metadata lines of the csv file), the json header, padding to 8 bytes
+    - the compressed chunks
+    - the chunk index, one INDEX_DTYPE entry per chunk
+    - uint64 offset of the index, uint32 number of chunks, END_MAGIC
+
+Usage: python run_archive.py convert <file or folder> ...
+converts the csv files in place, each archive is read back and compared to
+its csv file before the csv file is removed.'''
+import numpy as np
+import importlib.util, json, os, struct, sys, zlib
+
+ARCHIVE_EXTENSION = '.carz'
+ARCHIVE_VERSION = 1
+MAGIC = b'CARTARC1'
+END_MAGIC = b'CARTAEND'
+CHUNK_ROWS = 4096 # Rows per compressed chunk
+HEAD_LINES = 64 # Lines searched for the header of a csv table
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u8'), ('rows', '<u8'), ('t_min', '<f8'), ('t_max', '<f8')])
+TAIL = struct.Struct('<QI8s')
+
+def default_codec():
+    return 'zstd' if importlib.util.find_spec('zstandard') is not None else 'zlib'
+
+def compress(raw, codec):
+    if(codec == 'zstd'):
+        import zstandard
+        return zstandard.ZstdCompressor(level = ZSTD_LEVEL).compress(raw)
+    return zlib.compress(raw, ZLIB_LEVEL)
+
+def decompress(raw, codec):
+    if(codec == 'zstd'):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(raw)
+    return zlib.decompress(raw)
+
+def shuffle(block):
+    '''Bytes of a (rows, columns) float64 block, column by column and byte by byte'''
+    return np.ascontiguousarray(block.T, dtype = '<f8').view(np.uint8).reshape(-1, 8).T.tobytes()
+
+def unshuffle(raw, rows, n_columns):
+    values = np.frombuffer(raw, dtype = np.uint8).reshape(8, -1).T.copy().view('<f8')
+    return values.reshape(n_columns, rows).T
+
+def write_archive(filename, columns, data, metadata = None, csv_header = None, codec = None, chunk_rows = CHUNK_ROWS):
+    '''Writes an archive. data is a (rows, columns) array whose first column is
+    the time, csv_header the metadata lines of the original csv file if any.'''
+    codec = codec or default_codec()
+    data = np.asarray(data, dtype = np.float64).reshape(-1, len(columns))
+    header = {
+        'format': 'carter-archive',
+        'version': ARCHIVE_VERSION,
+        'columns': list(columns),
+        'codec': codec,
+        'chunk_rows': chunk_rows,
+        'rows': len(data),
+        'metadata': metadata or {},
+        'csv_header': csv_header,
+        }
+    raw = json.dumps(header).encode()
+    raw += b' ' * (-(len(MAGIC) + 4 + len(raw)) % 8)
+    index = np.zeros(-(-len(data) // chunk_rows), dtype = INDEX_DTYPE)
+    with open(filename, 'wb') as file:
+        file.write(MAGIC + struct.pack('<I', len(raw)) + raw)
+        for i in range(len(index)):
+            block = data[i * chunk_rows:(i + 1) * chunk_rows]
+            chunk = compress(shuffle(block), codec)
+            index[i] = (file.tell(), len(chunk), len(block), block[:, 0].min(), block[:, 0].max())
+            file.write(chunk)
+        index_offset = file.tell()
+        file.write(index.tobytes())
+        file.write(TAIL.pack(index_offset, len(index), END_MAGIC))
+
+class archive_file():
+
+    '''A run archive, with the interface of run_format.run_file. Only the
+    header and the chunk index are read when it is opened, the chunks are
+    decompressed on access.'''
+
+    def __init__(self, path, mmap = True):
+        self.path = path
+        with open(path, 'rb') as file:
+            if(file.read(len(MAGIC)) != MAGIC):
+                raise ValueError(path + " is not a run archive")
+            header_length, = struct.unpack('<I', file.read(4))
+            self.header = json.loads(file.read(header_length))
+            file.seek(-TAIL.size, os.SEEK_END)
+            index_offset, n_chunks, end = TAIL.unpack(file.read(TAIL.size))
+            if(end != END_MAGIC):
+                raise ValueError(path + " is truncated")
+            file.seek(index_offset)
+            self.index = np.frombuffer(file.read(n_chunks * INDEX_DTYPE.itemsize), dtype = INDEX_DTYPE)
+        self.columns = self.header['columns']
+        self.codec = self.header['codec']
+        self.metadata = dict(self.header['metadata'], sample_count = self.header['rows'])
+        self.arrays = None
+
+    def chunk(self, i):
+        '''Decompresses chunk i, returns a (rows, columns) array'''
+        entry = self.index[i]
+        with open(self.path, 'rb') as file:
+            file.seek(int(entry['offset']))
+            raw = file.read(int(entry['size']))
+        return unshuffle(decompress(raw, self.codec), int(entry['rows']), len(self.columns))
+
+    def read(self, start = None, stop = None, columns = None):
+        '''Returns a dictionary of the columns (all by default) for the rows
+        with start <= time <= stop, only the chunks in that range are read'''
+        selected = np.ones(len(self.index), dtype = bool)
+        if(start is not None):
+            selected &= self.index['t_max'] >= start
+        if(stop is not None):
+            selected &= self.index['t_min'] <= stop
+        blocks = [self.chunk(i) for i in np.flatnonzero(selected)]
+        block = np.concatenate(blocks) if blocks else np.zeros((0, len(self.columns)))
+        mask = np.ones(len(block), dtype = bool)
+        if(start is not None):
+            mask &= block[:, 0] >= start
+        if(stop is not None):
+            mask &= block[:, 0] <= stop
+        block = block[mask]
+        return {name: block[:, i] for i, name in enumerate(self.columns) if columns is None or name in columns}
+
+    def __getitem__(self, name):
+        if(self.arrays is None):
+            self.arrays = self.read()
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def data(self):
+        if(self.arrays is None):
+            self.arrays = self.read()
+        return dict(self.arrays)
+
+    def table(self, prefix):
+        '''The tables are archived as separate files'''
+        return {}
+
+def load_archive(path):
+    return archive_file(path)
+
+def is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def parse_metadata(lines):
+    '''The metadata of the lines before the table of a csv file, as read by
+    data_analysis.parse_and_load_data'''
+    metadata = {}
+    def value(text):
+        return float(text) if is_number(text) else text
+    for i, line in enumerate(lines):
+        parts = line.split(',')
+        if(parts[0] == 'Kp' and i + 1 < len(lines)):
+            values = lines[i + 1].split(',')
+            if(len(values) == len(parts)):
+                metadata.update((name, value(text)) for name, text in zip(parts, values))
+        elif(len(parts) == 2):
+            metadata[parts[0]] = value(parts[1])
+        elif(len(parts) == 4 and parts[0] == 'amplitude'):
+            metadata[parts[0]] = value(parts[1])
+            metadata[parts[2]] = value(parts[3])
+        elif(len(parts) > 2 and parts[0].startswith('multiple_')):
+            metadata[parts[0]] = [value(text) for text in parts[1:]]
+    return metadata
+
+def read_csv_table(path):
+    '''Reads an exported csv file (run, fft or phase_amp table). Returns the
+    metadata lines, the column names and the (rows, columns) array'''
+    with open(path, 'r') as file:
+        text = file.read()
+    # The metadata and the header of the table are in the first lines, the
+    # header is followed by numeric rows with the same number of fields
+    lines = text.split('\n', HEAD_LINES)
+    for i in range(len(lines) - 1):
+        first = lines[i + 1].split(',')
+        if(lines[i] and not is_number(lines[i].split(',')[0]) and all(is_number(field) for field in first)
+           and len(first) == lines[i].count(',') + 1
+           and (i + 2 == len(lines) or is_number(lines[i + 2].split(',', 1)[0].strip() or '0'))):
+            break
+    else:
+        raise ValueError(path + " has no table")
+    columns = lines[i].split(',')
+    body = '\n'.join(lines[i + 1:]).strip()
+    data = np.fromstring(body.replace('\n', ','), sep = ',') if body else np.zeros(0)
+    if(data.size % len(columns)):
+        raise ValueError(path + " has incomplete rows")
+    return lines[:i], columns, data.reshape(-1, len(columns))
+
+def unroll(data):
+    '''Returns the recorded rows of a run table in chronological order. The
+    older exports hold the circular buffer twice, padded with zeros until it
+    is full, and rotated at the first decrease of the time stamps once it is.'''
+    rows = len(data)
+    if(rows and rows % 2 == 0 and np.array_equal(data[:rows // 2], data[rows // 2:])):
+        data = data[:rows // 2]
+    drops = np.flatnonzero(np.diff(data[:, 0]) < 0)
+    if(len(drops) == 0):
+        return data
+    start = drops[0] + 1
+    if(not np.any(data[start:])):
+        # Zero padding after the last sample
+        return data[:start]
+    return np.concatenate((data[start:], data[:start]))
+
+def convert(path, codec = None):
+    '''Converts a csv file into an archive next to it and removes the csv
+    file once the archive is verified. Only the recorded rows are archived,
+    in chronological order (see unroll). Returns the path of the archive.'''
+    csv_header, columns, data = read_csv_table(path)
+    if(columns[0] == 'time'):
+        data = unroll(data)
+    filename = os.path.splitext(path)[0] + ARCHIVE_EXTENSION
+    metadata = parse_metadata(csv_header)
+    metadata.setdefault('module', os.path.basename(filename).rsplit('-', 3)[0])
+    write_archive(filename + '.tmp', columns, data, metadata, csv_header, codec)
+    archive = archive_file(filename + '.tmp')
+    restored = np.column_stack([archive[name] for name in columns])
+    if(not np.array_equal(restored, data, equal_nan = True)):
+        os.remove(filename + '.tmp')
+        raise ValueError(path + " could not be archived without loss")
+    os.replace(filename + '.tmp', filename)
+    os.remove(path)
+    return filename
+
+def csv_files(paths):
+    '''The csv files of the given files and folders'''
+    files = []
+    for path in paths:
+        if(os.path.isdir(path)):
+            files += [os.path.join(root, file) for root, _, names in os.walk(path)
+                      for file in names if file.endswith('.csv')]
+        elif(path.endswith('.csv')):
+            files.append(path)
+    return sorted(files)
+
+def main(args):
+    if(len(args) < 2 or args[0] != 'convert'):
+        print(__doc__.split('Usage: ')[-1])
+        return
+    before = after = 0
+    for path in csv_files(args[1:]):
+        size = os.path.getsize(path)
+        try:
+            filename = convert(path)
+        except (OSError, ValueError) as error:
+            print("Skipped " + path + ": " + str(error))
+            continue
+        before += size
+        after += os.path.getsize(filename)
+        print("Archived " + path)
+    if(after):
+        print("%.1f MB of csv archived into %.1f MB (%.1fx)" % (before / 1e6, after / 1e6, before / after))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
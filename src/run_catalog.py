@@ -0,0 +1,333 @@
+"""
+SQLite catalog of the recorded runs, so that the analysis does not have to
+find and parse every file again. There is one row per run file with its
+parameters and its KPIs (see data_analysis.calculate_fitness_score).
+
+The catalog is updated by data_process.export_csv() when a run is exported,
+and build_catalog() adds the runs of the existing data folders. The KPIs are
+cached by file: a run is scored again only if its file changed (size,
+modification time and then content hash) or if the KPIs changed since
+(data_analysis.KPI_VERSION). A file which was moved or copied keeps the KPIs
+cached under its content hash. The catalog
+file is CATALOG_PATH in the current directory, set CARTER_CATALOG to use
+another file or to an empty string to disable the updates on export.
+
+Usage: python run_catalog.py [base_directory]
+"""
+import os
+import sqlite3
+import glob
+import json
+import hashlib
+from datetime import datetime
+
+CATALOG_PATH = os.environ.get('CARTER_CATALOG', 'run_catalog.sqlite')
+PID_COLUMNS = ('Kp', 'Ki', 'Kd', 'Kp_pos', 'Ki_pos', 'Kd_pos')
+KPI_COLUMNS = ('iae_angle', 'iae_position', 'max_angle_deviation',
+               'max_position_overshoot', 'control_effort_proxy', 'ise_angle', 'itae_angle',
+               'settling_time', 'time_to_fall', 'rms_control_velocity', 'fitness_score')
+# Columns of the runs table with their SQL type, new columns are added to existing catalogs
+COLUMNS = dict(
+    [('file_path', 'TEXT PRIMARY KEY'), ('module', 'TEXT'), ('date', 'TEXT'),
+     ('data_set', 'TEXT'), ('pid_set', 'TEXT'), ('special_info', 'TEXT')]
+    + [(name, 'REAL') for name in PID_COLUMNS]
+    + [('omega', 'REAL'), ('amplitude', 'REAL'), ('amp_0', 'REAL'), ('phase', 'REAL'),
+       ('start_time', 'REAL'), ('sample_count', 'INTEGER'), ('file_size', 'INTEGER'),
+       ('file_mtime', 'REAL'), ('content_hash', 'TEXT'), ('kpi_version', 'INTEGER'),
+       ('end_reason', 'TEXT'), ('metadata', 'TEXT')]
+    + [(name, 'REAL') for name in KPI_COLUMNS]
+    )
+INDEXES = {
+    'runs_module': ('module', 'fitness_score'),
+    'runs_pid': PID_COLUMNS,
+    'runs_date': ('date',),
+    'runs_set': ('data_set', 'pid_set'),
+    'runs_hash': ('content_hash', 'kpi_version'),
+    }
+RUN_PATTERNS = ('*.csv', '*.npz', '*.rec', '*.carz') # Files scanned by build_catalog
+DERIVED_PREFIXES = ('fft-', 'phase_amp-') # Tables exported next to the runs, not runs
+HASH_BLOCK = 1 << 20 # Bytes read at once by file_hash
+
+def connect(catalog_path=CATALOG_PATH):
+    """
+    Opens the catalog, creating or upgrading its table and indexes.
+
+    Args:
+        catalog_path (str): The path to the SQLite file.
+
+    Returns:
+        sqlite3.Connection: The connection, rows are returned as sqlite3.Row.
+    """
+    connection = sqlite3.connect(catalog_path)
+    connection.row_factory = sqlite3.Row
+    columns = ', '.join(f'"{name}" {kind}' for name, kind in COLUMNS.items())
+    connection.execute(f'CREATE TABLE IF NOT EXISTS runs ({columns})')
+    existing = set(row['name'] for row in connection.execute('PRAGMA table_info(runs)'))
+    for name, kind in COLUMNS.items():
+        if name not in existing:
+            connection.execute(f'ALTER TABLE runs ADD COLUMN "{name}" {kind}')
+    for index, columns in INDEXES.items():
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {index} ON runs ({", ".join(columns)})')
+    connection.commit()
+    return connection
+
+def path_parts(file_path):
+    """
+    Splits the folders of a run path, e.g.
+    cart_pendulum_data_4\\pid_set_1\\23-07-csv\\pid-12-26-42.csv, with either
+    separator since the acquisition writes Windows paths.
+
+    Returns:
+        tuple: The data set, the pid set and the module name (None if unknown).
+    """
+    parts = file_path.replace('\\', '/').split('/')
+    data_set = next((part for part in parts if part.startswith('cart_pendulum_data')), None)
+    pid_set = next((part for part in parts if part.startswith('pid_set_')), None)
+    module = os.path.splitext(parts[-1])[0].rsplit('-', 3)[0] or None
+    return data_set, pid_set, module
+
+def file_hash(file_path):
+    """Returns the BLAKE2b digest of the content of a file, in hexadecimal."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def catalog_row(file_path, metadata, kpis=None, content_hash=None):
+    """
+    Builds the row of a run.
+
+    Args:
+        file_path (str): The path of the run file.
+        metadata (dict): The metadata of the run, as read by
+            data_analysis.parse_and_load_data or written by data.run_metadata.
+        kpis (dict): The results of calculate_fitness_score, if any.
+        content_hash (str): The file_hash of the file, if known.
+
+    Returns:
+        dict: The values of the row by column name.
+    """
+    from data_analysis import KPI_VERSION
+    file_path = os.path.abspath(file_path)
+    data_set, pid_set, module = path_parts(file_path)
+    row = {name: None for name in COLUMNS}
+    row.update({
+        'file_path': file_path,
+        'module': metadata.get('module') or module,
+        'data_set': data_set,
+        'pid_set': pid_set,
+        'special_info': str(metadata.get('special_info', '') or ''),
+        'phase': metadata.get('phase/pi'),
+        'sample_count': metadata.get('sample_count'),
+        'content_hash': content_hash,
+        'kpi_version': KPI_VERSION,
+        # Why the trial was ended early, as found when scored, see fall_detector.py
+        'end_reason': kpis['end_reason'] if 'end_reason' in (kpis or {}) else metadata.get('end_reason'),
+        'metadata': json.dumps(metadata, default=str),
+        })
+    for name in PID_COLUMNS + ('omega', 'amplitude', 'amp_0', 'start_time'):
+        value = metadata.get(name)
+        row[name] = value if isinstance(value, (int, float)) else None
+    try:
+        stat = os.stat(file_path)
+        row['file_size'], row['file_mtime'] = stat.st_size, stat.st_mtime
+        row['date'] = datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds')
+    except OSError:
+        row['date'] = datetime.now().isoformat(timespec='seconds')
+    for name in KPI_COLUMNS:
+        value = (kpis or {}).get(name)
+        row[name] = float(value) if value is not None else None
+    return row
+
+def upsert(connection, rows):
+    """Inserts or replaces the rows, a list of dictionaries from catalog_row."""
+    names = list(COLUMNS)
+    connection.executemany(
+        f'INSERT OR REPLACE INTO runs ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+        [[row.get(name) for name in names] for row in rows])
+    connection.commit()
+
+def run_kpis(metadata, df):
+    """Returns the KPIs of a PID run, None for the other modules."""
+    if metadata.get('module', 'pid') != 'pid' or df is None:
+        return None
+    from data_analysis import calculate_fitness_score
+    results = calculate_fitness_score(df, metadata)
+    return None if 'error' in results else results
+
+def register_run(file_path, metadata, columns, catalog_path=CATALOG_PATH):
+    """
+    Adds a run which has just been exported, called by data_process.
+
+    Args:
+        file_path (str): The path of the run file.
+        metadata (dict): The metadata of the run (data.run_metadata).
+        columns (dict): The data columns (time, angle, position, ...).
+        catalog_path (str): The catalog, nothing is done if empty.
+    """
+    if not catalog_path:
+        return
+    import pandas as pd
+    try:
+        connection = connect(catalog_path)
+        try:
+            upsert(connection, [catalog_row(file_path, metadata, run_kpis(metadata, pd.DataFrame(columns)),
+                                            file_hash(file_path))])
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f"Could not update the run catalog {catalog_path}: {e}")
+
+def find_runs(base_directory='.'):
+    """Returns the run files of the data folders, one file per run."""
+    from run_format import unique_runs
+    paths = []
+    for pattern in RUN_PATTERNS:
+        paths += glob.glob(os.path.join(base_directory, 'cart_pendulum_data*', '**', pattern), recursive=True)
+    paths = [path for path in paths
+             if not path.replace('\\', '/').split('/')[-1].startswith(DERIVED_PREFIXES)]
+    return unique_runs(sorted(paths))
+
+def shadowed(file_path):
+    """Whether a csv run has a binary twin, which find_runs returns instead."""
+    from run_format import is_run, binary_twin
+    return not is_run(file_path) and os.path.exists(binary_twin(file_path))
+
+def cached_row(connection, file_path, content_hash):
+    """
+    Returns the row of a file from the KPIs cached under its content hash,
+    None if no run with the same content was scored by the current KPI code.
+    """
+    from data_analysis import KPI_VERSION
+    cached = connection.execute('SELECT * FROM runs WHERE content_hash = ? AND kpi_version = ? LIMIT 1',
+                                (content_hash, KPI_VERSION)).fetchone()
+    if cached is None:
+        return None
+    kpis = {name: cached[name] for name in KPI_COLUMNS + ('end_reason',)}
+    return catalog_row(file_path, json.loads(cached['metadata']), kpis, content_hash)
+
+def build_catalog(base_directory='.', catalog_path=CATALOG_PATH, workers=None, rescore=False):
+    """
+    Adds the runs of the data folders to the catalog. Files already in the
+    catalog with the same size and modification time, or else the same
+    content hash, are not read again unless the KPIs changed since they were
+    scored, and the rows of the files which were removed (e.g. csv files
+    converted by run_archive.py) or shadowed by a binary twin (converted by
+    legacy_converter.py, see run_format.unique_runs) are deleted. The other files are scored in a
+    pool of processes (see data_analysis.score_files).
+
+    Args:
+        base_directory (str): The folder containing the cart_pendulum_data folders.
+        catalog_path (str): The path to the SQLite file.
+        workers (int): The number of processes, one per CPU if None.
+        rescore (bool): Whether to read and score all the files again.
+
+    Returns:
+        int: The number of runs added or updated.
+    """
+    from data_analysis import score_files, KPI_VERSION
+    connection = connect(catalog_path)
+    try:
+        known = {row['file_path']: (row['file_size'], row['file_mtime'], row['kpi_version'])
+                 for row in connection.execute('SELECT file_path, file_size, file_mtime, kpi_version FROM runs')}
+        rows, hashes = [], {}
+        cached = 0
+        for file_path in map(os.path.abspath, find_runs(base_directory)):
+            stat = os.stat(file_path)
+            if not rescore and known.get(file_path) == (stat.st_size, stat.st_mtime, KPI_VERSION):
+                cached += 1
+                continue
+            hashes[file_path] = file_hash(file_path)
+            row = None if rescore else cached_row(connection, file_path, hashes[file_path])
+            if row is not None:
+                rows.append(row)
+                del hashes[file_path]
+        print(f"{cached + len(rows)} runs served from the cache, {len(hashes)} to analyze")
+        rows += [catalog_row(file_path, metadata, kpis, hashes[file_path])
+                 for file_path, metadata, kpis, error in score_files(list(hashes), workers)
+                 if metadata is not None]
+        upsert(connection, rows)
+        root = os.path.join(os.path.abspath(base_directory), '')
+        removed = [(file_path,) for file_path in known
+                   if file_path.startswith(root) and (not os.path.exists(file_path) or shadowed(file_path))]
+        connection.executemany('DELETE FROM runs WHERE file_path = ?', removed)
+        connection.commit()
+    finally:
+        connection.close()
+    return len(rows)
+
+def query_runs(sql='SELECT * FROM runs', params=(), catalog_path=CATALOG_PATH):
+    """
+    Runs a query on the catalog.
+
+    Returns:
+        pd.DataFrame: The rows of the result.
+    """
+    import pandas as pd
+    connection = connect(catalog_path)
+    try:
+        return pd.read_sql_query(sql, connection, params=params)
+    finally:
+        connection.close()
+
+def rescore_runs(runs, profile, limit=None):
+    """
+    Replaces the fitness scores of the runs by those of a scoring profile
+    (see data_analysis.fitness_scores) and ranks them, best first.
+
+    Returns:
+        pd.DataFrame: The limit best runs, all if None.
+    """
+    from data_analysis import fitness_scores
+    runs = runs.assign(fitness_score=fitness_scores(runs, profile)).sort_values('fitness_score')
+    return runs if limit is None else runs.head(int(limit))
+
+def top_runs(limit=None, module='pid', catalog_path=CATALOG_PATH, profile=None):
+    """
+    Ranks the scored runs of a module by fitness score, best first.
+
+    Args:
+        limit (int): The number of runs returned, all if None.
+        module (str): The module of the runs.
+        profile: A scoring profile or weights (see data_analysis.profile_weights)
+            which replaces the fitness score stored in the catalog.
+
+    Returns:
+        pd.DataFrame: The rows of the best runs.
+    """
+    sql = 'SELECT * FROM runs WHERE module = ? AND fitness_score IS NOT NULL'
+    params = [module]
+    if profile is not None:
+        return rescore_runs(query_runs(sql, params, catalog_path), profile, limit)
+    sql += ' ORDER BY fitness_score'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(int(limit))
+    return query_runs(sql, params, catalog_path)
+
+def load_results(file_path, limit=None, profile=None):
+    """
+    Loads the scored PID runs from a catalog, or from a results CSV file of
+    data_analysis.py for the older analyses.
+
+    Args:
+        file_path (str): The path to the catalog (.sqlite) or the CSV file.
+        limit (int): The number of best runs loaded from a catalog, all if None.
+        profile: The scoring profile of the fitness scores, those of the file
+            if None.
+
+    Returns:
+        pd.DataFrame: The runs, sorted by fitness score for a catalog or a profile.
+    """
+    if file_path.endswith(('.sqlite', '.db')):
+        return top_runs(limit, catalog_path=file_path, profile=profile).drop(columns=['metadata'])
+    import pandas as pd
+    results = pd.read_csv(file_path)
+    return results if profile is None else rescore_runs(results, profile)
+
+if __name__ == '__main__':
+    import sys
+    base_directory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    count = build_catalog(base_directory)
+    print(f"{count} runs added to {os.path.abspath(CATALOG_PATH)}")
@@ -0,0 +1,121 @@
+'''Binary run format, an alternative to the csv files of export_csv which
+readers otherwise have to sniff line by line.
+
+A run is a single numpy .npz container holding
+    - the data columns: time, angle, position, angular_velocity, cart_velocity
+    - the fft table (if any): fft_freq, fft_angle, fft_position
+    - the phase_amp table (if any): phase_amp_time, phase_amp_phase,
+      phase_amp_amplitude, phase_amp_phase_active
+    - metadata: a json dictionary with the same keys as the csv header
+      (special_info, Kp ... Kd_pos, start_time, omega, amplitude, amp_0, phase/pi)
+      plus module, sample_count and the format version
+
+The arrays are stored uncompressed by default, so that load_run() can memory
+map them straight from the file instead of reading it.'''
+import numpy as np
+import json, os, struct, zipfile
+
+RUN_EXTENSION = '.npz'
+RECORD_EXTENSION = '.rec' # Streamed records, see run_recorder.py
+ARCHIVE_EXTENSION = '.carz' # Compressed archives, see run_archive.py
+RUN_VERSION = 1
+DATA_COLUMNS = ('time', 'angle', 'position', 'angular_velocity', 'cart_velocity')
+FFT_COLUMNS = ('freq', 'angle', 'position')
+PHASE_AMP_COLUMNS = ('time', 'phase', 'amplitude', 'phase_active')
+ZIP_LOCAL_HEADER = 30 # Size of the fixed part of a zip local file header
+
+def save_run(filename, metadata, data, fft = None, phase_amp = None, compress = False):
+    '''Saves a run. data, fft and phase_amp are dictionaries of columns (see
+    the module docstring for the names), fft and phase_amp are optional.'''
+    metadata = dict(metadata, format = 'carter-run', version = RUN_VERSION)
+    arrays = {'metadata': np.array(json.dumps(metadata))}
+    for name, values in data.items():
+        arrays[name] = np.ascontiguousarray(values)
+    for prefix, table in (('fft_', fft), ('phase_amp_', phase_amp)):
+        if(table is not None):
+            for name, values in table.items():
+                arrays[prefix + name] = np.ascontiguousarray(values)
+    if(compress):
+        np.savez_compressed(filename, **arrays)
+    else:
+        np.savez(filename, **arrays)
+
+def stored_array(file, info):
+    '''Memory maps an array stored uncompressed in the npz file, returns None
+    if it cannot be mapped'''
+    file.seek(info.header_offset)
+    local = file.read(ZIP_LOCAL_HEADER)
+    name_length, extra_length = struct.unpack('<HH', local[26:30])
+    file.seek(info.header_offset + ZIP_LOCAL_HEADER + name_length + extra_length)
+    version = np.lib.format.read_magic(file)
+    if(version == (1, 0)):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+    if(dtype.hasobject or int(np.prod(shape)) == 0):
+        return None
+    return np.memmap(file.name, dtype = dtype, mode = 'r', offset = file.tell(),
+                     shape = shape, order = 'F' if fortran_order else 'C')
+
+class run_file():
+
+    '''A loaded run. The arrays are accessed by name, e.g. run['angle'], and
+    are memory maps of the file unless it is compressed.'''
+
+    def __init__(self, path, mmap = True):
+        self.path = path
+        self.arrays = {}
+        with zipfile.ZipFile(path) as archive:
+            with open(path, 'rb') as file:
+                for info in archive.infolist():
+                    name = info.filename[:-len('.npy')]
+                    array = None
+                    if(mmap and info.compress_type == zipfile.ZIP_STORED and name != 'metadata'):
+                        array = stored_array(file, info)
+                    if(array is None):
+                        with archive.open(info) as member:
+                            array = np.lib.format.read_array(member)
+                    self.arrays[name] = array
+        self.metadata = json.loads(str(self.arrays.pop('metadata')))
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def data(self):
+        '''Dictionary of the data columns'''
+        return {name: self.arrays[name] for name in DATA_COLUMNS if name in self.arrays}
+
+    def table(self, prefix):
+        '''Dictionary of the columns of the 'fft' or 'phase_amp' table, empty if not saved'''
+        prefix += '_'
+        return {name[len(prefix):]: array for name, array in self.arrays.items() if name.startswith(prefix)}
+
+def load_run(path, mmap = True):
+    '''Loads a binary run file, a record of run_recorder.py or an archive of
+    run_archive.py'''
+    if(path.endswith(RECORD_EXTENSION)):
+        from run_recorder import record_file
+        return record_file(path, mmap)
+    if(path.endswith(ARCHIVE_EXTENSION)):
+        from run_archive import archive_file
+        return archive_file(path)
+    return run_file(path, mmap)
+
+def is_run(path):
+    return path.endswith((RUN_EXTENSION, RECORD_EXTENSION, ARCHIVE_EXTENSION))
+
+def binary_twin(csv_path):
+    '''Path of the binary file of a run exported in both formats'''
+    dirc, file = os.path.split(csv_path)
+    if(dirc.endswith('-csv')):
+        dirc = dirc[:-len('-csv')] + '-run'
+    return os.path.join(dirc, os.path.splitext(file)[0] + RUN_EXTENSION)
+
+def unique_runs(paths):
+    '''Drops the csv files of the runs which also have a binary file'''
+    paths = list(paths)
+    binaries = set(path for path in paths if is_run(path))
+    return [path for path in paths if is_run(path) or binary_twin(path) not in binaries]
@@ -0,0 +1,217 @@
+'''Streaming recorder of the runs, which writes the samples to disk while they
+arrive instead of exporting the whole run at the end. A crash or a Ctrl+C then
+only loses the last batch, and closing the run costs one small write.
+
+Enabled with CARTER_EXPORT_FORMAT=record (see data_process.py). The record is
+created by the first sample of a run, data.append_data() hands the new samples
+over in batches of BATCH_SIZE (or after FLUSH_PERIOD seconds), which are copied
+straight from the circular buffer, and export_csv() closes it with the
+metadata of the run.
+
+File layout (little endian):
+    - MAGIC, uint32 length of a json header, the json header (columns, start
+      time, path...), padding to a multiple of 8 bytes
+    - the samples as float64 rows of time, angle, position, angular_velocity,
+      cart_velocity
+    - the json footer (the metadata of run_format.py, 'complete' is True),
+      uint32 length of the footer, END_MAGIC
+
+A record without footer was truncated, recover() drops the partial row and
+closes it. Usage: python run_recorder.py recover <file or folder> ...'''
+import numpy as np
+import json, os, struct, sys, threading, time
+from datetime import datetime
+
+RECORD_EXTENSION = '.rec'
+RECORD_VERSION = 1
+MAGIC = b'CARTREC1'
+END_MAGIC = b'CARTEND1'
+COLUMNS = ('time', 'angle', 'position', 'angular_velocity', 'cart_velocity')
+ROW_SIZE = 8 * len(COLUMNS)
+BATCH_SIZE = 256 # Samples written at once
+FLUSH_PERIOD = 1. # Maximum age of the samples not written yet in seconds
+FSYNC_PERIOD = 2. # Minimum time between two fsync in seconds
+
+class run_recorder():
+
+    '''Writer of the record of one run, owned by the data object which reads
+    the arduino (and shared with its live_data copy). The reader thread
+    writes the samples while the main thread closes the record, hence the
+    lock.'''
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        header = dict(header, format = 'carter-record', version = RECORD_VERSION, columns = COLUMNS)
+        raw = json.dumps(header).encode()
+        raw += b' ' * (-(len(MAGIC) + 4 + len(raw)) % 8)
+        self.file.write(MAGIC + struct.pack('<I', len(raw)) + raw)
+        self.sync()
+        self.count = 0 # Samples written
+        self.last_write = time.perf_counter()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def update(self, data):
+        '''Writes the new samples of data if a batch is full or they are old enough'''
+        pending = data.index - self.count
+        if(pending >= BATCH_SIZE or (pending > 0 and time.perf_counter() - self.last_write >= FLUSH_PERIOD)):
+            self.write(data)
+
+    def write(self, data):
+        '''Writes the samples of data which are not on disk yet'''
+        with self.lock:
+            if(not self.closed):
+                self.write_pending(data)
+
+    def write_pending(self, data):
+        '''write() and close() once they hold the lock'''
+        pending = data.index - self.count
+        if(pending <= 0):
+            return
+        if(pending > data.buffer_length):
+            # Overwritten in the circular buffer before they could be written
+            print("\nRecorder fell behind, %d samples lost\n" % (pending - data.buffer_length))
+            self.count = data.index - data.buffer_length
+            pending = data.buffer_length
+        # The buffer is doubled, so the pending samples are contiguous
+        low = self.count % data.buffer_length
+        block = np.column_stack((data.time[low:low + pending],
+                                 data.angle[low:low + pending],
+                                 data.position[low:low + pending],
+                                 data.angular_velocity[low:low + pending],
+                                 data.position_velocity[low:low + pending]))
+        self.file.write(block.astype('<f8').tobytes())
+        self.count += pending
+        now = time.perf_counter()
+        self.last_write = now
+        if(now - self.last_sync >= FSYNC_PERIOD):
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.perf_counter()
+
+    def close(self, data, metadata = None):
+        '''Writes the remaining samples of data and the footer'''
+        with self.lock:
+            if(self.closed):
+                return
+            self.write_pending(data)
+            footer = dict(metadata or {}, sample_count = self.count, complete = True)
+            write_footer(self.file, footer)
+            self.sync()
+            self.file.close()
+            self.closed = True
+        print("\nRecorded to " + self.filename + "\n")
+
+def start_recorder(data):
+    '''Creates the record of the run starting in data'''
+    dirc = data.path + '\\' + datetime.now().strftime("%d-%m-rec")
+    os.makedirs(dirc, exist_ok = True)
+    name = data.module_name or 'run'
+    filename = dirc + '\\' + name + datetime.now().strftime("-%H-%M-%S") + RECORD_EXTENSION
+    header = {
+        'module': data.module_name,
+        'start_time': float(data.start_time),
+        'sys_start_time': data.sys_start_time,
+        'pid_param': getattr(data, 'pid_param', None),
+        }
+    return run_recorder(filename, header)
+
+def write_footer(file, footer):
+    raw = json.dumps(footer).encode()
+    file.write(raw + struct.pack('<I', len(raw)) + END_MAGIC)
+
+def read_layout(file):
+    '''Returns the header, the offset of the samples, the number of complete
+    rows and the footer (None if the record was truncated)'''
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if(file.read(len(MAGIC)) != MAGIC):
+        raise ValueError(file.name + " is not a run record")
+    header_length, = struct.unpack('<I', file.read(4))
+    header = json.loads(file.read(header_length))
+    offset = len(MAGIC) + 4 + header_length
+    end = size
+    footer = None
+    if(size - offset >= 4 + len(END_MAGIC)):
+        file.seek(size - 4 - len(END_MAGIC))
+        tail = file.read(4 + len(END_MAGIC))
+        if(tail[4:] == END_MAGIC):
+            footer_length, = struct.unpack('<I', tail[:4])
+            end = size - 4 - len(END_MAGIC) - footer_length
+            file.seek(end)
+            footer = json.loads(file.read(footer_length))
+    return header, offset, (end - offset) // ROW_SIZE, footer
+
+class record_file():
+
+    '''A loaded record, with the same interface as run_format.run_file. The
+    samples are memory mapped, a truncated record is read up to its last
+    complete row.'''
+
+    def __init__(self, path, mmap = True):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.header, offset, rows, self.footer = read_layout(file)
+            if(mmap and rows > 0):
+                samples = np.memmap(path, dtype = '<f8', mode = 'r', offset = offset, shape = (rows, len(COLUMNS)))
+            else:
+                file.seek(offset)
+                samples = np.frombuffer(file.read(rows * ROW_SIZE), dtype = '<f8').reshape(rows, len(COLUMNS))
+        self.arrays = {name: samples[:, i] for i, name in enumerate(self.header['columns'])}
+        self.metadata = {'module': self.header.get('module'), 'start_time': self.header.get('start_time')}
+        self.metadata.update(self.footer or {'complete': False})
+        self.metadata['sample_count'] = rows
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def data(self):
+        return dict(self.arrays)
+
+    def table(self, prefix):
+        '''Records only hold the samples'''
+        return {}
+
+def recover(path):
+    '''Closes a truncated record: the partial row is dropped and a footer is
+    written. Returns False if the record was complete already.'''
+    with open(path, 'r+b') as file:
+        header, offset, rows, footer = read_layout(file)
+        if(footer is not None):
+            return False
+        file.truncate(offset + rows * ROW_SIZE)
+        file.seek(0, os.SEEK_END)
+        write_footer(file, {'module': header.get('module'), 'sample_count': rows,
+                            'complete': False, 'recovered': True})
+        file.flush()
+        os.fsync(file.fileno())
+    return True
+
+def main(args):
+    if(len(args) < 2 or args[0] != 'recover'):
+        print(__doc__.splitlines()[-1])
+        return
+    paths = []
+    for arg in args[1:]:
+        if(os.path.isdir(arg)):
+            paths += [os.path.join(root, file) for root, _, files in os.walk(arg)
+                      for file in files if file.endswith(RECORD_EXTENSION)]
+        else:
+            paths.append(arg)
+    for path in sorted(paths):
+        try:
+            if(recover(path)):
+                print("Recovered " + path)
+        except (OSError, ValueError) as error:
+            print("Failed " + path + ": " + str(error))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,345 @@
+'''Publishes the live data of the acquisition process into shared memory, so
+that the live plot can be drawn by separate viewer processes (live_viewer.py)
+which never hold the GIL of the acquisition.
+
+The shared memory block starts with a small header holding a sequence number.
+The publisher makes it odd while writing and even again when done, a reader
+copies the data and only accepts the copy if the sequence number was even and
+unchanged, otherwise it tries again later. The publisher therefore never waits
+for the readers, and any number of readers can attach to the same run.
+
+Each run has a block of its own, named after the process and the run, since
+on Windows a block cannot be created again while a viewer still holds it. The
+name of the block of the current run is announced in a small block named
+SHM_NAME, which the publisher keeps until it exits. Publishing never raises
+into the acquisition: on any error the publisher is disabled.'''
+import numpy as np
+import atexit, json, os, struct, time
+from multiprocessing import shared_memory
+
+SHM_NAME = 'carter_live' # Default name of the announce block, see shm_publisher.announce_run
+ANNOUNCE_SIZE = 256 # Bytes of the announce block, the length and the name of the block of the run
+PUBLISH_RATE = 50 # Maximum number of updates of the shared memory per second
+META_SIZE = 1024 # Bytes reserved for the json metadata (module name, titles...)
+READ_ATTEMPTS = 5 # Attempts of a reader to get a consistent copy
+
+# Slots of the integer header
+SEQ, INDEX, TEMP_INDEX, BUFFER_LENGTH, FFT_LENGTH, PHASE_CAPACITY, AMP_CAPACITY, \
+    PHASE_LENGTH, AMP_LENGTH, META_LENGTH, FLAGS = range(11)
+N_INTS = 16
+# Slots of the float header
+OMEGA, AMP, AMP_0, START_TIME, AVG_SPACING, SAMPLING_DIV = range(6)
+N_FLOATS = 16
+# Bits of the FLAGS slot
+FLAG_ACTIVE = 1 # phase_list_active is published
+FLAG_CLOSED = 2 # The run is over, the block is about to be removed
+N_SERIES = 5 # time, angle, position, angular_velocity, position_velocity
+
+def block_size(buffer_length, phase_capacity, amp_capacity):
+    return 8 * (N_INTS + N_FLOATS) + META_SIZE \
+        + 8 * (N_SERIES * buffer_length + 2 * 2 * phase_capacity + 2 * amp_capacity)
+
+class shared_block():
+
+    '''Numpy views of the header and the arrays in a shared memory block'''
+
+    def __init__(self, shm, buffer_length, phase_capacity, amp_capacity):
+        self.shm = shm
+        buf = shm.buf
+        offset = 0
+        self.ints = np.ndarray(N_INTS, dtype = np.int64, buffer = buf, offset = offset)
+        offset += 8 * N_INTS
+        self.floats = np.ndarray(N_FLOATS, dtype = np.float64, buffer = buf, offset = offset)
+        offset += 8 * N_FLOATS
+        self.meta = np.ndarray(META_SIZE, dtype = np.uint8, buffer = buf, offset = offset)
+        offset += META_SIZE
+        self.ring = np.ndarray((N_SERIES, buffer_length), dtype = np.float64, buffer = buf, offset = offset)
+        offset += 8 * N_SERIES * buffer_length
+        self.phase = np.ndarray((phase_capacity, 2), dtype = np.float64, buffer = buf, offset = offset)
+        offset += 8 * 2 * phase_capacity
+        self.phase_active = np.ndarray((phase_capacity, 2), dtype = np.float64, buffer = buf, offset = offset)
+        offset += 8 * 2 * phase_capacity
+        self.amp = np.ndarray((amp_capacity, 2), dtype = np.float64, buffer = buf, offset = offset)
+
+    def release(self):
+        '''The views have to be deleted before the shared memory is closed'''
+        del self.ints, self.floats, self.meta, self.ring, self.phase, self.phase_active, self.amp
+
+class shm_publisher():
+
+    '''Writer side, owned by the live_data object of the acquisition process.
+    The block of a run is created on its first publish() and removed by close().'''
+
+    def __init__(self, name = SHM_NAME, rate = PUBLISH_RATE):
+        self.name = name
+        self.period = 1. / rate
+        self.block = None
+        self.announce = None # Block holding the name of the block of the current run
+        self.runs = 0
+        self.disabled = False
+        self.last_publish = 0.
+        self.published_index = 0
+        self.meta = None
+
+    def create(self, data):
+        self.buffer_length = data.buffer_length
+        # Lengths of the phase and amplitude lists of the data class
+        self.phase_capacity = data.plot_length * (data.wait_to_stable + 1) * 10
+        self.amp_capacity = data.plot_length * 10
+        size = block_size(self.buffer_length, self.phase_capacity, self.amp_capacity)
+        self.runs += 1
+        block_name = '%s_%d_%d' % (self.name, os.getpid(), self.runs)
+        shm = shared_memory.SharedMemory(name = block_name, create = True, size = size)
+        self.block = shared_block(shm, self.buffer_length, self.phase_capacity, self.amp_capacity)
+        ints = self.block.ints
+        ints[:] = 0
+        ints[BUFFER_LENGTH] = self.buffer_length
+        ints[FFT_LENGTH] = data.fft_length
+        ints[PHASE_CAPACITY] = self.phase_capacity
+        ints[AMP_CAPACITY] = self.amp_capacity
+        self.published_index = 0
+        self.meta = None
+        self.announce_run(block_name)
+
+    def announce_run(self, block_name):
+        '''Writes the name of the block of the run in the announce block, which
+        is created by the first run'''
+        if(self.announce is None):
+            try:
+                self.announce = shared_memory.SharedMemory(name = self.name, create = True, size = ANNOUNCE_SIZE)
+            except FileExistsError:
+                # Left over by a publisher that crashed, or still held by a viewer
+                self.announce = shared_memory.SharedMemory(name = self.name)
+            atexit.register(self.shutdown)
+        raw = block_name.encode()
+        self.announce.buf[4:4 + len(raw)] = raw
+        self.announce.buf[:4] = struct.pack('<I', len(raw))
+
+    def disable(self, error):
+        '''Stops publishing after an error, the acquisition goes on'''
+        print("\nShared memory publishing disabled: %s: %s\n" % (type(error).__name__, error))
+        self.disabled = True
+        self.close()
+
+    def publish(self, data, force = False):
+        '''Copies the new samples and the derived series of data (a live_data
+        object) into the shared memory, at most PUBLISH_RATE times per second'''
+        now = time.perf_counter()
+        if(self.disabled or (not force and now - self.last_publish < self.period)):
+            return
+        self.last_publish = now
+        try:
+            self.write(data)
+        except Exception as error:
+            # Publishing must never stop the acquisition
+            self.disable(error)
+
+    def write(self, data):
+        '''Copies the data into the block of the run, created if needed'''
+        if(self.block is None):
+            self.create(data)
+        block = self.block
+        ints = block.ints
+        length = self.buffer_length
+        # Samples below index are complete, the reader thread may be writing the next one
+        index = data.index
+        ints[SEQ] += 1 # Odd, writing
+        if(index < self.published_index or index - self.published_index >= length):
+            low, high = 0, length # Cleared or too far behind, copy the whole ring
+        else:
+            low, high = self.published_index % length, index % length
+        series = (data.time, data.angle, data.position, data.angular_velocity, data.position_velocity)
+        for row, values in enumerate(series):
+            if(low <= high):
+                block.ring[row, low:high] = values[low:high]
+            else:
+                block.ring[row, low:] = values[low:length]
+                block.ring[row, :high] = values[:high]
+        self.published_index = index
+        ints[INDEX] = index
+        ints[TEMP_INDEX] = (index - 1) % length if index > 0 else 0
+        ints[PHASE_LENGTH] = self.copy_series(block.phase, data.phase_list)
+        ints[AMP_LENGTH] = self.copy_series(block.amp, data.amp_list)
+        flags = 0
+        if(data.phase_list_active is not None):
+            self.copy_series(block.phase_active, data.phase_list_active)
+            flags |= FLAG_ACTIVE
+        ints[FLAGS] = flags
+        block.floats[OMEGA] = data.omega
+        block.floats[AMP] = data.amp
+        block.floats[AMP_0] = data.amp_0
+        block.floats[START_TIME] = data.start_time
+        block.floats[AVG_SPACING] = data.avg_spacing
+        block.floats[SAMPLING_DIV] = data.sampling_div
+        meta = {
+            'module_name': data.module_name,
+            'pid_param': getattr(data, 'pid_param', None),
+            'setSpeed_param': data.setSpeed_param,
+            }
+        if(meta != self.meta):
+            self.meta = meta
+            raw = np.frombuffer(json.dumps(meta).encode()[:META_SIZE], dtype = np.uint8)
+            block.meta[:len(raw)] = raw
+            ints[META_LENGTH] = len(raw)
+        ints[SEQ] += 1 # Even, consistent
+
+    def copy_series(self, target, series):
+        '''Copies the last entries of a list of (time, value) tuples, returns the number copied'''
+        if(series is None):
+            # e.g. phase_list when several frequencies are driven, not published
+            return 0
+        series = series[-len(target):]
+        if(len(series) == 0):
+            return 0
+        target[:len(series)] = np.asarray(series, dtype = np.float64)
+        return len(series)
+
+    def close(self):
+        '''Marks the run as over and removes the block, the attached readers
+        keep their mapping until they detach'''
+        if(self.block is None):
+            return
+        block, self.block = self.block, None
+        try:
+            block.ints[FLAGS] |= FLAG_CLOSED
+            block.ints[SEQ] += 2
+            shm = block.shm
+            block.release()
+            shm.close()
+            shm.unlink()
+        except OSError:
+            # Already removed, or kept by a viewer until it detaches on Windows
+            pass
+        except Exception as error:
+            print("\nCould not close the shared memory block: %s: %s\n" % (type(error).__name__, error))
+
+    def shutdown(self):
+        '''Ends the current run and removes the announce block, at exit'''
+        self.close()
+        if(self.announce is not None):
+            self.announce.close()
+            try:
+                self.announce.unlink()
+            except OSError:
+                pass
+            self.announce = None
+
+def open_block(name):
+    '''Attaches to an existing block, None if there is none'''
+    try:
+        shm = shared_memory.SharedMemory(name = name)
+    except (FileNotFoundError, ValueError):
+        return None
+    if(os.name == 'posix'):
+        # The resource tracker would otherwise remove the block of the
+        # acquisition process when this reader exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+class shm_reader():
+
+    '''Reader side, used by the viewer processes'''
+
+    def __init__(self, name = SHM_NAME):
+        self.name = name
+        self.block = None
+        self.seq = -1
+
+    def attach(self):
+        '''Returns True if the block of a run exists and is attached'''
+        if(self.block is not None):
+            return True
+        block_name = self.announced()
+        if(block_name is None):
+            return False
+        shm = open_block(block_name)
+        if(shm is None):
+            return False
+        ints = np.ndarray(N_INTS, dtype = np.int64, buffer = shm.buf)
+        buffer_length, phase_capacity, amp_capacity, flags = \
+            int(ints[BUFFER_LENGTH]), int(ints[PHASE_CAPACITY]), int(ints[AMP_CAPACITY]), int(ints[FLAGS])
+        del ints
+        if(buffer_length == 0 or flags & FLAG_CLOSED):
+            # Not initialised yet, or the run is over and the next one not announced yet
+            shm.close()
+            return False
+        self.block = shared_block(shm, buffer_length, phase_capacity, amp_capacity)
+        self.seq = -1
+        return True
+
+    def announced(self):
+        '''Returns the name of the block of the current run, None if no run was
+        announced'''
+        announce = open_block(self.name)
+        if(announce is None):
+            return None
+        try:
+            length, = struct.unpack('<I', bytes(announce.buf[:4]))
+            if(0 < length <= ANNOUNCE_SIZE - 4):
+                return bytes(announce.buf[4:4 + length]).decode()
+            return None
+        except UnicodeDecodeError:
+            # Read while the publisher was writing it
+            return None
+        finally:
+            announce.close()
+
+    def closed(self):
+        '''Returns True if the publisher has ended the run'''
+        return self.block is not None and bool(self.block.ints[FLAGS] & FLAG_CLOSED)
+
+    def changed(self):
+        return self.block is not None and self.block.ints[SEQ] != self.seq
+
+    def snapshot(self):
+        '''Returns a consistent copy of the published data as a dictionary,
+        None if there is nothing new or the publisher kept writing'''
+        block = self.block
+        if(block is None):
+            return None
+        ints = block.ints
+        for _ in range(READ_ATTEMPTS):
+            seq = int(ints[SEQ])
+            if(seq == self.seq):
+                return None
+            if(seq % 2):
+                time.sleep(0)
+                continue
+            header = ints.copy()
+            floats = block.floats.copy()
+            ring = block.ring.copy()
+            phase = block.phase[:header[PHASE_LENGTH]].copy()
+            amp = block.amp[:header[AMP_LENGTH]].copy()
+            phase_active = block.phase_active[:header[PHASE_LENGTH]].copy() \
+                if header[FLAGS] & FLAG_ACTIVE else None
+            meta = bytes(block.meta[:header[META_LENGTH]])
+            if(int(ints[SEQ]) != seq):
+                continue
+            self.seq = seq
+            return {
+                'index': int(header[INDEX]),
+                'temp_index': int(header[TEMP_INDEX]),
+                'fft_length': int(header[FFT_LENGTH]),
+                'closed': bool(header[FLAGS] & FLAG_CLOSED),
+                'omega': floats[OMEGA],
+                'amp': floats[AMP],
+                'amp_0': floats[AMP_0],
+                'start_time': floats[START_TIME],
+                'avg_spacing': floats[AVG_SPACING],
+                'sampling_div': floats[SAMPLING_DIV],
+                'ring': ring,
+                'phase': phase,
+                'phase_active': phase_active,
+                'amp_list': amp,
+                'meta': json.loads(meta) if meta else {},
+                }
+        return None
+
+    def detach(self):
+        if(self.block is None):
+            return
+        shm = self.block.shm
+        self.block.release()
+        self.block = None
+        shm.close()
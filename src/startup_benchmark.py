@@ -0,0 +1,74 @@
+'''Start-up benchmark of the scripts. Each module is imported in a fresh
+interpreter with python -X importtime, and the import time of the module is
+reported with its slowest direct imports. The first run of a module is the
+cold start, the best of the following runs the warm start.
+
+Usage: python startup_benchmark.py [module ...]'''
+import os, subprocess, sys, time
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+MODULES = [
+    'data_process',
+    'Pendulum_Control_Console',
+    'auto_pid',
+    'twoauto',
+    'auto_freq_scan',
+    'data_analysis',
+    'image_analysis',
+    'pca',
+    ]
+REPEAT = 3 # Number of runs per module
+TOP = 5 # Number of direct imports listed per module
+
+def import_times(module):
+    '''Imports the module in a new interpreter. Returns the wall time of the
+    interpreter in seconds, the import time of the module in seconds, its
+    direct imports as a list of (seconds, name) and the error if any.'''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd = SRC, capture_output = True, text = True)
+    wall = time.perf_counter() - start
+    entries = []
+    for line in result.stderr.splitlines():
+        if(not line.startswith('import time:')):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1]) * 1e-6
+        except (IndexError, ValueError):
+            continue # Header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((depth, cumulative, name.strip()))
+    total, children = 0., []
+    # Children are printed before their parent, the module is the last top level entry
+    for i in range(len(entries) - 1, -1, -1):
+        depth, cumulative, name = entries[i]
+        if(depth == 0 and name == module):
+            total = cumulative
+            for depth, cumulative, name in reversed(entries[:i]):
+                if(depth == 0):
+                    break
+                if(depth == 1):
+                    children.append((cumulative, name))
+            break
+    error = None
+    if(result.returncode != 0):
+        error = result.stderr.strip().splitlines()[-1]
+    return wall, total, sorted(children, reverse = True), error
+
+def main(modules):
+    print('%-26s %10s %10s %10s' % ('module', 'cold/ms', 'warm/ms', 'import/ms'))
+    for module in modules:
+        runs = [import_times(module) for _ in range(REPEAT)]
+        cold = runs[0][0]
+        warm = min(run[0] for run in runs[1:]) if REPEAT > 1 else cold
+        best = min(runs[1:] or runs, key = lambda run: run[1])
+        print('%-26s %10.1f %10.1f %10.1f' % (module, 1000 * cold, 1000 * warm, 1000 * best[1]))
+        if(best[3] is not None):
+            print('    failed: ' + best[3])
+        for cumulative, name in best[2][:TOP]:
+            print('    %-22s %10.1f ms' % (name, 1000 * cumulative))
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or MODULES)
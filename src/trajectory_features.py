@@ -0,0 +1,177 @@
+"""
+Trajectory features of the runs, which describe how the pendulum and the cart
+moved rather than how well (see data_analysis.calculate_fitness_score), for
+the behaviour clustering of pca.py:
+    - the fraction of the spectral power of the angle and of the position in
+      each frequency band of BANDS
+    - the dominant oscillation frequency of the angle and of the position
+    - the limit-cycle amplitude of the angle and of the position, over the
+      second half of the run
+    - the share of the time spent in each cell of the angle / angular
+      velocity phase space, on a PHASE_BINS x PHASE_BINS grid
+    - the drift rate of the cart
+
+Usage: python trajectory_features.py [base_directory]
+writes the features of the runs of the data folders to FEATURES_PATH.
+"""
+import os
+import numpy as np
+import pandas as pd
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
+BANDS = ((0.0, 0.5), (0.5, 1.0), (1.0, 2.0), (2.0, 4.0), (4.0, np.inf)) # Frequency bands (Hz)
+PHASE_BINS = 4 # Bins per axis of the phase-space histogram
+# Angle (rad) and angular velocity (rad/s) covered by the histogram, the samples beyond fall in the edge bins
+PHASE_RANGE = ((-0.1, 0.1), (-3.0, 3.0))
+MIN_SAMPLES = 16 # Runs with fewer samples have no features
+CHUNK_RUNS = 32 # Maximum number of runs sent to a process at once
+FEATURES_PATH = 'trajectory_features.csv'
+
+def band_name(signal, low, high):
+    """Name of the band energy feature of a signal, e.g. angle_band_1_2hz."""
+    high = 'inf' if np.isinf(high) else f'{high:g}'
+    return f"{signal}_band_{low:g}_{high}hz".replace('.', 'p')
+
+FEATURE_NAMES = tuple(
+    [band_name(signal, low, high) for signal in ('angle', 'position') for low, high in BANDS]
+    + [f'{signal}_{name}' for signal in ('angle', 'position')
+       for name in ('dominant_frequency', 'limit_cycle_amplitude')]
+    + [f'phase_space_{i}_{j}' for i in range(PHASE_BINS) for j in range(PHASE_BINS)]
+    + ['drift_rate'])
+
+def spectrum(values, dt):
+    """
+    Power spectrum of a uniformly sampled signal, without its mean and with a
+    Hann window.
+
+    Returns:
+        tuple: The frequencies (Hz) and the power at each frequency.
+    """
+    power = np.abs(np.fft.rfft((values - values.mean()) * np.hanning(len(values)))) ** 2
+    return np.fft.rfftfreq(len(values), dt), power
+
+def extract_features(df):
+    """
+    Computes the trajectory features of a run.
+
+    Args:
+        df (pd.DataFrame): The time-series data, as loaded by
+            data_analysis.parse_and_load_data.
+
+    Returns:
+        dict: The value of each feature of FEATURE_NAMES, None if the run has
+            fewer than MIN_SAMPLES samples.
+    """
+    time = np.asarray(df['time'], dtype=float)
+    if len(time) < MIN_SAMPLES or time[-1] <= time[0]:
+        return None
+    angle = np.asarray(df['angle'], dtype=float)
+    position = np.asarray(df['position'], dtype=float)
+    angular_velocity = np.asarray(df['angular_velocity'], dtype=float)
+    features = {}
+
+    # The spectra need a uniform sampling, the samples are interpolated at the median step
+    dt = np.median(np.diff(time))
+    grid = np.arange(time[0], time[-1], dt)
+    for signal, values in (('angle', angle), ('position', position)):
+        uniform = np.interp(grid, time, values)
+        frequencies, power = spectrum(uniform, dt)
+        total = power[1:].sum() or 1.0
+        for low, high in BANDS:
+            band = (frequencies > 0) & (frequencies >= low) & (frequencies < high)
+            features[band_name(signal, low, high)] = power[band].sum() / total
+        features[f'{signal}_dominant_frequency'] = frequencies[1 + np.argmax(power[1:])] if len(power) > 1 else 0.0
+        steady = uniform[len(uniform) // 2:]
+        low, high = np.percentile(steady, [5, 95])
+        features[f'{signal}_limit_cycle_amplitude'] = (high - low) / 2
+
+    # Time spent in each cell of the phase space, the samples weigh their step
+    (angle_low, angle_high), (velocity_low, velocity_high) = PHASE_RANGE
+    occupancy, _, _ = np.histogram2d(
+        np.clip(angle, angle_low, angle_high), np.clip(angular_velocity, velocity_low, velocity_high),
+        bins=PHASE_BINS, range=PHASE_RANGE, weights=np.gradient(time))
+    occupancy /= occupancy.sum() or 1.0
+    for i in range(PHASE_BINS):
+        for j in range(PHASE_BINS):
+            features[f'phase_space_{i}_{j}'] = occupancy[i, j]
+
+    # Drift of the cart, the slope of the least squares line of the position (steps/s)
+    features['drift_rate'] = np.polyfit(time - time[0], position, 1)[0]
+    return features
+
+def extract_chunk(file_paths):
+    """
+    Loads a chunk of run files and extracts their features. This is the task
+    of the worker processes of extract_files, so it never raises.
+
+    Returns:
+        list: A tuple per file with the file path, the features (None if the
+            run has none) and the error message (None if there was none).
+    """
+    from data_analysis import parse_and_load_data
+    results = []
+    for file_path in file_paths:
+        try:
+            metadata, df = parse_and_load_data(file_path)
+            if df is None:
+                results.append((file_path, None, 'Could not be parsed'))
+            else:
+                results.append((file_path, extract_features(df), None))
+        except Exception as e:
+            results.append((file_path, None, f"{type(e).__name__}: {e}"))
+    return results
+
+def extract_files(file_paths, workers=None):
+    """
+    Extracts the features of the files in a pool of processes, in chunks of
+    at most CHUNK_RUNS files.
+
+    Args:
+        file_paths (list): The paths of the run files.
+        workers (int): The number of processes, one per CPU if None, and no
+            pool at all if 1.
+
+    Yields:
+        tuple: The results of extract_chunk for each file, in order.
+    """
+    file_paths = list(file_paths)
+    workers = workers or os.cpu_count() or 1
+    chunksize = min(CHUNK_RUNS, max(1, len(file_paths) // (4 * workers)))
+    chunks = [file_paths[i:i + chunksize] for i in range(0, len(file_paths), chunksize)]
+    if workers == 1 or len(chunks) < 2:
+        yield from chain.from_iterable(map(extract_chunk, chunks))
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        yield from chain.from_iterable(executor.map(extract_chunk, chunks))
+
+def feature_table(file_paths, workers=None):
+    """
+    Extracts the features of the runs into a table.
+
+    Args:
+        file_paths (list): The paths of the run files.
+        workers (int): The number of processes, see extract_files.
+
+    Returns:
+        pd.DataFrame: The file_path column and a column per feature, one row
+            per run with features.
+    """
+    rows = []
+    for file_path, features, error in extract_files(file_paths, workers):
+        if error is not None:
+            print(f"Error in {file_path}: {error}")
+        elif features is not None:
+            rows.append(dict(features, file_path=file_path))
+    return pd.DataFrame(rows, columns=['file_path', *FEATURE_NAMES])
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from run_catalog import find_runs
+    base_directory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    start = time.perf_counter()
+    table = feature_table([os.path.abspath(path) for path in find_runs(base_directory)])
+    table.to_csv(FEATURES_PATH, index=False)
+    print(f"Features of {len(table)} runs saved to {os.path.abspath(FEATURES_PATH)} "
+          f"in {time.perf_counter() - start:.1f} s")